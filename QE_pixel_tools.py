@@ -2,11 +2,21 @@ from astropy.io import fits
 import numpy as np
 import os
 import copy
+import glob
+import json
+import shutil
+import threading
+from collections import OrderedDict
+from paths_and_params import params
+from instrumentation import instrumented, record_read, record_write
+from fits_reader import PrefetchReader
+from dq_flags import or_dq, get_bad_pixel_mask, mask_bad_pixels, pack_mask, unpack_mask
 
 def open_fits(ifile, chips, DQ = False):
 
     """Opens fits file, returns science arrays (and DQ arrays, if DQ = True,
-        from specified UVIS chips.
+        from specified UVIS chips. Uncompressed and tile compressed images (see
+        write_full_frame_uvis_image) are read the same way.
         
         Parameters
         ----------
@@ -49,6 +59,8 @@ def open_fits(ifile, chips, DQ = False):
             DQ_arrays.append(DQ_array_chip)
         
     hdu_list.close()
+    
+    record_read(sum([ar.nbytes for ar in sci_arrays + DQ_arrays]))
         
     if DQ:
         return (sci_arrays,DQ_arrays)
@@ -56,7 +68,546 @@ def open_fits(ifile, chips, DQ = False):
         return sci_arrays
     
     
-def make_avg_flat_array(ifiles,avg_type,chips,combine_dq_arrays = False, mask_dq_each = False):
+#least recently used arrays first, see get_cached
+_cache = OrderedDict()
+_cache_info = {'bytes': 0, 'hits': 0, 'misses': 0}
+_cache_lock = threading.Lock()
+
+def get_cached(key, make):
+
+    """Returns the cached value of key, or computes it with make() and caches it.
+    
+    The value is an array or a list of arrays, which are made read-only: a caller 
+    that needs to change them (e.g. to mask pixels) must copy them first, see 
+    writable_copy. The cache holds at most params()['chip_cache_bytes'] bytes; the
+    least recently used values are evicted first. The cache is per process.
+    
+        Parameters
+        ----------
+        key: tuple
+            Identifies the value. For data read from a file, it should include the
+            path and modification time of the file, so that a changed file is read
+            again.
+            
+        make: function
+            Returns the value.
+        
+        """
+        
+    with _cache_lock:
+        if key in _cache:
+            _cache.move_to_end(key)
+            _cache_info['hits'] += 1
+            return _cache[key]
+        _cache_info['misses'] += 1
+        
+    value = make()
+    arrays = value if isinstance(value, list) else [value]
+    for ar in arrays:
+        ar.flags.writeable = False
+    nbytes = sum([ar.nbytes for ar in arrays])
+    
+    max_bytes = params()['chip_cache_bytes']
+    with _cache_lock:
+        if nbytes <= max_bytes and key not in _cache:
+            _cache[key] = value
+            _cache_info['bytes'] += nbytes
+            while _cache_info['bytes'] > max_bytes:
+                old_key, old_value = _cache.popitem(last = False)
+                old_arrays = old_value if isinstance(old_value, list) else [old_value]
+                _cache_info['bytes'] -= sum([ar.nbytes for ar in old_arrays])
+    return value
+    
+def clear_cache():
+
+    with _cache_lock:
+        _cache.clear()
+        _cache_info['bytes'] = 0
+        
+def get_cache_info():
+
+    """Returns the number of bytes, entries, hits and misses of the cache."""
+    
+    with _cache_lock:
+        info = dict(_cache_info)
+        info['entries'] = len(_cache)
+        return info
+        
+def writable_copy(array):
+
+    """Returns a copy of a cached (read-only) array that can be changed."""
+    
+    return np.array(array)
+    
+def load_chip(ifile, chip, ext = 'SCI'):
+
+    """Returns the ext ('SCI' or 'DQ') array of a chip of ifile as a read-only 
+        array, read once and then served from the cache (see get_cached) until 
+        the file changes."""
+        
+    def read_chip():
+        with fits.open(ifile) as hdu_list:
+            data = np.array(hdu_list[ext,chip].data)
+        record_read(data.nbytes)
+        return data
+        
+    key = ('chip', os.path.abspath(ifile), os.path.getmtime(ifile), chip, ext)
+    return get_cached(key, read_chip)
+    
+def load_bad_pixel_mask(ifile, chip, bad_bits = None):
+
+    """Returns the bad pixel mask (see dq_flags.get_bad_pixel_mask) of a chip of 
+        ifile. The mask is cached packed to one bit a pixel, so it is made once 
+        and kept at 1/16 of the size of the DQ array."""
+        
+    if bad_bits is None:
+        bad_bits = params()['dq_bad_bits']
+        
+    def make_mask():
+        with fits.open(ifile) as hdu_list:
+            dq = hdu_list['DQ',chip].data
+            record_read(dq.nbytes)
+            return [pack_mask(get_bad_pixel_mask(dq, bad_bits)), np.array(dq.shape)]
+            
+    key = ('dq_mask', os.path.abspath(ifile), os.path.getmtime(ifile), chip, bad_bits)
+    packed, shape = get_cached(key, make_mask)
+    return unpack_mask(packed, shape)
+    
+def load_masked_flat(ifile, chips, mask_DQ = False, mask_border = True):
+
+    """Returns the science arrays of chips of a flat (e.g. a median flat) with the
+        top and bottom 10 rows (mask_border) and flagged pixels (mask_DQ) set to 
+        NaN, as read-only arrays prepared once and then served from the cache."""
+        
+    def mask_flat():
+        sci_arrays = []
+        for chip in chips:
+            sci = writable_copy(load_chip(ifile, chip, 'SCI'))
+            if mask_border:
+                sci[0:10], sci[-10:] = np.nan, np.nan
+            if mask_DQ:
+                mask_bad_pixels(sci, load_bad_pixel_mask(ifile, chip))
+            sci_arrays.append(sci)
+        return sci_arrays
+        
+    key = ('masked', os.path.abspath(ifile), os.path.getmtime(ifile), tuple(chips),
+           params()['dq_bad_bits'] if mask_DQ else None, mask_border)
+    return get_cached(key, mask_flat)
+    
+    
+@instrumented(tag_args=('ifiles',), profile=True)
+def make_mean_flat_array(ifiles, chips, combine_dq_arrays = False, 
+                         mask_dq_each = False):
+                         
+    """Makes a mean image for input files, one file at a time. 
+    
+    Keeps a running sum and a count of valid (not NaN) values for each pixel, so 
+    memory use does not depend on the number of files. Pixels that are NaN 
+    in some files, or flagged bad in their DQ array (see dq_flags) with 
+    mask_dq_each, are averaged over the remaining files; pixels with no valid 
+    values are NaN.
+    
+        Parameters
+        ----------
+        ifiles: list of string
+            Paths to input files.
+            
+        chips: list of ints
+            List of UVIS chips.
+            
+        Returns
+        -------
+        
+        mean_flat_arrays: tuple of arrays
+            Tuple containing the mean image for each chip, and the combined DQ 
+            arrays.
+        
+        """
+        
+    chips = sorted(chips)
+    
+    sum_arrays = None
+    
+    #the next files are read while the current one is added
+    for filee, rows, sci_arrays, dq_arrays in PrefetchReader(ifiles,chips,DQ=True):
+        
+        #initialize accumulators from the first file
+        if sum_arrays is None:
+            dims = sci_arrays[0].shape
+            sum_arrays = np.zeros((len(chips),dims[0],dims[1]))
+            count_arrays = np.zeros((len(chips),dims[0],dims[1]),dtype=np.int32)
+            DQ_array_chips = np.zeros((len(chips),dims[0],dims[1]),dtype=np.uint16)
+            bad = np.empty(dims,dtype=bool)
+            
+        for j in range(len(sci_arrays)):
+            tmp = np.array(sci_arrays[j],dtype=np.float64)
+            if mask_dq_each:
+                mask_bad_pixels(tmp, get_bad_pixel_mask(dq_arrays[j], out=bad))
+            valid = ~np.isnan(tmp)
+            np.add(sum_arrays[j],tmp,out=sum_arrays[j],where=valid)
+            count_arrays[j] += valid
+            if combine_dq_arrays:
+                or_dq(DQ_array_chips[j], dq_arrays[j])
+                
+    mean_arrs = []
+    for j in range(len(chips)):
+        mean_arr = np.full(sum_arrays[j].shape, np.nan)
+        np.divide(sum_arrays[j],count_arrays[j],out=mean_arr,where=count_arrays[j]>0)
+        mean_arrs.append(mean_arr)
+        
+    return (mean_arrs,DQ_array_chips)
+    
+    
+def get_chip_shape(ifile, chip):
+
+    """Returns the shape of the science array of a chip, read from the header only."""
+    
+    hdu_list = fits.open(ifile, memmap = True)
+    dims = hdu_list['SCI',chip].shape
+    hdu_list.close()
+    return dims
+    
+    
+def nanmedian_cube(cube, out = None, stats_out = None):
+
+    """Median of a data cube along its first (file) axis, ignoring NaNs.
+    
+    The cube is sorted in place, which puts NaNs at the end of each pixel's values,
+    and the median is taken from the middle of each pixel's valid values. Pixels 
+    with no valid values are NaN. Without NaNs, the result is the same as 
+    np.median(cube, axis=0).
+    
+        Parameters
+        ----------
+        cube: array
+            (n_files, ny, nx) array. Its contents are overwritten.
+            
+        out: array, optional
+            (ny, nx) array to write the median to.
+            
+        stats_out: dict, optional
+            (ny, nx) arrays to write other statistics of each pixel's values to, 
+            taken from the same sorted cube, see get_cube_stats.
+            
+        Returns
+        -------
+        
+        out: array
+            Median image, with the same dtype as cube.
+        
+        """
+        
+    cube.sort(axis=0)
+    n_valid = cube.shape[0] - np.count_nonzero(np.isnan(cube), axis=0)
+    
+    lo = np.maximum((n_valid-1)//2, 0)[np.newaxis]
+    hi = np.minimum(n_valid//2, cube.shape[0]-1)[np.newaxis]
+    
+    if out is None:
+        out = np.empty(cube.shape[1:], dtype=cube.dtype)
+    np.add(np.take_along_axis(cube,lo,axis=0)[0],
+           np.take_along_axis(cube,hi,axis=0)[0],out=out)
+    out /= 2
+    
+    if stats_out is not None:
+        get_cube_stats(cube, n_valid, out, stats_out)
+    
+    return out
+    
+    
+def get_cube_stats(cube, n_valid, median, stats_out):
+
+    """Computes statistics of each pixel's values from a data cube sorted along 
+    its first axis (NaNs last), as left by nanmedian_cube.
+    
+    No statistic sorts the cube again: percentiles are interpolated between two 
+    sorted values, and the median absolute deviation (MAD) is found by a 
+    bisection over the sorted values (see get_kth_deviation), which reads 
+    2 * log2(n_files) values of each pixel. Pixels with no valid values are NaN 
+    (0 for n_valid).
+    
+        Parameters
+        ----------
+        cube: array
+            Sorted (n_files, ny, nx) array.
+            
+        n_valid: array
+            (ny, nx) number of valid values of each pixel.
+            
+        median: array
+            (ny, nx) median of each pixel.
+            
+        stats_out: dict
+            Statistic name: (ny, nx) array to write it to. Names are 'mad', 
+            'n_valid', or 'p' followed by a percentile, e.g. 'p16' (linear 
+            interpolation, as np.nanpercentile).
+            
+        """
+        
+    empty = n_valid == 0
+    n = np.maximum(n_valid, 1)
+    
+    for name, out in stats_out.items():
+        if name == 'n_valid':
+            out[:] = n_valid
+            
+        elif name == 'mad':
+            #median of the deviations, same ranks as the median of the values
+            mad = get_kth_deviation(cube, n, median, (n-1)//2 + 1)
+            mad += get_kth_deviation(cube, n, median, n//2 + 1)
+            mad /= 2
+            mad[empty] = np.nan
+            out[:] = mad
+            
+        elif name.startswith('p'):
+            pos = float(name[1:]) / 100. * (n-1)
+            lo = np.floor(pos).astype(np.intp)
+            hi = np.minimum(lo+1, n-1)
+            values_lo = np.take_along_axis(cube, lo[np.newaxis], axis=0)[0]
+            values_hi = np.take_along_axis(cube, hi[np.newaxis], axis=0)[0]
+            out[:] = values_lo + (pos-lo) * (values_hi-values_lo)
+            out[empty] = np.nan
+            
+        else:
+            raise ValueError('Unknown statistic {}.'.format(name))
+            
+            
+def get_kth_deviation(cube, n_valid, median, k):
+
+    """Returns the k-th smallest absolute deviation from median of each pixel's 
+    values, from a cube sorted along its first axis. n_valid and k are (ny, nx) 
+    arrays, with 1 <= k <= n_valid.
+    
+    The k values closest to the median are k consecutive sorted values, starting
+    at the first index i where values[i+k-1] - median >= median - values[i]. i is 
+    found for every pixel at once by bisection, and the k-th deviation is the 
+    smaller of the deviations of the windows starting at i and i-1.
+    
+        """
+        
+    def values_at(index):
+        return np.take_along_axis(cube, index[np.newaxis], axis=0)[0]
+        
+    lo = np.zeros(median.shape, dtype=np.intp)
+    hi = (n_valid - k).astype(np.intp)
+    
+    searching = lo < hi
+    while searching.any():
+        mid = (lo + hi) // 2
+        right = values_at(mid+k-1) - median >= median - values_at(mid)
+        hi = np.where(searching & right, mid, hi)
+        lo = np.where(searching & ~right, mid+1, lo)
+        searching = lo < hi
+        
+    dev = np.maximum(median - values_at(lo), values_at(lo+k-1) - median)
+    prev = np.maximum(lo-1, 0)
+    dev_prev = np.maximum(median - values_at(prev), values_at(prev+k-1) - median)
+    return np.minimum(dev, dev_prev)
+    
+    
+def make_stats_arrays(stats, n_chips, dims):
+
+    """Returns a dict of empty (n_chips, ny, nx) arrays for the statistics named 
+        in stats (see get_cube_stats): int32 for n_valid, float32 otherwise."""
+        
+    return OrderedDict([(name, np.empty((n_chips,dims[0],dims[1]),
+                         dtype=np.int32 if name == 'n_valid' else np.float32)) \
+                        for name in stats])
+                        
+                        
+def get_stats_strip(stats_arrays, y0, y1):
+
+    """Returns the rows y0:y1 of every array of stats_arrays, as keyword arguments
+        of save_checkpoint_strip."""
+        
+    return dict([('stat_'+name, arrays[:,y0:y1]) for name, arrays in \
+                 stats_arrays.items()])
+                 
+                 
+def get_stats_out(stats_arrays, j, y0 = 0, y1 = None):
+
+    """Returns the rows y0:y1 of chip j of every array of stats_arrays, for 
+        nanmedian_cube."""
+        
+    return OrderedDict([(name, arrays[j][y0:y1]) for name, arrays in \
+                        stats_arrays.items()])
+    
+    
+#rows of the cube sigma_clip_cube processes at a time
+SIGMA_CLIP_BLOCK_ROWS = 16
+
+def sigma_clip_cube(cube, sigma = None, iters = None, out = None, 
+                    block_rows = SIGMA_CLIP_BLOCK_ROWS):
+    
+    """Sigma clipped mean of a data cube along its first (file) axis, ignoring NaNs.
+    
+    For each pixel, values more than sigma standard deviations from the mean of
+    the values kept so far are rejected, and the mean and standard deviation are
+    recomputed, up to iters times or until no more values are rejected (the same
+    as astropy.stats.sigma_clip with cenfunc='mean', stdfunc='std'). The cube is 
+    processed block_rows rows at a time, every pixel of a block at once. The sums 
+    and counts of the kept values are computed once per block, and each iteration
+    only subtracts the values it clips, so an iteration costs one comparison of 
+    the block with the clipping bounds. The cube is not changed.
+    
+    With n values, a single outlier is at most (n-1)/sqrt(n) standard deviations 
+    from the mean, so sigma must be below that for outliers to be clipped from 
+    few files (2.47 for 8 files).
+    
+        Parameters
+        ----------
+        cube: array
+            (n_files, ny, nx) array.
+            
+        sigma: float
+            Clipping threshold in standard deviations, default 
+            params()['sigma_clip_sigma'].
+            
+        iters: int
+            Maximum number of clipping iterations, default 
+            params()['sigma_clip_iters'].
+            
+        out: array, optional
+            (ny, nx) array to write the clipped mean to.
+            
+        Returns
+        -------
+        
+        out: array
+            Clipped mean image, with the same dtype as cube. Pixels with no valid
+            values are NaN.
+            
+        n_clipped: array
+            Number of pixels of each file that were clipped (NaNs not counted).
+        
+        """
+        
+    if sigma is None:
+        sigma = params()['sigma_clip_sigma']
+    if iters is None:
+        iters = params()['sigma_clip_iters']
+        
+    n_files, ny, nx = cube.shape
+    if out is None:
+        out = np.empty((ny, nx), dtype=cube.dtype)
+    n_clipped = np.zeros(n_files, dtype=np.int64)
+    
+    for y0 in range(0, ny, block_rows):
+        block = cube[:,y0:y0+block_rows]
+        shape = block.shape[1:]
+        
+        #sums of the valid values, NaNs are left out
+        keep = ~np.isnan(block)
+        n_keep = keep.sum(axis=0, dtype=np.int32)
+        where = True if n_keep.min() == n_files else keep
+        sums = np.sum(block, axis=0, where=where, dtype=np.float64)
+        sums_sq = np.sum(np.square(block, dtype=np.float64), axis=0, where=where)
+        
+        for i in range(iters):
+            with np.errstate(invalid='ignore', divide='ignore'):
+                mean = sums / n_keep
+                std = np.sqrt(np.maximum(sums_sq / n_keep - mean**2, 0))
+                
+            #values already clipped stay out, NaNs never compare greater
+            dev = np.abs(block - mean.astype(block.dtype))
+            clipped = np.greater(dev, sigma * std)
+            clipped &= keep
+            
+            if not clipped.any():
+                break
+            idx = np.unravel_index(np.flatnonzero(clipped), clipped.shape)
+            keep[idx] = False
+            
+            values = block[idx].astype(np.float64)
+            pix = idx[1] * shape[1] + idx[2]
+            size = shape[0] * shape[1]
+            sums -= np.bincount(pix, weights=values, minlength=size).reshape(shape)
+            sums_sq -= np.bincount(pix, weights=values**2, minlength=size).reshape(shape)
+            n_keep -= np.bincount(pix, minlength=size).reshape(shape)
+            n_clipped += np.bincount(idx[0], minlength=n_files)
+            
+        with np.errstate(invalid='ignore', divide='ignore'):
+            out[y0:y0+block_rows] = sums / n_keep
+            
+    return out, n_clipped
+    
+    
+def print_clip_stats(ifiles, n_clipped, dims):
+
+    """Prints the fraction of pixels sigma clipped in all files, and the files 
+        with the most clipped pixels."""
+        
+    fractions = n_clipped.sum(axis=0) / float(n_clipped.shape[0] * dims[0] * dims[1])
+    print('clipped {:.3%} of pixels, most in:'.format(fractions.mean()))
+    for i in np.argsort(fractions)[::-1][0:3]:
+        print('    {} ({:.3%})'.format(os.path.basename(ifiles[i]), fractions[i]))
+    
+    
+def plan_combine(n_files, dims, n_chips, avg_type, max_memory):
+
+    """Chooses how to combine n_files full frames within max_memory bytes.
+    
+    Means are always made with the streaming running mean. Medians (and sigma 
+    clipped means, which use the same data cube) are made in memory if the 
+    float32 data cube of every chip fits in max_memory, otherwise in strips of as
+    many rows as fit. Sigma clipping also needs the float64 temporaries of one 
+    block of sigma_clip_cube, which are taken off the budget first.
+    
+        Parameters
+        ----------
+        n_files: int
+            Number of files to combine.
+            
+        dims: tuple of ints
+            Shape of the science array of one chip.
+            
+        n_chips: int
+            Number of chips combined.
+            
+        avg_type: string
+            'median', 'mean' or 'sigma_clip'.
+            
+        max_memory: int
+            Memory budget in bytes.
+            
+        Returns
+        -------
+        
+        (strategy, strip_height): tuple
+            strategy is 'streaming' (make_mean_flat_array), 'memory' 
+            (make_avg_flat_array) or 'tiled' (make_avg_flat_array_strips with 
+            strip_height rows).
+        
+        """
+        
+    if avg_type == 'mean':
+        return ('streaming', dims[0])
+        
+    #float32 cube, plus the NaN mask and sort indices used by nanmedian_cube
+    bytes_per_row = n_chips * n_files * dims[1] * (4 + 1) + n_chips * dims[1] * 24
+    
+    #sigma_clip_cube works on SIGMA_CLIP_BLOCK_ROWS rows of one chip at a time: 
+    #NaN mask, float64 squares, float32 deviations (two) and clip mask of the block
+    temp_bytes = 0
+    if avg_type == 'sigma_clip':
+        temp_bytes = n_files * SIGMA_CLIP_BLOCK_ROWS * dims[1] * (1 + 8 + 4 + 4 + 1)
+    
+    #leave room for the interpreter, file buffers and output arrays
+    max_memory = 0.8 * max_memory - temp_bytes
+    
+    if bytes_per_row * dims[0] <= max_memory:
+        return ('memory', dims[0])
+        
+    strip_height = int(max_memory // bytes_per_row)
+    if strip_height < 1:
+        raise MemoryError('Cannot median combine {} files within {} bytes.'.format(
+                          n_files, max_memory))
+    return ('tiled', strip_height)
+    
+    
+@instrumented(tag_args=('ifiles','avg_type'), profile=True)
+def make_avg_flat_array(ifiles,avg_type,chips,combine_dq_arrays = False, mask_dq_each = False,
+                        sigma = None, iters = None, stats = None):
 
     """Makes a median or mean image for input files. Assumes images are full frame 
     UVIS images, and returns a median or mean image for each chip. 
@@ -64,6 +615,14 @@ def make_avg_flat_array(ifiles,avg_type,chips,combine_dq_arrays = False, mask_dq
     If desired, DQ array is generated from all the DQ arrays of the 
     combined files - a flag is set for a pixel if that pixel was flagged in ANY of the 
     input images.
+    
+    Means are computed with make_mean_flat_array, which streams the files and 
+    never holds more than one of them in memory. Medians are computed on a float32
+    data cube (the native type of FLT science arrays) with nanmedian_cube, so 
+    pixels masked with mask_dq_each (pixels flagged bad in the DQ array of their
+    own file, see dq_flags) are left out of the median. avg_type 'sigma_clip' 
+    makes a sigma clipped mean of the same data cube with sigma_clip_cube, which 
+    rejects cosmic rays and other outliers at a lower cost than the median.
               
         Parameters
         ----------
@@ -76,78 +635,433 @@ def make_avg_flat_array(ifiles,avg_type,chips,combine_dq_arrays = False, mask_dq
         ifiles: list of string
             Paths to input files.
             
+        avg_type: string
+            'median', 'mean' or 'sigma_clip'.
+            
+        sigma, iters: float, int
+            Parameters of sigma_clip_cube, for avg_type 'sigma_clip'.
+            
+        stats: list of strings
+            For avg_type 'median', other statistics of each pixel (e.g. 'mad', 
+            'n_valid', 'p16'), taken from the data cube sorted for the median, 
+            see get_cube_stats.
+            
         Returns
         -------
         
         median_flat_arrays: tuple of arrays
             Tuple containing the median image for (chip 1, chip 2) 
+            
+        For avg_type 'sigma_clip', the tuple also contains an (n_chips, n_files) 
+        array of the number of pixels clipped in each chip of each file. For 
+        avg_type 'median' with stats, it also contains a dict of the 
+        (n_chips, ny, nx) array of each statistic (see make_stats_arrays).
         
         """
     
     #sort order of chips so they are ascending...
     chips = sorted(chips)
+    
+    if avg_type == 'mean':
+        print('computing mean of {} images'.format(str(len(ifiles))))
+        return make_mean_flat_array(ifiles,chips,combine_dq_arrays = combine_dq_arrays,
+                                    mask_dq_each = mask_dq_each)
 
     #initialize an empty array for each chip
-    test_hdu = fits.open(ifiles[0])
-    test_sci_ar = test_hdu['SCI',chips[0]].data
-    dims = test_sci_ar.shape
-    test_hdu.close()
+    dims = get_chip_shape(ifiles[0],chips[0])
     
-    avg_array_chips = np.zeros((len(chips),len(ifiles),dims[0],dims[1]))
-    DQ_array_chips = np.zeros((len(chips),dims[0],dims[1]),dtype=np.int16)
+    avg_array_chips = np.empty((len(chips),len(ifiles),dims[0],dims[1]),dtype=np.float32)
+    DQ_array_chips = np.zeros((len(chips),dims[0],dims[1]),dtype=np.uint16)
+    bad = np.empty(dims,dtype=bool)
 
-    #fill up empty data cube 
-    for i, filee in enumerate(ifiles):
-        sci_arrays,dq_arrays = open_fits(filee,chips,DQ=True)  
+    #fill up empty data cube, reading the next files while the current one is copied
+    reader = PrefetchReader(ifiles,chips,DQ=True)
+    for i, (filee, rows, sci_arrays, dq_arrays) in enumerate(reader):
         for j in range(len(sci_arrays)):
-            tmp = np.copy(sci_arrays[j])
+            avg_array_chips[j][i] = sci_arrays[j]
             if mask_dq_each:
-                tmp[DQ_array_chips[j] != 0] = np.nan
-            avg_array_chips[j][i] = tmp
+                mask_bad_pixels(avg_array_chips[j][i],
+                                get_bad_pixel_mask(dq_arrays[j], out=bad))
             if combine_dq_arrays:
-
-                DQ_array_chips[j] = DQ_array_chips[j] | dq_arrays[j]
+                or_dq(DQ_array_chips[j], dq_arrays[j])
 
   #make average image (median or mean)
     if avg_type == 'median':
         print('computing median of {} images...'.format(str(len(ifiles))))
-        median_arrs = [np.median(arr, axis=0) for arr in avg_array_chips]
+        if stats:
+            stats_arrays = make_stats_arrays(stats, len(chips), dims)
+            median_arrs = [nanmedian_cube(arr, stats_out=get_stats_out(stats_arrays,j)) \
+                           for j, arr in enumerate(avg_array_chips)]
+            return (median_arrs,DQ_array_chips,stats_arrays)
+        median_arrs = [nanmedian_cube(arr) for arr in avg_array_chips]
         return (median_arrs,DQ_array_chips)
+        
+    elif avg_type == 'sigma_clip':
+        print('computing sigma clipped mean of {} images...'.format(str(len(ifiles))))
+        clip_results = [sigma_clip_cube(arr,sigma=sigma,iters=iters) for arr in avg_array_chips]
+        n_clipped = np.array([result[1] for result in clip_results])
+        print_clip_stats(ifiles, n_clipped, dims)
+        return ([result[0] for result in clip_results],DQ_array_chips,n_clipped)
+            
+    else:
+        print("Please specify method of average ('mean', 'median' or 'sigma_clip').")
+    
+    
+def has_scaling(hdu):
 
-    if avg_type == 'mean':
-        print('computing mean of {} images'.format(str(len(ifiles))))
+    """Returns True if the image HDU hdu (tile compressed or not) has BZERO, 
+        BSCALE or BLANK keywords (e.g. uint16 data stored as int16), which astropy
+        cannot read from a memory map."""
+        
+    return any([key in hdu.header for key in ('BZERO','BSCALE','BLANK')])
+    
+def open_fits_section(ifile, chips, rows, DQ = False):
+
+    """Opens fits file, returns a horizontal strip of the science arrays (and DQ 
+        arrays, if DQ = True) from specified UVIS chips. Only the requested rows are
+        read from disk, the rest of the file is never loaded into memory.
+        
+        The file is memory mapped, unless one of the extensions read has scaling
+        keywords (see has_scaling), as the uint16 DQ arrays of the flats written
+        by the pipeline, compressed or not: then it is opened without a memory 
+        map, and still only the rows (or compressed tiles) of the strip are read.
+        
+        Parameters
+        ----------
+        
+        ifile: string
+            Path to input file.
+            
+        chips: list of ints
+            List of UVIS chips.
+            
+        rows: tuple of ints
+            (first row, last row + 1) of the strip to read.
+            
+        Returns
+        -------
+        Same as open_fits, but each array only contains rows[0]:rows[1].
+        
+        """
+        
+    hdu_list = fits.open(ifile, memmap = True)
+    exts = ['SCI','DQ'] if DQ else ['SCI']
+    if any([has_scaling(hdu_list[ext,chip]) for ext in exts for chip in chips]):
+        hdu_list.close()
+        hdu_list = fits.open(ifile, memmap = False)
+    
+    sci_arrays = []
+    DQ_arrays = []
+    
+    for chip in chips:
+        sci_array_chip = hdu_list['SCI',chip].section[rows[0]:rows[1],:]
+        sci_arrays.append(np.array(sci_array_chip))
+        if DQ:
+            DQ_array_chip = hdu_list['DQ',chip].section[rows[0]:rows[1],:]
+            DQ_arrays.append(np.array(DQ_array_chip))
+            
+    hdu_list.close()
+    
+    record_read(sum([ar.nbytes for ar in sci_arrays + DQ_arrays]))
+    
+    if DQ:
+        return (sci_arrays,DQ_arrays)
+    else:
+        return sci_arrays
+        
+        
+def read_checkpoint(checkpoint_dir, key):
+
+    """Returns the first rows of the strips already done in a checkpoint of a 
+        combine, or an empty list. A checkpoint written for a different key 
+        (i.e. other inputs or parameters) is cleared, and a new one started.
+        
+        Parameters
+        ----------
+        
+        checkpoint_dir: string
+            Directory of the checkpoint: a journal (journal.json) of the key and 
+            the strips done, and the results of each strip done (strip_<y0>.npz).
+            
+        key: string
+            Identifies the inputs and parameters of the combine, e.g. a hash of 
+            the input manifest.
+            
+        """
+        
+    journal_path = os.path.join(checkpoint_dir,'journal.json')
+    if os.path.isfile(journal_path):
+        with open(journal_path,'r') as f:
+            journal = json.load(f)
+        if journal['key'] == key:
+            #leftovers of a strip being saved when the last run was killed
+            for tmp_path in glob.glob(os.path.join(checkpoint_dir,'*.tmp')):
+                os.remove(tmp_path)
+            print('Resuming from checkpoint, {} strips done.'.format(len(journal['done'])))
+            return journal['done']
+            
+    clear_checkpoint(checkpoint_dir)
+    os.makedirs(checkpoint_dir)
+    write_journal(checkpoint_dir, {'key': key, 'done': []})
+    return []
+    
+def checkpoint_matches(checkpoint_dir, key):
+
+    """Returns True if there is a checkpoint for key in checkpoint_dir."""
+    
+    journal_path = os.path.join(checkpoint_dir,'journal.json')
+    if not os.path.isfile(journal_path):
+        return False
+    with open(journal_path,'r') as f:
+        return json.load(f)['key'] == key
+        
+def write_journal(checkpoint_dir, journal):
 
-        mean_arrs = [np.mean(arr, axis=0) for arr in avg_array_chips]
+    journal_path = os.path.join(checkpoint_dir,'journal.json')
+    with open(journal_path+'.tmp','w') as f:
+        json.dump(journal, f)
+    os.rename(journal_path+'.tmp', journal_path)
+    
+def save_checkpoint_strip(checkpoint_dir, y0, **arrays):
+
+    """Saves the results (arrays) of the strip starting at row y0, then adds it
+        to the journal. The file is written under a temporary name and renamed, 
+        so an interrupted save leaves no partial strip."""
+        
+    strip_path = os.path.join(checkpoint_dir,'strip_{}.npz'.format(y0))
+    tmp_path = strip_path+'.tmp'
+    try:
+        with open(tmp_path,'wb') as f:
+            np.savez(f, **arrays)
+        os.rename(tmp_path, strip_path)
+    except BaseException:
+        if os.path.isfile(tmp_path):
+            os.remove(tmp_path)
+        raise
+        
+    with open(os.path.join(checkpoint_dir,'journal.json'),'r') as f:
+        journal = json.load(f)
+    journal['done'].append(y0)
+    write_journal(checkpoint_dir, journal)
+    
+def load_checkpoint_strip(checkpoint_dir, y0):
 
-        return (mean_arrs,DQ_array_chips)
+    """Returns the arrays saved by save_checkpoint_strip, as a dict."""
+    
+    with np.load(os.path.join(checkpoint_dir,'strip_{}.npz'.format(y0))) as npz:
+        return dict([(name, npz[name]) for name in npz.files])
+        
+def clear_checkpoint(checkpoint_dir):
 
+    if os.path.isdir(checkpoint_dir):
+        shutil.rmtree(checkpoint_dir)
+        
+        
+@instrumented(tag_args=('ifiles','avg_type','strip_height'), profile=True)
+def make_avg_flat_array_strips(ifiles, avg_type, chips, strip_height = 64,
+                               combine_dq_arrays = False, mask_dq_each = False,
+                               checkpoint_dir = None, checkpoint_key = None,
+                               sigma = None, iters = None, stats = None):
+                               
+    """Streaming version of make_avg_flat_array for combining many files. 
+    
+    Instead of holding every full frame in memory at once, the chips are combined
+    one horizontal strip of `strip_height` rows at a time, reading only that strip 
+    from each input file. No intermediate files are written. The output is identical
+    to make_avg_flat_array called with the same arguments.
+    
+        Parameters
+        ----------
+        ifiles: list of string
+            Paths to input files.
+            
+        avg_type: string
+            'median', 'mean' or 'sigma_clip'.
+            
+        chips: list of ints
+            List of UVIS chips.
             
+        strip_height: int
+            Number of rows combined at a time. Peak memory is roughly
+            5 bytes * len(chips) * len(ifiles) * strip_height * ncolumns, see 
+            plan_combine.
+            
+        checkpoint_dir, checkpoint_key: strings
+            If given, each finished strip of the median is saved to a checkpoint 
+            (see read_checkpoint), and strips saved by an earlier, interrupted call 
+            with the same checkpoint_key are loaded instead of combined again. The 
+            caller clears the checkpoint once the result is safely written.
+            
+        sigma, iters, stats: 
+            See make_avg_flat_array.
+            
+        Returns
+        -------
+        
+        avg_flat_arrays: tuple of arrays
+            Tuple containing the median or mean image for each chip, and the 
+            combined DQ arrays (and the clipped pixel counts for 'sigma_clip' or
+            the statistics for 'median' with stats, see make_avg_flat_array).
+        
+        """
+        
+    if avg_type not in ('median','mean','sigma_clip'):
+        print("Please specify method of average ('mean', 'median' or 'sigma_clip').")
+        return
+        
+    chips = sorted(chips)
+    
+    #a running mean does not need the strips
+    if avg_type == 'mean':
+        print('computing mean of {} images'.format(str(len(ifiles))))
+        return make_mean_flat_array(ifiles,chips,combine_dq_arrays = combine_dq_arrays,
+                                    mask_dq_each = mask_dq_each)
+    
+    #get dimensions from the header, without reading the data
+    dims = get_chip_shape(ifiles[0],chips[0])
+    
+    avg_arrays = [np.empty(dims,dtype=np.float32) for chip in chips]
+    DQ_array_chips = np.zeros((len(chips),dims[0],dims[1]),dtype=np.uint16)
+    
+    #one buffer for all strips, reused as each strip is filled
+    strip_height = min(strip_height, dims[0])
+    strip_cube = np.empty((len(chips),len(ifiles),strip_height,dims[1]),dtype=np.float32)
+    bad_strip = np.empty((strip_height,dims[1]),dtype=bool)
+    n_clipped = np.zeros((len(chips),len(ifiles)),dtype=np.int64)
+    stats_arrays = make_stats_arrays(stats or [], len(chips), dims)
+    
+    print('computing {} of {} images in strips of {} rows...'.format(avg_type,
+          str(len(ifiles)),str(strip_height)))
+    
+    strips = [(y0,min(y0+strip_height,dims[0])) for y0 in range(0,dims[0],strip_height)]
+    
+    #strips finished by an interrupted run
+    done = []
+    if checkpoint_dir is not None:
+        done = read_checkpoint(checkpoint_dir, checkpoint_key)
+        for y0, y1 in strips:
+            if y0 in done:
+                strip = load_checkpoint_strip(checkpoint_dir, y0)
+                for j in range(len(chips)):
+                    avg_arrays[j][y0:y1] = strip['sci'][j]
+                DQ_array_chips[:,y0:y1] = strip['dq']
+                if avg_type == 'sigma_clip':
+                    n_clipped += strip['clipped']
+                for name in stats_arrays:
+                    stats_arrays[name][:,y0:y1] = strip['stat_'+name]
+        strips = [(y0, y1) for y0, y1 in strips if y0 not in done]
+        
+    #strips of the next files (and next strip) are read while one is copied
+    reader = iter(PrefetchReader([(filee,rows) for rows in strips for filee in ifiles],
+                                 chips,DQ=True))
+    
+    for y0, y1 in strips:
+        cube = strip_cube[:,:,0:y1-y0]
+        
+        for i in range(len(ifiles)):
+            filee, rows, sci_arrays, dq_arrays = next(reader)
+            for j in range(len(sci_arrays)):
+                cube[j][i] = sci_arrays[j]
+                if mask_dq_each:
+                    mask_bad_pixels(cube[j][i], get_bad_pixel_mask(dq_arrays[j],
+                                    out=bad_strip[0:y1-y0]))
+                if combine_dq_arrays:
+                    or_dq(DQ_array_chips[j][y0:y1], dq_arrays[j])
+                    
+        clipped_strip = np.zeros((len(chips),len(ifiles)),dtype=np.int64)
+        for j in range(len(chips)):
+            if avg_type == 'median':
+                nanmedian_cube(cube[j], out=avg_arrays[j][y0:y1],
+                               stats_out=get_stats_out(stats_arrays,j,y0,y1))
+            else:
+                clipped_strip[j] = sigma_clip_cube(cube[j], sigma=sigma, iters=iters,
+                                                   out=avg_arrays[j][y0:y1])[1]
+        n_clipped += clipped_strip
+            
+        if checkpoint_dir is not None:
+            save_checkpoint_strip(checkpoint_dir, y0, 
+                                  sci = np.array([ar[y0:y1] for ar in avg_arrays]),
+                                  dq = DQ_array_chips[:,y0:y1], clipped = clipped_strip,
+                                  **get_stats_strip(stats_arrays, y0, y1))
+                
+    if avg_type == 'sigma_clip':
+        print_clip_stats(ifiles, n_clipped, dims)
+        return (avg_arrays,DQ_array_chips,n_clipped)
+    if stats:
+        return (avg_arrays,DQ_array_chips,stats_arrays)
+    return (avg_arrays,DQ_array_chips)
+    
+    
+def make_uvis_image_hdu(data, extname, extver, compression = None):
+
+    """Returns the image extension extname, extver of a full frame UVIS image,
+        tile compressed as set by compression (see write_full_frame_uvis_image)."""
+        
+    if compression is None:
+        hdu = fits.ImageHDU(data)
+        
+    #DQ flags and counts are always compressed losslessly
+    elif extname == 'DQ' or np.asarray(data).dtype.kind in 'iu':
+        hdu = fits.CompImageHDU(data, compression_type = 'RICE_1')
+        
+    elif compression == 'lossless':
+        hdu = fits.CompImageHDU(np.asarray(data,dtype=np.float32),
+                                compression_type = 'GZIP_2', quantize_level = 0.)
+                                
+    elif isinstance(compression, (int, float)) and compression > 0:
+        #dither from the tile checksums, so the same data give the same file
+        hdu = fits.CompImageHDU(np.asarray(data,dtype=np.float32),
+                                compression_type = 'RICE_1',
+                                quantize_level = float(compression),
+                                quantize_method = 2, dither_seed = -1)
     else:
-        print("Please specify method of average ('mean' or 'median').")
+        raise ValueError("compression must be None, 'lossless' or a positive "
+                         "quantize level, not {}".format(compression))
+                         
+    hdu.header['EXTNAME'] = extname
+    hdu.header['EXTVER'] = extver
+    return hdu
     
     
 def write_full_frame_uvis_image(sci_array_chip1, sci_array_chip2, dq_array_chip1,
-                                dq_array_chip2, outfile_path, overwrite=True):
+                                dq_array_chip2, outfile_path, overwrite=True,
+                                compression = None, stats = None):
+                                
+    """Writes a full frame UVIS image with SCI and DQ extensions for each chip.
+    
+        compression: None, 'lossless' or float
+            None writes uncompressed images. Otherwise the images are tile 
+            compressed (one tile per row) and the SCI arrays are stored as 
+            float32: 'lossless' compresses them with GZIP, a number quantizes them
+            with steps of (noise / compression) before RICE compression, so larger
+            values keep more precision. DQ arrays are compressed losslessly with 
+            RICE. open_fits reads either layout.
+            
+        stats: dict, optional
+            Other images of each chip, e.g. the statistics returned by 
+            make_avg_flat_array with stats. Each (n_chips, ny, nx) array is 
+            written as an extension named after it in upper case ('MAD', 'N_VALID',
+            'P16'...), one EXTVER per chip, after the SCI and DQ extensions.
+            
+        """
                                 
     pri=fits.PrimaryHDU() # dummy primary extension
     
-    hdu = fits.ImageHDU(sci_array_chip1)
-    hdu.header['EXTNAME'] = 'SCI'
-    hdu.header['EXTVER'] = 1
+    hdu = make_uvis_image_hdu(sci_array_chip1, 'SCI', 1, compression)
     
-    hdu2 = fits.ImageHDU(dq_array_chip1)
-    hdu2.header['EXTNAME'] = 'DQ'
-    hdu2.header['EXTVER'] = 1
+    hdu2 = make_uvis_image_hdu(dq_array_chip1, 'DQ', 1, compression)
     
-    hdu3 = fits.ImageHDU(sci_array_chip2)
-    hdu3.header['EXTNAME'] = 'SCI'
-    hdu3.header['EXTVER'] = 2
+    hdu3 = make_uvis_image_hdu(sci_array_chip2, 'SCI', 2, compression)
     
-    hdu4 = fits.ImageHDU(dq_array_chip2)
-    hdu4.header['EXTNAME'] = 'DQ'
-    hdu4.header['EXTVER'] = 2
+    hdu4 = make_uvis_image_hdu(dq_array_chip2, 'DQ', 2, compression)
     
     #DQ arrays
     
-    hdulist = fits.HDUList([pri,hdu,hdu2,hdu3,hdu4])
-    hdulist.writeto(outfile_path,overwrite=overwrite) 
\ No newline at end of file
+    hdus = [pri,hdu,hdu2,hdu3,hdu4]
+    for name, arrays in (stats or {}).items():
+        for j, chip_array in enumerate(arrays):
+            hdus.append(make_uvis_image_hdu(chip_array, name.upper(), j+1, compression))
+    
+    hdulist = fits.HDUList(hdus)
+    hdulist.writeto(outfile_path,overwrite=overwrite)
+    record_write(os.path.getsize(outfile_path)) 
@@ -0,0 +1,152 @@
+import numpy as np
+import os
+from paths_and_params import paths
+
+""" Lookup of the UVIS anneal epoch that observations fall in. 
+
+	An observation belongs to the epoch of the first anneal at or after its MJD, and 
+	is sorted into a directory named after that anneal (as written in anneal_mjds.txt).
+	The anneal list is parsed once into a sorted array, and whole arrays of MJDs are 
+	assigned to their epoch with np.searchsorted.
+	
+"""
+
+ANNEAL_INFO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+_loaded_calendars = {}
+
+def get_anneal_file():
+
+    """Returns the anneal_mjds.txt that the pipeline uses: the one in 
+        paths()['anneal_info_dir'] (written by download_new_anneal_file), or the 
+        copy next to this module if that directory has none yet. Independent of 
+        the working directory."""
+        
+    anneal_file = os.path.join(paths()['anneal_info_dir'],'anneal_mjds.txt')
+    if os.path.isfile(anneal_file):
+        return anneal_file
+    return os.path.join(ANNEAL_INFO_DIR,'anneal_mjds.txt')
+
+def parse_anneal_file(anneal_file):
+
+    """Returns the list of anneal MJDs (strings) in anneal_file, which is either a 
+        list of MJDs (anneal_mjds.txt) or the table of anneal dates downloaded by 
+        download_new_anneal_file (anneal_dates.txt)."""
+        
+    anneal_mjds = []
+    with open(anneal_file,'r') as f:
+        lines = f.readlines()
+        
+    for line in lines:
+        line_split = line.split()
+        if len(line_split) == 0:
+            continue
+        if len(line_split) == 1 or 'anneal' in line_split[-1]:
+            try:
+                float(line_split[0])
+            except ValueError:
+                continue
+            anneal_mjds.append(line_split[0])
+            
+    return anneal_mjds
+    
+
+class AnnealCalendar(object):
+
+    """Sorted anneal dates, with lookup of the anneal epoch of observation MJDs.
+    
+        Parameters
+        ----------
+        
+        anneal_mjds: list of strings
+            Anneal dates in MJD, as written in anneal_mjds.txt. The strings are 
+            kept as the epoch labels used in directory names.
+            
+    """
+    
+    def __init__(self, anneal_mjds):
+    
+        mjds = np.array([float(mjd) for mjd in anneal_mjds], dtype = np.float64)
+        order = np.argsort(mjds, kind = 'stable')
+        self.mjds = mjds[order]
+        self.labels = np.array(anneal_mjds, dtype = object)[order]
+        
+    @classmethod
+    def load(cls, anneal_file = None):
+    
+        """Loads the calendar from anneal_file (default: get_anneal_file()).
+            
+            The parsed calendar is cached in memory, and on disk in 
+            paths()['anneal_info_dir'] (never next to the bundled anneal file), 
+            keyed by the path, modification time (in ns) and size of 
+            anneal_file, so it is parsed again whenever the file changes.
+        """
+        
+        if anneal_file is None:
+            anneal_file = get_anneal_file()
+        stat = os.stat(anneal_file)
+        mtime = '{}_{}'.format(stat.st_mtime_ns, stat.st_size)
+        
+        key = (os.path.abspath(anneal_file), mtime)
+        if key in _loaded_calendars:
+            return _loaded_calendars[key]
+            
+        cache_file = os.path.join(paths()['anneal_info_dir'],
+                                  os.path.basename(anneal_file) + '.npz')
+        calendar = None
+        if os.path.isfile(cache_file):
+            with np.load(cache_file) as cache:
+                if str(cache['mtime']) == mtime and str(cache['source']) == key[0]:
+                    calendar = cls([str(label) for label in cache['labels']])
+                    
+        if calendar is None:
+            calendar = cls(parse_anneal_file(anneal_file))
+            if os.path.isdir(paths()['anneal_info_dir']):
+                try:
+                    np.savez(cache_file, mtime = mtime, source = key[0],
+                             labels = calendar.labels.astype(str))
+                except (IOError, OSError):
+                    pass
+                
+        _loaded_calendars[key] = calendar
+        return calendar
+        
+    def epoch_index(self, mjds):
+    
+        """Returns, for each MJD in mjds, the index of the first anneal at or after 
+            it. Indices equal to the number of anneals mean the MJD is after the 
+            last anneal."""
+            
+        return np.searchsorted(self.mjds, np.asarray(mjds, dtype = np.float64),
+                               side = 'left')
+                               
+    def assign(self, mjds):
+    
+        """Returns the anneal epoch label for each MJD in mjds, or None for MJDs 
+            after the last anneal."""
+            
+        labels = np.append(self.labels, None)
+        return labels[self.epoch_index(mjds)]
+        
+    def nearest_anneal(self, mjd):
+    
+        """Anneal epoch label for a single MJD, or None."""
+        
+        return self.assign([mjd])[0]
+        
+    def epoch_bounds(self, label):
+    
+        """Returns (start, end) MJDs of the epoch ending at anneal `label`; 
+            observations in it have start < mjd <= end."""
+            
+        i = list(self.labels).index(label)
+        start = self.mjds[i-1] if i > 0 else -np.inf
+        return (start, self.mjds[i])
+        
+    def epochs_between(self, start_mjd, end_mjd):
+    
+        """Returns the labels of every epoch containing observations with 
+            start_mjd <= mjd <= end_mjd."""
+            
+        first, last = self.epoch_index([start_mjd, end_mjd])
+        return list(self.labels[first:min(last+1, len(self.labels))])
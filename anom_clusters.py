@@ -0,0 +1,225 @@
+from scipy import ndimage
+import glob
+import os
+import numpy as np
+from find_anom_pixels import get_percent_dev_images
+from instrumentation import instrumented
+
+""" Groups the low QE pixels found by find_anom_pixels into connected clusters 
+	(features), with the centroid, area, mean and minimum deviation and bounding box
+	of each, and matches clusters seen in different epochs to the same feature with
+	a grid spatial index.
+	
+	Clusters are labelled with scipy.ndimage, listed in requirements.txt.
+	
+"""
+
+CLUSTER_DTYPE = np.dtype([('chip','u1'), ('epoch','U32'), ('feature','i4'),
+                          ('yc','f4'), ('xc','f4'), ('area','i4'), 
+                          ('mean_dev','f4'), ('min_dev','f4'),
+                          ('y0','u2'), ('y1','u2'), ('x0','u2'), ('x1','u2')])
+
+def label_clusters(mask, dif_sci, chip, epoch, connectivity = 8):
+
+    """Labels the connected clusters of flagged pixels in one chip.
+    
+        Parameters
+        ----------
+        
+        mask: boolean array
+            Flagged pixels.
+            
+        dif_sci: array
+            Percent deviation image of the chip.
+            
+        chip: int
+            UVIS chip.
+            
+        epoch: string
+            Name of the epoch.
+            
+        connectivity: int
+            4 or 8, whether diagonal neighbours belong to the same cluster.
+            
+        Returns
+        -------
+        
+        clusters: structured array
+            One row per cluster with the fields of CLUSTER_DTYPE (feature is -1).
+            
+    """
+    
+    structure = ndimage.generate_binary_structure(2, 2 if connectivity == 8 else 1)
+    labels, n_clusters = ndimage.label(mask, structure = structure)
+    
+    clusters = np.zeros(n_clusters, dtype = CLUSTER_DTYPE)
+    if n_clusters == 0:
+        return clusters
+        
+    #per cluster sums of all flagged pixels in one pass each
+    flat_labels = labels[mask]
+    ys, xs = np.nonzero(mask)
+    devs = dif_sci[mask]
+    area = np.bincount(flat_labels, minlength = n_clusters+1)[1:]
+    
+    clusters['chip'] = chip
+    clusters['epoch'] = epoch
+    clusters['feature'] = -1
+    clusters['area'] = area
+    clusters['yc'] = np.bincount(flat_labels, weights = ys)[1:] / area
+    clusters['xc'] = np.bincount(flat_labels, weights = xs)[1:] / area
+    clusters['mean_dev'] = np.bincount(flat_labels, weights = devs)[1:] / area
+    clusters['min_dev'] = ndimage.minimum(dif_sci, labels, np.arange(1,n_clusters+1))
+    
+    slices = ndimage.find_objects(labels)
+    clusters['y0'] = [s[0].start for s in slices]
+    clusters['y1'] = [s[0].stop for s in slices]
+    clusters['x0'] = [s[1].start for s in slices]
+    clusters['x1'] = [s[1].stop for s in slices]
+    
+    return clusters
+    
+    
+def find_anom_clusters(epoch_mean_flat, ideal_median_flat, threshold, lower_bound,
+                       mask_DQ = False, mask_border = True, connectivity = 8):
+                       
+    """Finds the clusters of pixels with lower_bound < percent deviation < threshold
+        in an epoch mean flat, see find_anom_pixels and label_clusters."""
+        
+    dif_sci_arrays, epoch_sci_arrays = get_percent_dev_images(epoch_mean_flat,
+                                                              ideal_median_flat,
+                                                              mask_DQ = mask_DQ,
+                                                              mask_border = mask_border)
+                                                              
+    epoch = '_'.join(os.path.basename(epoch_mean_flat).replace('.fits','').split('_')[-2:])
+    
+    clusters = []
+    for j, dif_sci in enumerate(dif_sci_arrays):
+        with np.errstate(invalid = 'ignore'):
+            mask = (dif_sci < threshold) & (dif_sci > lower_bound)
+        clusters.append(label_clusters(mask, dif_sci, j+1, epoch,
+                                       connectivity = connectivity))
+                                       
+    return np.concatenate(clusters)
+    
+    
+class ClusterIndex(object):
+
+    """Grid spatial index of cluster bounding boxes. 
+    
+        Each cluster is stored in every grid cell its bounding box touches, so 
+        finding the clusters that overlap a box only looks at the clusters in the
+        cells under that box.
+        
+        Parameters
+        ----------
+        
+        cell_size: int
+            Size of the grid cells in pixels.
+            
+    """
+    
+    def __init__(self, cell_size = 64):
+    
+        self.cell_size = cell_size
+        self.cells = {}
+        self.boxes = []
+        
+    def get_cells(self, chip, y0, y1, x0, x1):
+    
+        c = self.cell_size
+        return [(chip, cy, cx) for cy in range(y0//c, (y1-1)//c + 1) \
+                for cx in range(x0//c, (x1-1)//c + 1)]
+                
+    def insert(self, chip, y0, y1, x0, x1, item):
+    
+        """Adds a box (y1, x1 exclusive) with an associated item, e.g. a feature 
+            id."""
+            
+        i = len(self.boxes)
+        self.boxes.append((chip, y0, y1, x0, x1, item))
+        for cell in self.get_cells(chip, y0, y1, x0, x1):
+            self.cells.setdefault(cell, []).append(i)
+            
+    def query(self, chip, y0, y1, x0, x1):
+    
+        """Returns the items of all boxes overlapping the box (y1, x1 exclusive)."""
+        
+        found = set()
+        for cell in self.get_cells(chip, max(y0,0), y1, max(x0,0), x1):
+            for i in self.cells.get(cell, []):
+                if i in found:
+                    continue
+                c, by0, by1, bx0, bx1, item = self.boxes[i]
+                if by0 < y1 and y0 < by1 and bx0 < x1 and x0 < bx1:
+                    found.add(i)
+        return [self.boxes[i][5] for i in sorted(found)]
+        
+        
+def match_features(clusters, match_radius = 2, cell_size = 64):
+
+    """Assigns a feature id to every cluster, in place. A cluster whose bounding 
+        box, grown by match_radius pixels, overlaps a cluster of an earlier row is 
+        given that cluster's feature, otherwise a new one. Clusters should be in 
+        date order.
+        
+        Returns
+        -------
+        
+        index: ClusterIndex
+            Index of the bounding boxes of all clusters, with feature ids as items.
+    """
+    
+    index = ClusterIndex(cell_size = cell_size)
+    n_features = 0
+    
+    for cluster in clusters:
+        box = (int(cluster['chip']), int(cluster['y0']) - match_radius,
+               int(cluster['y1']) + match_radius, int(cluster['x0']) - match_radius,
+               int(cluster['x1']) + match_radius)
+        features = index.query(*box)
+        if len(features) > 0:
+            cluster['feature'] = min(features)
+        else:
+            cluster['feature'] = n_features
+            n_features += 1
+        index.insert(int(cluster['chip']), int(cluster['y0']), int(cluster['y1']),
+                     int(cluster['x0']), int(cluster['x1']), int(cluster['feature']))
+                     
+    return index
+    
+    
+@instrumented()
+def main_cluster_anom_pixels(data_dir, threshold = -2.0, lower_bound = -10.0, 
+                             mask_border = True):
+                             
+    """Finds the low QE clusters of every epoch mean flat of each filter, matches
+        them across epochs and writes them to 
+        <filter>/results/<filter>_anom_clusters_<threshold>_<lower_bound>.npy."""
+        
+    for filter_dir in glob.glob(data_dir+'/*'):
+        filt = os.path.basename(filter_dir)
+        median_flats = glob.glob(filter_dir+'/*median_flat.fits')
+        if len(median_flats) == 0:
+            continue
+            
+        #in date order, so features are numbered by first appearance
+        epoch_mean_flats = sorted(glob.glob(filter_dir+'/*/*/*/mean_flat_*.fits'),
+                                  key = lambda f: os.path.basename(f).split('_')[-1])
+                                  
+        clusters = [find_anom_clusters(epoch_mean_flat, median_flats[0], threshold,
+                                       lower_bound, mask_DQ = True, 
+                                       mask_border = mask_border) \
+                    for epoch_mean_flat in epoch_mean_flats]
+        if len(clusters) == 0:
+            continue
+        clusters = np.concatenate(clusters)
+        match_features(clusters)
+        
+        output_dir = filter_dir+'/results/'
+        if not os.path.isdir(output_dir):
+            os.makedirs(output_dir)
+        output_path = output_dir+'{}_anom_clusters_{}_{}.npy'.format(filt,
+                      str(threshold),str(lower_bound))
+        print('writing out',output_path)
+        np.save(output_path, clusters)
@@ -0,0 +1,7 @@
+""" Benchmarks of the QE pixel monitor stages on synthetic UVIS FLT files.
+
+	Run from the top level of the repository with
+	
+		python -m benchmarks.bench_stages --n-files 10 50 150 500 --output bench.json
+		
+"""
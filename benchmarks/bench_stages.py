@@ -0,0 +1,295 @@
+import argparse
+import contextlib
+import datetime
+import glob
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+from astropy.io import fits
+from benchmarks.synthetic_flt import make_synthetic_flts, UVIS_CHIP_SHAPE
+from QE_pixel_tools import open_fits, make_avg_flat_array, write_full_frame_uvis_image
+from find_anom_pixels import find_anom_pixels, find_anom_pixels_multi
+from sort_new_data import main_sort_new_data
+
+""" Times the pipeline stages on synthetic FLT files, and reports the wall time, 
+	CPU time, throughput (frames/s) and peak RSS of each as JSON.
+	
+	Every stage runs in a freshly spawned process, so that its peak RSS is not 
+	inflated by earlier stages. Module imports are not included in the timings.
+	
+	write_temp_split_files is the quadrant split that make_filter_median_flat used 
+	before it combined files in sections; it is kept here as a reference timing.
+	
+"""
+
+def write_temp_split_files(ifiles):
+
+    """To avoid running out of memory, when trying to combine more than ~150 images,
+        create temporary files that split the full frame into pieces, combine them 
+        piecewise. This functionality assumes disk space is not limited so that temp
+        files can be all created at once, then deleted. 
+        
+        Each chip is split into quadrants for a total of 8 temporary files for each
+        full frame image. The DQ arrays are split up accordingly and written to the 
+        temporary files as well. 
+        
+        Parameters
+        ----------
+        ifiles: list of strings
+            List of paths to all files that should be split.
+            
+        Outputs
+        -------
+            For each file in ifiles, a temporary fits file that is a quarter segment of 
+            the full chip. Temporary files contain the science array and the DQ array. 
+            
+            The names of the output temporary files contain the rootname of the original 
+            file, the chip (1 or 2) and which quadrant (A,B,C,or D clockwise from the top 
+            left), and appended with '.temp'. For example - 'ic5y17f7q_chip1_D.temp' -
+            would be the bottom right quadrant of chip 1 for the full frame image in 
+            ic5y17f7q_flt.fits.
+            
+    """
+        
+    for fnumber, ifile in enumerate(ifiles):
+    
+        print(fnumber,'of',len(ifiles))
+        
+        sci_arrays, dq_arrays = open_fits(ifile,[1,2],DQ = True)
+        ch1, ch2 = sci_arrays[0],sci_arrays[1]
+        dq1,dq2 = dq_arrays[0],dq_arrays[1]
+        
+        #split each chip in 2 pieces
+        
+        sci_arrays = (ch1[0:1025,0:2048],ch1[0:1025,2048:],ch1[1025:,0:2048],
+                      ch1[1025:,2048:], ch2[0:1025,0:2048],ch2[0:1025,2048:],
+                      ch2[1025:,0:2048],ch2[1025:,2048:])
+                  
+        dq_arrays = (dq1[0:1025,0:2048],dq1[0:1025,2048:],dq1[1025:,0:2048],
+                     dq1[1025:,2048:], dq2[0:1025,0:2048],dq2[0:1025,2048:],
+                     dq2[1025:,0:2048],dq2[1025:,2048:])
+                  
+        
+        #write out temporary files
+        
+        sections = [('_chip{0}_{1}'.format(i,j),i) for i in ('1','2') \
+                    for j in ('A','B','C','D')]
+        
+        for i, ar in enumerate(sci_arrays):
+            temp_path = ifile.replace('_flt.fits','') + sections[i][0]+'.temp'
+            chip = int(sections[i][1])
+            
+            dq_ar = dq_arrays[i]
+            
+            #if not os.path.isfile(temp_path):
+            if True:
+                pri = fits.PrimaryHDU() #dummy primary extension
+                
+                hdu1 = fits.ImageHDU(ar)
+                hdu1.header['EXTNAME'] = 'SCI'
+                hdu1.header['EXTVER'] = int(chip)
+                
+                hdu2 = fits.ImageHDU(dq_ar)
+                hdu2.header['EXTNAME'] = 'DQ'
+                hdu2.header['EXTVER'] = int(chip)
+    
+                
+                hdulist = fits.HDUList([pri,hdu1,hdu2])
+                hdulist.writeto(temp_path,overwrite=True) 
+            else:
+                pass
+                
+
+def bench_open_fits(ifiles):
+    for ifile in ifiles:
+        open_fits(ifile,[1,2],DQ = True)
+        
+def bench_make_avg_flat_array(ifiles, avg_type):
+    make_avg_flat_array(ifiles,avg_type,[1,2],combine_dq_arrays = True)
+    
+def bench_write_temp_split_files(ifiles):
+    write_temp_split_files(ifiles)
+    
+def bench_find_anom_pixels(epoch_mean_flat, ideal_median_flat):
+    find_anom_pixels(epoch_mean_flat, ideal_median_flat, -1.0, -10.0)
+    
+def bench_find_anom_pixels_multi(epoch_mean_flat, ideal_median_flat):
+    bands = [(threshold, lower_bound) for threshold in [-1.0,-2.0,-3.0,-4.0,-5.0] \
+             for lower_bound in [-10.0,-7.0,-6.0]]
+    find_anom_pixels_multi(epoch_mean_flat, ideal_median_flat, bands)
+    
+def bench_sort_new_data(paths):
+    main_sort_new_data(paths)
+    
+def run_stage(func, args, queue):
+
+    """Runs func(*args) in a child process, puts (wall, cpu, peak rss, error) on
+        queue."""
+        
+    sys.stdout = open(os.devnull,'w')
+    error = None
+    start, cpu_start = time.perf_counter(), time.process_time()
+    try:
+        func(*args)
+    except Exception as e:
+        error = repr(e)
+    wall, cpu = time.perf_counter() - start, time.process_time() - cpu_start
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    queue.put((wall, cpu, peak_rss, error))
+    
+def time_stage(stage, n_files, func, args):
+
+    """Times one stage in a spawned process, returns its result record."""
+    
+    ctx = multiprocessing.get_context('spawn')
+    queue = ctx.Queue()
+    process = ctx.Process(target = run_stage, args = (func, args, queue))
+    process.start()
+    wall, cpu, peak_rss, error = queue.get()
+    process.join()
+    
+    result = {'stage': stage, 'n_files': n_files, 'wall_s': round(wall,4), 
+              'cpu_s': round(cpu,4), 'frames_per_s': round(n_files/wall,3),
+              'peak_rss_mb': round(peak_rss/2.**20,1)}
+    if error is not None:
+        result['error'] = error
+    print(json.dumps(result), file = sys.stderr)
+    return result
+    
+def setup_anom_flats(ifiles, workdir):
+
+    """Writes a median flat of all ifiles and a mean flat of the last of them (the
+        ones with low QE patches), named like the pipeline products."""
+        
+    filter_dir = os.path.join(workdir,'anom','F218W')
+    os.makedirs(os.path.join(filter_dir,'results'))
+    
+    median_flat = os.path.join(filter_dir,'F218W_median_flat.fits')
+    sci, dq = make_avg_flat_array(ifiles,'median',[1,2],combine_dq_arrays = True)
+    write_full_frame_uvis_image(sci[0],sci[1],dq[0],dq[1],median_flat)
+    
+    mean_flat = os.path.join(filter_dir,'mean_flat_F218W_57000.0_2016-01-01.fits')
+    sci, dq = make_avg_flat_array(ifiles[-max(len(ifiles)//4,1):],'mean',[1,2])
+    write_full_frame_uvis_image(sci[0],sci[1],dq[0],dq[1],mean_flat)
+    
+    return (mean_flat, median_flat)
+    
+def main_bench_stages(n_files_list, shape = UVIS_CHIP_SHAPE, workdir = None,
+                      stages = None):
+                      
+    """Generates synthetic FLTs and times each stage.
+    
+        Parameters
+        ----------
+        
+        n_files_list: list of ints
+            Numbers of files the combine stages are timed at.
+            
+        shape: tuple of ints
+            Shape of each chip of the synthetic files.
+            
+        workdir: string
+            Directory the synthetic files and products are written to.
+            
+        stages: list of strings
+            Stages to run, default all.
+            
+        Returns
+        -------
+        
+        report: dict
+            Run information and the list of stage results.
+            
+    """
+    
+    all_stages = ['open_fits','make_avg_flat_array','write_temp_split_files',
+                  'find_anom_pixels','main_sort_new_data']
+    if stages is None:
+        stages = all_stages
+        
+    n_files_list = sorted(n_files_list)
+    n_small = n_files_list[0]
+    
+    print('Writing {} synthetic FLTs to {}'.format(n_files_list[-1],workdir),
+          file = sys.stderr)
+    flt_dir = os.path.join(workdir,'flts')
+    ifiles = make_synthetic_flts(flt_dir, n_files_list[-1], shape = shape)
+    
+    results = []
+    
+    if 'open_fits' in stages:
+        for n in n_files_list:
+            results.append(time_stage('open_fits', n, bench_open_fits, (ifiles[:n],)))
+            
+    if 'make_avg_flat_array' in stages:
+        for avg_type in ('mean','median'):
+            for n in n_files_list:
+                results.append(time_stage('make_avg_flat_array_'+avg_type, n,
+                               bench_make_avg_flat_array, (ifiles[:n],avg_type)))
+                               
+    if 'write_temp_split_files' in stages:
+        results.append(time_stage('write_temp_split_files', n_small,
+                       bench_write_temp_split_files, (ifiles[:n_small],)))
+        for temp_file in glob.glob(os.path.join(flt_dir,'*.temp')):
+            os.remove(temp_file)
+            
+    if 'find_anom_pixels' in stages:
+        with contextlib.redirect_stdout(sys.stderr):
+            mean_flat, median_flat = setup_anom_flats(ifiles[:n_small], workdir)
+        results.append(time_stage('find_anom_pixels', 1, bench_find_anom_pixels,
+                       (mean_flat, median_flat)))
+        results.append(time_stage('find_anom_pixels_multi', 1, 
+                       bench_find_anom_pixels_multi, (mean_flat, median_flat)))
+                       
+    if 'main_sort_new_data' in stages:
+        new_data_dir = os.path.join(workdir,'new_data')
+        os.makedirs(new_data_dir)
+        for ifile in ifiles[:n_small]:
+            shutil.copy(ifile,new_data_dir)
+        #the index goes in data_dir/.header_index.db, see get_index_path
+        paths = {'new_data_dir': new_data_dir, 
+                 'data_dir': os.path.join(workdir,'data')}
+        results.append(time_stage('main_sort_new_data', n_small, bench_sort_new_data,
+                       (paths,)))
+                       
+    report = {'date': datetime.datetime.now().isoformat(), 'shape': list(shape),
+              'cpu_count': os.cpu_count(), 'results': results}
+    return report
+    
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description = 'Benchmark the QE pixel monitor '
+                                     'stages on synthetic UVIS FLT files.')
+    parser.add_argument('--n-files', type = int, nargs = '+', 
+                        default = [10,50,150,500])
+    parser.add_argument('--shape', type = int, nargs = 2, default = UVIS_CHIP_SHAPE,
+                        help = 'shape of each chip, default full frame')
+    parser.add_argument('--stages', nargs = '+', default = None)
+    parser.add_argument('--workdir', default = None,
+                        help = 'directory for the synthetic files (default: a '
+                        'temporary directory, removed afterwards)')
+    parser.add_argument('--output', default = None, help = 'JSON report path')
+    args = parser.parse_args()
+    
+    workdir = args.workdir
+    if workdir is None:
+        workdir = tempfile.mkdtemp(prefix = 'qe_bench_')
+        
+    try:
+        report = main_bench_stages(args.n_files, shape = tuple(args.shape), 
+                                   workdir = workdir, stages = args.stages)
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir)
+            
+    if args.output is None:
+        print(json.dumps(report, indent = 1))
+    else:
+        with open(args.output,'w') as f:
+            json.dump(report, f, indent = 1)
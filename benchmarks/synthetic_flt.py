@@ -0,0 +1,141 @@
+from astropy.io import fits
+import datetime
+import numpy as np
+import os
+
+""" Generates synthetic full frame UVIS FLT files: two SCI/DQ chips with the 
+	header keywords used by the pipeline (FILTER, PROPOSID, DATE-OBS), a smooth flat 
+	field with noise, random DQ flags, and patches of low QE pixels that appear after
+	a given date.
+	
+"""
+
+UVIS_CHIP_SHAPE = (2051,4096)
+
+def make_low_qe_patches(shape, n_patches, rng):
+
+    """Returns a list of (chip, yc, xc, radius, depth) low QE patches, where depth
+        is the fractional loss of QE."""
+        
+    patches = []
+    for i in range(n_patches):
+        patches.append((int(rng.integers(1,3)), int(rng.integers(10,shape[0]-10)),
+                        int(rng.integers(0,shape[1])), int(rng.integers(1,6)),
+                        float(rng.uniform(0.02,0.08))))
+    return patches
+    
+def make_flat_field(shape, rng, level = 20000.):
+
+    """Smooth flat field illumination with Poisson-like noise, float32."""
+    
+    y, x = np.mgrid[0:shape[0],0:shape[1]].astype(np.float32)
+    illumination = 1 - 0.05*((x/shape[1]-0.5)**2 + (y/shape[0]-0.5)**2)
+    sci = level * illumination
+    sci += rng.normal(0,np.sqrt(level),shape).astype(np.float32)
+    return sci.astype(np.float32)
+    
+def make_dq_array(shape, rng, fraction = 0.005):
+
+    """Random DQ flags (WFC3 bit values) on a fraction of the pixels."""
+    
+    dq = np.zeros(shape,dtype=np.int16)
+    flagged = rng.random(shape) < fraction
+    dq[flagged] = rng.choice([4,16,32,512,1024,4096],size=int(flagged.sum()))
+    return dq
+    
+def write_synthetic_flt(outfile_path, filt, prop_id, date_obs, rng, patches = [],
+                        shape = UVIS_CHIP_SHAPE):
+                        
+    """Writes one synthetic FLT file.
+    
+        Parameters
+        ----------
+        
+        outfile_path: string
+            Path of the output file, should end in _flt.fits.
+            
+        filt: string
+            FILTER keyword.
+            
+        prop_id: int
+            PROPOSID keyword.
+            
+        date_obs: string
+            DATE-OBS keyword (YYYY-MM-DD).
+            
+        rng: numpy.random.Generator
+            Random number generator.
+            
+        patches: list of tuples
+            Low QE patches (see make_low_qe_patches) to inject.
+            
+        shape: tuple of ints
+            Shape of each chip.
+            
+    """
+    
+    pri = fits.PrimaryHDU()
+    pri.header['ROOTNAME'] = os.path.basename(outfile_path).split('_')[0]
+    pri.header['INSTRUME'] = 'WFC3'
+    pri.header['DETECTOR'] = 'UVIS'
+    pri.header['FILTER'] = filt
+    pri.header['PROPOSID'] = prop_id
+    pri.header['DATE-OBS'] = date_obs
+    pri.header['TIME-OBS'] = '00:00:00'
+    
+    hdus = [pri]
+    for chip in (1,2):
+        sci = make_flat_field(shape, rng)
+        for patch_chip, yc, xc, radius, depth in patches:
+            if patch_chip == chip:
+                sci[max(yc-radius,0):yc+radius+1,max(xc-radius,0):xc+radius+1] *= 1-depth
+                
+        hdu = fits.ImageHDU(sci)
+        hdu.header['EXTNAME'] = 'SCI'
+        hdu.header['EXTVER'] = chip
+        
+        hdu2 = fits.ImageHDU(make_dq_array(shape, rng))
+        hdu2.header['EXTNAME'] = 'DQ'
+        hdu2.header['EXTVER'] = chip
+        hdus += [hdu,hdu2]
+        
+    fits.HDUList(hdus).writeto(outfile_path,overwrite=True)
+    
+def make_synthetic_flts(output_dir, n_files, filt = 'F218W', 
+                        prop_ids = [13169,13585,14027,14389,14546],
+                        start_date = '2013-01-15', end_date = '2017-06-01',
+                        n_patches = 50, shape = UVIS_CHIP_SHAPE, seed = 0):
+                        
+    """Writes n_files synthetic FLTs to output_dir, with DATE-OBS evenly spread 
+        between start_date and end_date. Low QE patches are injected in the files
+        taken in the second half of the date range.
+        
+        Returns
+        -------
+        
+        ifiles: list of strings
+            Paths to the files written.
+            
+    """
+    
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+        
+    rng = np.random.default_rng(seed)
+    patches = make_low_qe_patches(shape, n_patches, rng)
+    
+    start = datetime.datetime.strptime(start_date,'%Y-%m-%d').date()
+    end = datetime.datetime.strptime(end_date,'%Y-%m-%d').date()
+    days = np.linspace(0,(end-start).days,n_files).astype(int)
+    
+    ifiles = []
+    for i, day in enumerate(days):
+        date_obs = (start + datetime.timedelta(days=int(day))).isoformat()
+        prop_id = prop_ids[i*len(prop_ids)//n_files]
+        outfile_path = os.path.join(output_dir,'isyn{:05d}q_flt.fits'.format(i))
+        file_patches = patches if day > days[-1]/2 else []
+        write_synthetic_flt(outfile_path, filt, prop_id, date_obs, rng, 
+                            patches = file_patches, shape = shape)
+        ifiles.append(outfile_path)
+        
+    return ifiles
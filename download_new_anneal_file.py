@@ -1,15 +1,23 @@
+import os
 import requests
 from paths_and_params import paths
+from instrumentation import instrumented
 
-def download_updated_anneal_file(:
+""" Downloads the UVIS anneal dates and writes anneal_mjds.txt to 
+	paths()['anneal_info_dir'], where anneal_calendar.AnnealCalendar.load reads it.
+
+"""
+
+def download_updated_anneal_file(anneal_info_dir):
 	url = 'http://www.stsci.edu/hst/wfc3/ins_performance/monitoring/UVIS/anneal_dates-tab.txt'
 	r = requests.get(url, allow_redirects = True)
-	open('anneal_dates.txt','w').write(r.content)
-	print 'Downloaded updated anneal dates file.'
+	with open(os.path.join(anneal_info_dir,'anneal_dates.txt'),'w') as f:
+		f.write(r.text)
+	print('Downloaded updated anneal dates file.')
 
-def parse_updated_anneal_file():
+def parse_updated_anneal_file(anneal_info_dir):
 
-	anneal_file = 'anneal_dates.txt'
+	anneal_file = os.path.join(anneal_info_dir,'anneal_dates.txt')
 	
 	anneal_mjds = []
 	with open(anneal_file,'r') as f:
@@ -21,18 +29,29 @@ def parse_updated_anneal_file():
 					anneal_mjds.append(line_split[0])
 	return anneal_mjds
 	
-def write_mjd_to_file(anneal_mjds):
+def write_mjd_to_file(anneal_mjds, anneal_info_dir):
 
-	with open('anneal_mjds.txt','w') as f:
+	#written to a temporary file and renamed, so readers never see a partial list
+	anneal_file = os.path.join(anneal_info_dir,'anneal_mjds.txt')
+	with open(anneal_file+'.tmp','w') as f:
 		for mjd in anneal_mjds:
 			f.write(mjd+'\n')
+	os.rename(anneal_file+'.tmp',anneal_file)
+	
+	#the parsed calendar cache is keyed by the file's time and size, remove it anyway
+	if os.path.isfile(anneal_file+'.npz'):
+		os.remove(anneal_file+'.npz')
+	print('Wrote', len(anneal_mjds), 'anneal dates to', anneal_file)
 			
+@instrumented()
 def main_update_anneal_file(anneal_info_dir):
-	download_updated_anneal_file()
-	anneal_mjds = parse_updated_anneal_file()
-	write_mjd_to_file(anneal_mjds)
+	if not os.path.isdir(anneal_info_dir):
+		os.makedirs(anneal_info_dir)
+	download_updated_anneal_file(anneal_info_dir)
+	anneal_mjds = parse_updated_anneal_file(anneal_info_dir)
+	write_mjd_to_file(anneal_mjds, anneal_info_dir)
 	
 			
 if __name__ == '__main__':
 
-	main_update_anneal_file()	
+	main_update_anneal_file(paths()['anneal_info_dir'])	
@@ -0,0 +1,87 @@
+import numpy as np
+from paths_and_params import params
+
+""" Data quality (DQ) flags of WFC3/UVIS images.
+
+	DQ flags are bit fields stored as unsigned 16 bit integers. Older products of
+	the pipeline (and some FLT files) store them as int16, which holds the same
+	bits, so arrays are viewed as uint16 rather than converted (see as_dq).
+	
+	Which flags make a pixel bad is set by params()['dq_bad_bits']: a pixel is
+	masked if any of those bits is set. Bad pixel masks are boolean arrays, and
+	can be packed to one bit a pixel (pack_mask) to be kept or cached cheaply.
+	
+"""
+
+def as_dq(dq):
+
+    """Returns the DQ array dq as uint16, without copying int16 arrays."""
+    
+    dq = np.asarray(dq)
+    if dq.dtype == np.uint16:
+        return dq
+    if dq.dtype == np.int16:
+        return dq.view(np.uint16)
+    return dq.astype(np.uint16)
+    
+def or_dq(dq_union, dq):
+
+    """Adds the flags of dq to the uint16 array dq_union, in place."""
+    
+    np.bitwise_or(dq_union, as_dq(dq), out = dq_union)
+    
+def union_dq(dq_arrays, out = None, block_rows = 256):
+
+    """Returns the union (bitwise OR) of a list or stack of DQ arrays of the same
+        shape, as uint16.
+        
+        The arrays are reduced with np.bitwise_or.reduce block_rows rows at a
+        time, so a list of arrays is never stacked whole and the block being
+        reduced stays in cache.
+        
+    """
+    
+    dq_arrays = [as_dq(dq) for dq in dq_arrays]
+    if out is None:
+        out = np.zeros(dq_arrays[0].shape, dtype = np.uint16)
+        
+    for y0 in range(0, out.shape[0], block_rows):
+        y1 = min(y0 + block_rows, out.shape[0])
+        block = np.array([dq[y0:y1] for dq in dq_arrays])
+        np.bitwise_or.reduce(block, axis = 0, out = out[y0:y1])
+    return out
+    
+def get_bad_pixel_mask(dq, bad_bits = None, out = None):
+
+    """Returns a boolean array that is True where any of bad_bits (default
+        params()['dq_bad_bits']) is set in dq."""
+        
+    if bad_bits is None:
+        bad_bits = params()['dq_bad_bits']
+    dq = as_dq(dq)
+    if out is None:
+        out = np.empty(dq.shape, dtype = bool)
+        
+    #every bit bad: no need to AND first
+    if bad_bits & 0xFFFF == 0xFFFF:
+        return np.not_equal(dq, 0, out = out)
+    return np.not_equal(np.bitwise_and(dq, np.uint16(bad_bits & 0xFFFF)), 0, out = out)
+    
+def mask_bad_pixels(sci, mask):
+
+    """Sets the pixels of the float array sci where mask is True to NaN, in
+        place."""
+        
+    np.copyto(sci, np.nan, where = mask)
+    
+def pack_mask(mask):
+
+    """Packs a boolean mask to one bit a pixel along its last axis."""
+    
+    return np.packbits(mask, axis = -1)
+    
+def unpack_mask(packed, shape):
+
+    """Unpacks a mask packed with pack_mask to a boolean array of shape."""
+    
+    return np.unpackbits(packed, axis = -1, count = shape[-1]).view(bool)
@@ -1,137 +1,583 @@
-from astropy.io import fits
 import numpy as np
 import os
+import sys
 import glob
 from paths_and_params import *
 from QE_pixel_tools import *
-import pandas as pd
-from astropy.time import Time
+from task_pool import run_tasks, get_file_sizes
+from instrumentation import instrumented, record_write
+from dq_flags import get_bad_pixel_mask, mask_bad_pixels
+from pixel_history import get_history_dir, read_history_index, get_region_history, \
+                          rebuild_history, has_dq
 
 
-def find_anom_pixels(epoch_mean_flat, ideal_median_flat, threshold, lower_bound, 
-                     mask_DQ = False, mask_border = True):
-                     
+def get_percent_dev_images(epoch_mean_flat, ideal_median_flat, mask_DQ = False,
+                           mask_border = True):
+                           
     """
-    Identifies low QE pixels by comparing mean flat fields from each visit to a 
-    median 'ideal' flat field for each filter. 
+    Reads an epoch mean flat and the median 'ideal' flat for its filter, applies the
+    optional border / DQ masks, and returns the percent difference of the mean flat 
+    from the median flat for each chip.
     
-    Updates file that lists x,y pixel positions of identified low QE pixels,
-        their % deviation from the ideal flat, and counts on that pixel
+    Returns
+    -------
+    
+    dif_sci_arrays: list of arrays
+        Percent deviation images for (chip 1, chip 2).
+        
+    epoch_sci_arrays: list of arrays
+        Masked science arrays of the epoch mean flat for (chip 1, chip 2).
     """
 
-    #get data from fits files 
+    #get data from fits files. The masked median flat is shared by every epoch of
+    #the filter, so it is prepared once and cached (read-only)
     epoch_sci_arrays, epoch_dq_arrays = open_fits(epoch_mean_flat, [1,2], DQ = True)
-    median_sci_arrays, median_dq_arrays = open_fits(ideal_median_flat, [1,2], DQ = True)
+    median_sci_arrays = load_masked_flat(ideal_median_flat, [1,2], mask_DQ = mask_DQ,
+                                         mask_border = mask_border)
     
     sci_1_epoch, sci_2_epoch = epoch_sci_arrays[0],epoch_sci_arrays[1]
     dq_1_epoch, dq_2_epoch = epoch_dq_arrays[0],epoch_dq_arrays[1]
     
     sci_1_median,sci_2_median = median_sci_arrays[0],median_sci_arrays[1]
-    dq_1_median,dq_2_median = median_dq_arrays[0],median_dq_arrays[1]
 
     #optional, mask top and bottom 10 pixels in each chip
     if mask_border:
         sci_1_epoch[0:10], sci_1_epoch[-10:] = np.nan, np.nan
         sci_2_epoch[0:10], sci_2_epoch[-10:] = np.nan, np.nan
-        sci_1_median[0:10], sci_1_median[-10:] = np.nan, np.nan
-        sci_2_median[0:10], sci_2_median[-10:] = np.nan, np.nan
-        if mask_DQ:
-            dq_1_epoch[0:10], dq_1_epoch[-10:] = np.nan, np.nan
-            dq_2_epoch[0:10], dq_2_epoch[-10:] = np.nan, np.nan
-            dq_1_median[0:10], dq_1_median[-10:] = np.nan, np.nan
-            dq_2_median[0:10], dq_2_median[-10:] = np.nan, np.nan
             
     #optional, mask science arrays with DQ arrays 
     if mask_DQ:
-        sci_1_epoch[dq_1_epoch != 0] = np.nan
-        sci_2_epoch[dq_2_epoch != 0] = np.nan
-        sci_1_median[dq_1_median != 0] = np.nan
-        sci_2_epoch[dq_2_epoch != 0] = np.nan
+        mask_bad_pixels(sci_1_epoch, get_bad_pixel_mask(dq_1_epoch))
+        mask_bad_pixels(sci_2_epoch, get_bad_pixel_mask(dq_2_epoch))
         
     #find percent difference from median flat 
     dif_sci_1 = ((sci_1_epoch-sci_1_median)/sci_1_median)*100
     dif_sci_2 = ((sci_2_epoch-sci_2_median)/sci_2_median)*100
     
-    #find locations and values of anom. pixels
-    locs_lowQE_sci1 = np.where((dif_sci_1<threshold) & (dif_sci_1>lower_bound))
-    locs_lowQE_sci2 = np.where((dif_sci_2<threshold) & (dif_sci_2>lower_bound))
-    #zip coords together
-    coords_sci1 = np.column_stack(locs_lowQE_sci1)
-    coords_sci2 = np.column_stack(locs_lowQE_sci2)
+    return ([dif_sci_1,dif_sci_2],[sci_1_epoch,sci_2_epoch])
+    
+    
+def check_significance_params():
+
+    """Raises a ValueError if params()['anom_min_significance'] is set but the 
+        median flats are not made with a MAD extension, which the significance is
+        computed from (see get_significance_images)."""
+        
+    if params()['anom_min_significance'] is not None and \
+       'mad' not in params()['median_flat_stats']:
+        raise ValueError("params()['anom_min_significance'] is set, which needs "
+                         "'mad' in params()['median_flat_stats'].")
+                         
+def get_significance_images(epoch_sci_arrays, ideal_median_flat, mask_DQ = False,
+                            mask_border = True):
+                            
+    """
+    Returns the deviation of the (masked) epoch mean flat from the median flat for
+    each chip in units of sigma = 1.4826 * MAD of the inputs of the median flat, 
+    read from its MAD extensions (see params()['median_flat_stats']), so the 
+    scatter of each pixel does not have to be computed again. Pixels with a MAD
+    of 0 have an infinite (or NaN) significance.
+    """
+    
+    median_sci_arrays = load_masked_flat(ideal_median_flat, [1,2], mask_DQ = mask_DQ,
+                                         mask_border = mask_border)
+    
+    sig_arrays = []
+    for j, chip in enumerate([1,2]):
+        try:
+            sigma = 1.4826 * load_chip(ideal_median_flat, chip, 'MAD')
+        except KeyError:
+            raise ValueError("{} has no MAD extension: add 'mad' to "
+                             "params()['median_flat_stats'] and make the median flat "
+                             "again.".format(ideal_median_flat))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            sig_arrays.append((epoch_sci_arrays[j] - median_sci_arrays[j]) / sigma)
         
-    percent_dev_lowQE_sci1 = dif_sci_1[locs_lowQE_sci1]
-    flux_lowQE_sci1=sci_1_epoch[locs_lowQE_sci1]
-    percent_dev_lowQE_sci2 = dif_sci_2[locs_lowQE_sci2]
-    flux_lowQE_sci2=sci_2_epoch[locs_lowQE_sci2]
+    return sig_arrays
+    
+    
+def get_band_pixel_locs(dif_sci, bands):
+
+    """
+    Finds the pixels with lower_bound < dif_sci < threshold for every 
+    (threshold, lower_bound) pair in bands, in a single pass over the image.
+    
+    Pixels that fall in the widest band are selected once and sorted by deviation,
+    then the pixels of each band are a contiguous slice of the sorted deviations
+    found with np.searchsorted.
+    
+    Parameters
+    ----------
+    
+    dif_sci: array
+        Percent deviation image of one chip.
+        
+    bands: list of tuples
+        (threshold, lower_bound) pairs.
+        
+    Returns
+    -------
+    
+    band_locs: list of tuples of arrays
+        For each band, the (y, x) locations of its pixels in the same (row-major) 
+        order as np.where.
+    """
+    
+    thresholds = [band[0] for band in bands]
+    lower_bounds = [band[1] for band in bands]
+    
+    flat_dif = dif_sci.ravel()
+    with np.errstate(invalid = 'ignore'):
+        candidates = np.flatnonzero((flat_dif < max(thresholds)) & \
+                                    (flat_dif > min(lower_bounds)))
+    
+    order = np.argsort(flat_dif[candidates], kind = 'stable')
+    sorted_devs = flat_dif[candidates][order]
+    
+    band_locs = []
+    for threshold, lower_bound in bands:
+        lo = np.searchsorted(sorted_devs, lower_bound, side = 'right')
+        hi = np.searchsorted(sorted_devs, threshold, side = 'left')
+        locs = np.sort(candidates[order[lo:max(lo,hi)]])
+        band_locs.append(np.unravel_index(locs, dif_sci.shape))
+        
+    return band_locs
+    
+    
+ANOM_DTYPE = np.dtype([('anneal_mjd','f8'), ('date_obs','S10'), ('threshold','f4'),
+                       ('lower_bound','f4'), ('chip','u1'), ('y','u2'), ('x','u2'),
+                       ('percent_dev','f4'), ('counts','f4')])
+
+def get_epoch_info(epoch_mean_flat):
+
+    """Returns (anneal_date, date_obs) from the name of an epoch mean flat."""
     
     #get date info from file path       
     split_path = epoch_mean_flat.split('/')[-1]
     split_path = split_path.replace('.fits','')
     split_path = split_path.split('_')
     
-    anneal_date = split_path[-2]
-    date_obs = split_path[-1]
+    return (split_path[-2], split_path[-1])
+    
+    
+def get_output_path(epoch_mean_flat, ideal_median_flat, threshold, lower_bound):
+
+    """Returns the path of the .dat file for an epoch mean flat and threshold."""
+
+    anneal_date, date_obs = get_epoch_info(epoch_mean_flat)
         
     output_dir = ideal_median_flat.replace(os.path.basename(ideal_median_flat),'results/')
     filt = output_dir.split('/')[-3]
     output_path = output_dir+'combined_masked_{}_{}_{}_{}_{}.dat'.format(filt,str(anneal_date),str(date_obs),str(threshold),str(lower_bound))
     
-    #write out data file
-    with open(output_path,'w') as f:
-        print 'writing out',output_path
-        f.write('#chip,xc,yc,percent_dev,counts\n')
-        for i,coords in enumerate(coords_sci1):
-            f.write('{},{},{},{},{}\n'.format('1',coords[0],coords[1],\
-            percent_dev_lowQE_sci1[i],flux_lowQE_sci1[i]))
-        for i,coords in enumerate(coords_sci2):
-            f.write('{},{},{},{},{}\n'.format('2',coords[0],coords[1],\
-            percent_dev_lowQE_sci2[i],flux_lowQE_sci2[i]))
-
-
-    """#write out mask
-    chip_1_mask = np.zeros(sci_1_epoch.shape)
-    chip_1_mask[locs_lowQE_sci1] = 1
-    chip_2_mask = np.zeros(sci_2_epoch.shape)
-    chip_2_mask[locs_lowQE_sci2] = 1
-    outfile_path = output_dir + 'combined_masked_{}_{}_{}_{}_{}_QE_pixel_mask.fits'.format(filt,anneal_date,date_obs,str(threshold),str(lower_bound))
-    
-    print 'writing out',outfile_path
-    write_full_frame_uvis_image(chip_1_mask, chip_2_mask, dq_1_epoch,
-                                dq_2_epoch, outfile_path, overwrite=True)"""
+    return output_path
+    
+    
+def get_table_part_path(epoch_mean_flat, ideal_median_flat):
+
+    """Returns the path of the table of anomalous pixels of one epoch mean flat,
+        named after its proposal, anneal date and visit date."""
+        
+    output_dir = ideal_median_flat.replace(os.path.basename(ideal_median_flat),'results/')
+    epoch = '_'.join(epoch_mean_flat.split('/')[-4:-1])
+    return output_dir+'anom_pixels_parts/{}.npy'.format(epoch)
+    
+    
+def combine_anom_table(filter_dir):
+
+    """Combines the tables of every epoch of a filter into 
+        <filter>/results/<filter>_anom_pixels.npy, and returns its path. Tables 
+        of epochs that no longer have a mean flat (e.g. a visit that was removed 
+        or re-sorted to another anneal epoch) are deleted first, so they do not
+        end up in the table."""
+        
+    filt = os.path.basename(filter_dir.rstrip('/'))
+    parts = sorted(glob.glob(filter_dir+'/results/anom_pixels_parts/*.npy'))
+    
+    #names of the parts the current epoch mean flats produce, see get_table_part_path
+    epochs = set(['_'.join(mean_flat.split('/')[-4:-1]) for mean_flat in \
+                  glob.glob(filter_dir+'/*/*/*/mean_flat_*.fits')])
+    for part in parts:
+        if os.path.basename(part)[:-len('.npy')] not in epochs:
+            print('removing stale',part)
+            os.remove(part)
+    parts = [part for part in parts if os.path.isfile(part)]
+    table = np.concatenate([np.load(part) for part in parts]) if len(parts) > 0 \
+            else np.zeros(0, dtype = ANOM_DTYPE)
+            
+    table_path = filter_dir+'/results/{}_anom_pixels.npy'.format(filt)
+    print('writing out',table_path)
+    np.save(table_path, table)
+    record_write(os.path.getsize(table_path))
+    return table_path
+    
+    
+def load_anom_table(table_path, date_obs = None, anneal_mjd = None, chip = None,
+                    region = None, threshold = None, lower_bound = None):
+                    
+    """
+    Loads the anomalous pixels table of a filter (see combine_anom_table), keeping
+    only the rows that match the given selections. Selections left as None are not
+    applied.
+    
+    Parameters
+    ----------
+    
+    table_path: string
+        Path to <filter>_anom_pixels.npy.
+        
+    date_obs: string or list of strings
+        Visit date(s), YYYY-MM-DD.
+        
+    anneal_mjd: float or list of floats
+        Anneal epoch(s).
+        
+    chip: int
+        UVIS chip.
+        
+    region: tuple of ints
+        (y0, y1, x0, x1) pixel region, end exclusive. y and x are the 'xc' and 'yc'
+        columns of the .dat files.
+        
+    threshold, lower_bound: float
+        Band of the rows.
+        
+    Returns
+    -------
+    
+    table: structured array
+        Selected rows, with the fields of ANOM_DTYPE.
+    """
+    
+    table = np.load(table_path, mmap_mode = 'r')
+    keep = np.ones(len(table), dtype = bool)
+    
+    if date_obs is not None:
+        keep &= np.isin(table['date_obs'], np.atleast_1d(date_obs).astype('S10'))
+    if anneal_mjd is not None:
+        keep &= np.isin(table['anneal_mjd'], np.atleast_1d(anneal_mjd).astype(float))
+    if chip is not None:
+        keep &= table['chip'] == chip
+    if region is not None:
+        y0, y1, x0, x1 = region
+        keep &= (table['y'] >= y0) & (table['y'] < y1) & \
+                (table['x'] >= x0) & (table['x'] < x1)
+    if threshold is not None:
+        keep &= table['threshold'] == np.float32(threshold)
+    if lower_bound is not None:
+        keep &= table['lower_bound'] == np.float32(lower_bound)
+        
+    return np.array(table[keep])
+    
+    
+@instrumented(name='anom_pixels', tag_args=('epoch_mean_flat','bands'))
+def find_anom_pixels_multi(epoch_mean_flat, ideal_median_flat, bands, mask_DQ = False,
+                           mask_border = True):
+                           
+    """
+    Identifies low QE pixels by comparing mean flat fields from each visit to a 
+    median 'ideal' flat field for each filter, for several thresholds at once. 
+    
+    The flats are read and the deviation images computed once, and the pixels 
+    for every (threshold, lower_bound) pair in bands are found in one pass. If 
+    params()['anom_min_significance'] is set, pixels whose deviation is less 
+    significant than that (see get_significance_images) are left out of every 
+    band.
+    
+    Depending on params()['anom_output'], writes the same .dat file for each pair
+    as find_anom_pixels ('dat'), a binary table of the pixels of every pair
+    (results/anom_pixels_parts/, 'table'), or both ('both'). 
+    """
+    
+    dif_sci_arrays, epoch_sci_arrays = get_percent_dev_images(epoch_mean_flat,
+                                                              ideal_median_flat,
+                                                              mask_DQ = mask_DQ,
+                                                              mask_border = mask_border)
+    dif_sci_1, dif_sci_2 = dif_sci_arrays[0], dif_sci_arrays[1]
+    sci_1_epoch, sci_2_epoch = epoch_sci_arrays[0], epoch_sci_arrays[1]
+    
+    #NaN pixels are in no band
+    min_significance = params()['anom_min_significance']
+    if min_significance is not None:
+        sig_arrays = get_significance_images(epoch_sci_arrays, ideal_median_flat,
+                                             mask_DQ = mask_DQ, mask_border = mask_border)
+        for dif_sci, sig in zip(dif_sci_arrays, sig_arrays):
+            dif_sci[~(np.abs(sig) >= min_significance)] = np.nan
+    
+    band_locs_sci1 = get_band_pixel_locs(dif_sci_1, bands)
+    band_locs_sci2 = get_band_pixel_locs(dif_sci_2, bands)
+    
+    output_format = params()['anom_output']
+    anneal_date, date_obs = get_epoch_info(epoch_mean_flat)
+    rows = []
+    
+    for b, (threshold, lower_bound) in enumerate(bands):
+        locs_lowQE_sci1 = band_locs_sci1[b]
+        locs_lowQE_sci2 = band_locs_sci2[b]
+        
+        if output_format in ('table','both'):
+            for chip, locs, dif_sci, sci_epoch in ((1,locs_lowQE_sci1,dif_sci_1,sci_1_epoch),
+                                                   (2,locs_lowQE_sci2,dif_sci_2,sci_2_epoch)):
+                band_rows = np.zeros(len(locs[0]), dtype = ANOM_DTYPE)
+                band_rows['anneal_mjd'] = float(anneal_date)
+                band_rows['date_obs'] = date_obs
+                band_rows['threshold'] = threshold
+                band_rows['lower_bound'] = lower_bound
+                band_rows['chip'] = chip
+                band_rows['y'], band_rows['x'] = locs
+                band_rows['percent_dev'] = dif_sci[locs]
+                band_rows['counts'] = sci_epoch[locs]
+                rows.append(band_rows)
+                
+        if output_format not in ('dat','both'):
+            continue
+            
+        #zip coords together
+        coords_sci1 = np.column_stack(locs_lowQE_sci1)
+        coords_sci2 = np.column_stack(locs_lowQE_sci2)
+            
+        percent_dev_lowQE_sci1 = dif_sci_1[locs_lowQE_sci1]
+        flux_lowQE_sci1=sci_1_epoch[locs_lowQE_sci1]
+        percent_dev_lowQE_sci2 = dif_sci_2[locs_lowQE_sci2]
+        flux_lowQE_sci2=sci_2_epoch[locs_lowQE_sci2]
+        
+        output_path = get_output_path(epoch_mean_flat, ideal_median_flat, threshold,
+                                      lower_bound)
+        output_dir = os.path.dirname(output_path)
+        if not os.path.isdir(output_dir):
+            os.makedirs(output_dir)
+        
+        #write out data file
+        with open(output_path,'w') as f:
+            print('writing out',output_path)
+            f.write('#chip,xc,yc,percent_dev,counts\n')
+            for i,coords in enumerate(coords_sci1):
+                f.write('{},{},{},{},{}\n'.format('1',coords[0],coords[1],\
+                percent_dev_lowQE_sci1[i],flux_lowQE_sci1[i]))
+            for i,coords in enumerate(coords_sci2):
+                f.write('{},{},{},{},{}\n'.format('2',coords[0],coords[1],\
+                percent_dev_lowQE_sci2[i],flux_lowQE_sci2[i]))
+        record_write(os.path.getsize(output_path))
+        
+    if output_format in ('table','both'):
+        part_path = get_table_part_path(epoch_mean_flat, ideal_median_flat)
+        if not os.path.isdir(os.path.dirname(part_path)):
+            os.makedirs(os.path.dirname(part_path))
+        print('writing out',part_path)
+        np.save(part_path, np.concatenate(rows))
+        record_write(os.path.getsize(part_path))
+                
+
+def find_anom_pixels(epoch_mean_flat, ideal_median_flat, threshold, lower_bound, 
+                     mask_DQ = False, mask_border = True):
+                     
+    """
+    Identifies low QE pixels by comparing mean flat fields from each visit to a 
+    median 'ideal' flat field for each filter. 
+    
+    Updates file that lists x,y pixel positions of identified low QE pixels,
+        their % deviation from the ideal flat, and counts on that pixel
+    """
+    
+    find_anom_pixels_multi(epoch_mean_flat, ideal_median_flat, 
+                           [(threshold, lower_bound)], mask_DQ = mask_DQ,
+                           mask_border = mask_border)
                                 
             
-def main_find_anom_pixels(data_dir,mask_DQ = False, mask_border = True):
+#percent deviation bands searched for low QE pixels
+THRESHOLDS = [-1.0,-2.0,-3.0,-4.0,-5.0]
+LOWER_BOUNDS = [-10.0,-7.0,-6.0]
+
+def get_bands():
+
+    """Returns the (threshold, lower_bound) pairs searched by main_find_anom_pixels."""
+    
+    return [(threshold, lower_bound) for threshold in THRESHOLDS \
+            for lower_bound in LOWER_BOUNDS]
+            
+            
+@instrumented()
+def main_find_anom_pixels(data_dir,mask_DQ = False, mask_border = True, workers = 1):
 
     filter_dirs = glob.glob(data_dir+'/*')
     filters = [os.path.basename(item) for item in filter_dirs]
     
-    anneal_date_dirs = glob.glob(data_dir+'/*/*')
-    anneal_dates = [os.path.basename(item) for item in anneal_date_dirs]
-    
-    visit_date_dirs = glob.glob(data_dir+'/*/*') 
+    check_significance_params()
+    bands = get_bands()
+    print('thresholds:',THRESHOLDS)
+    print('lower bounds:',LOWER_BOUNDS)
     
+    tasks = []
     for i,filter_dir in enumerate(filter_dirs):
     
-        ideal_median_flat = glob.glob(filter_dir+'/*combined*median*')[0]
+        median_flats = glob.glob(filter_dir+'/*median_flat.fits')
+        if len(median_flats) == 0:
+            print('No median flat for', filters[i], ', skipping.')
+            continue
+        ideal_median_flat = median_flats[0]
 
-        epoch_mean_flats=glob.glob(data_dir+'/{}/*/*/*combined*mean*'.format(filters[i]))
+        epoch_mean_flats=glob.glob(data_dir+'/{}/*/*/*/mean_flat_*.fits'.format(filters[i]))
         
-        thresholds = [-1.0,-2.0,-3.0,-4.0,-5.0]
-        lower_bounds = [-10.0,-7.0,-6.0]
         for epoch_mean_flat in epoch_mean_flats:
-            for threshold in thresholds:
-                for lower_bound in lower_bounds:
-                    print 'threshold:',threshold
-                    print 'lower bound:',lower_bound
+            tasks.append(('anomalous pixels '+epoch_mean_flat, 
+                          get_file_sizes([epoch_mean_flat]), find_anom_pixels_multi,
+                          (epoch_mean_flat, ideal_median_flat, bands, True, mask_border)))
+                          
+    failed = run_tasks(tasks, workers = workers, max_memory = params()['max_memory'])
+    
+    #one table per filter, from the tables of all its epochs
+    if params()['anom_output'] in ('table','both'):
+        for filter_dir in filter_dirs:
+            if os.path.isdir(filter_dir+'/results/anom_pixels_parts'):
+                combine_anom_table(filter_dir)
+                
+    return failed
+
+def find_anom_pixels_stack(filter_dir, bands, mask_DQ = False, mask_border = True, 
+                           strip_height = 64):
+
+    """
+    Compares every epoch mean flat of a filter to the median 'ideal' flat at once, 
+    and finds, for every pixel, when it first went bad and for how many epochs.
+    
+    The epoch mean flats are read from the pixel history store of the filter (built
+    from the mean flats if it does not exist), one strip of rows at a time, and the
+    deviation of all epochs from the median flat is computed in one broadcasted 
+    operation per strip. Pixels are masked as in find_anom_pixels_multi: with 
+    mask_DQ, pixels flagged in the DQ array of the median flat or of an epoch mean
+    flat (params()['dq_bad_bits']) are in no band for that epoch. The DQ flags of
+    the epochs are read from the store with the science values; a store made 
+    without them is rebuilt first.
+    
+    Parameters
+    ----------
+    
+    filter_dir: string
+        Directory of the filter, containing its median flat.
+        
+    bands: list of tuples
+        (threshold, lower_bound) pairs, as in find_anom_pixels_multi.
+        
+    mask_DQ: bool
+        Mask the pixels flagged in the DQ arrays of the flats.
+        
+    mask_border: bool
+        Mask the top and bottom 10 rows of each chip.
+        
+    strip_height: int
+        Rows processed at a time, peak memory is about 
+        13 bytes * n_epochs * strip_height * ncolumns, 16 bytes with mask_DQ.
+        
+    Returns
+    -------
+    
+    epochs: list of dicts
+        Epochs (visits) in date order, as stored in the pixel history.
+        
+    first_epoch: list of arrays
+        For each chip, an int16 array (n_bands, ny, nx) of the index in epochs of 
+        the first epoch the pixel is in each band, -1 if never.
         
-                    find_anom_pixels(epoch_mean_flat, ideal_median_flat, threshold, lower_bound, \
-                    mask_DQ = True, mask_border = mask_border)
+    n_flagged: list of arrays
+        For each chip, an int16 array (n_bands, ny, nx) of the number of epochs 
+        the pixel is in each band.
+        
+    min_dev: list of arrays
+        For each chip, a float32 array (ny, nx) of the lowest percent deviation 
+        of the pixel over all epochs.
+    """
+    
+    store_dir = get_history_dir(filter_dir)
+    if read_history_index(store_dir) is None or (mask_DQ and not has_dq(store_dir)):
+        rebuild_history(filter_dir)
+    index = read_history_index(store_dir)
+    ny, nx = index['chip_shape']
+    
+    ideal_median_flat = glob.glob(filter_dir+'/*median_flat.fits')[0]
+    median_sci_arrays = load_masked_flat(ideal_median_flat, index['chips'], 
+                                         mask_DQ = mask_DQ, mask_border = mask_border)
+                                         
+    first_epoch, n_flagged, min_dev = [], [], []
+    
+    for j, chip in enumerate(index['chips']):
+        sci_median = median_sci_arrays[j].astype(np.float32)
+        
+        first_epoch_chip = np.full((len(bands),ny,nx), -1, dtype=np.int16)
+        n_flagged_chip = np.zeros((len(bands),ny,nx), dtype=np.int16)
+        min_dev_chip = np.full((ny,nx), np.nan, dtype=np.float32)
+        
+        for y0 in range(0,ny,strip_height):
+            y1 = min(y0+strip_height,ny)
+            if mask_DQ:
+                epochs, history, dq_history = get_region_history(store_dir, chip, y0, y1,
+                                                                 0, nx, dq = True)
+                mask_bad_pixels(history, get_bad_pixel_mask(dq_history))
+                del dq_history
+            else:
+                epochs, history = get_region_history(store_dir, chip, y0, y1, 0, nx)
+            
+            #percent difference of every epoch from the median flat
+            median_strip = sci_median[np.newaxis,y0:y1]
+            history -= median_strip
+            history /= median_strip
+            history *= 100
+            
+            if len(epochs) > 0:
+                min_dev_chip[y0:y1] = np.fmin.reduce(history, axis=0)
+                
+            with np.errstate(invalid = 'ignore'):
+                for b, (threshold, lower_bound) in enumerate(bands):
+                    flagged = (history < threshold) & (history > lower_bound)
+                    n_flagged_chip[b,y0:y1] = flagged.sum(axis=0)
+                    first = flagged.argmax(axis=0)
+                    first_epoch_chip[b,y0:y1] = np.where(n_flagged_chip[b,y0:y1] > 0,
+                                                         first, -1)
+                                                         
+        first_epoch.append(first_epoch_chip)
+        n_flagged.append(n_flagged_chip)
+        min_dev.append(min_dev_chip)
+        
+    return (epochs, first_epoch, n_flagged, min_dev)
+    
+    
+@instrumented()
+def main_find_anom_pixels_stack(data_dir, mask_DQ = True, mask_border = True):
+
+    """Runs find_anom_pixels_stack for every filter, with the bands and DQ masking
+        of main_find_anom_pixels, and saves the results to 
+        <filter>/results/<filter>_anom_pixels_history.npz."""
+        
+    bands = get_bands()
+    
+    for filter_dir in glob.glob(data_dir+'/*'):
+        filt = os.path.basename(filter_dir)
+        if len(glob.glob(filter_dir+'/*median_flat.fits')) == 0:
+            print('No median flat for', filt, ', skipping.')
+            continue
+            
+        epochs, first_epoch, n_flagged, min_dev = find_anom_pixels_stack(filter_dir,
+                                                  bands, mask_DQ = mask_DQ,
+                                                  mask_border = mask_border)
+                                                  
+        output_dir = filter_dir+'/results/'
+        if not os.path.isdir(output_dir):
+            os.makedirs(output_dir)
+        output_path = output_dir+'{}_anom_pixels_history.npz'.format(filt)
+        print('writing out',output_path)
+        np.savez(output_path, bands = np.array(bands), 
+                 epochs = np.array([epoch['key'] for epoch in epochs]),
+                 first_epoch_1 = first_epoch[0], first_epoch_2 = first_epoch[1],
+                 n_flagged_1 = n_flagged[0], n_flagged_2 = n_flagged[1],
+                 min_dev_1 = min_dev[0], min_dev_2 = min_dev[1])
+                 
 
 if __name__ == '__main__':
 
     data_dir = paths()['data_dir']
     
-    main_find_anom_pixels(data_dir,mask_DQ = False, mask_border = True)
+    failed = main_find_anom_pixels(data_dir,mask_DQ = False, mask_border = True)
+    if len(failed) > 0:
+        sys.exit(1)
     
 
     
@@ -0,0 +1,165 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from astropy.io import fits
+import numpy as np
+from paths_and_params import params
+from instrumentation import record_read, record_stall
+
+""" Reads the SCI (and DQ) arrays of a sequence of FITS files ahead of the code
+	using them, so that reading from disk overlaps with combining.
+	
+	Background threads read the next `depth` files (or strips of files) into a ring
+	of depth + 1 buffer slots that are reused for the whole sequence, so reading
+	does not allocate new arrays once the ring is filled. The time the consumer
+	spends waiting for data (stall time) shows whether the read-ahead hides the
+	latency of the storage.
+	
+"""
+
+class PrefetchReader(object):
+
+    """Iterates over FITS files, reading ahead on background threads.
+    
+        Iterating yields (ifile, rows, sci_arrays, dq_arrays) for each item, in
+        order, like open_fits / open_fits_section with DQ = True (dq_arrays is
+        empty if DQ = False). The arrays are views into the buffer ring and are
+        only valid until the next item is requested, so they must be copied (or
+        combined) before that.
+        
+        Parameters
+        ----------
+        
+        items: list
+            Paths of the files to read, or (path, (first row, last row + 1))
+            tuples to read only a strip of the chips.
+            
+        chips: list of ints
+            List of UVIS chips.
+            
+        DQ: bool
+            If True, the DQ arrays are read as well.
+            
+        depth: int
+            Number of items read ahead. 0 reads each item when it is requested,
+            without threads. Default params()['read_ahead'].
+            
+        threads: int
+            Number of reading threads, default min(depth, params()['io_threads']).
+            
+        Attributes
+        ----------
+        
+        stats: dict
+            n_reads, bytes_read, read_s (time spent reading, summed over the
+            threads), stall_s (time the consumer waited for data) and depth.
+            
+    """
+    
+    def __init__(self, items, chips, DQ = False, depth = None, threads = None):
+    
+        if depth is None:
+            depth = params()['read_ahead']
+        if threads is None:
+            threads = min(depth, params()['io_threads'])
+            
+        self.items = [item if isinstance(item, tuple) else (item, None) \
+                      for item in items]
+        self.chips = chips
+        self.DQ = DQ
+        self.depth = max(int(depth), 0)
+        self.threads = max(int(threads), 1)
+        self.slots = [[] for i in range(self.depth + 1)]
+        self.stats = {'n_reads': 0, 'bytes_read': 0, 'read_s': 0., 'stall_s': 0.,
+                      'depth': self.depth}
+        self._lock = threading.Lock()
+        
+    def get_buffer(self, slot, k, shape, dtype):
+    
+        """Returns the k-th array of a slot with the given shape, reusing the
+            array already there if it is large enough."""
+            
+        buffers = self.slots[slot]
+        if k == len(buffers):
+            buffers.append(None)
+        buf = buffers[k]
+        if buf is None or buf.dtype != dtype or buf.shape[1:] != shape[1:] \
+           or buf.shape[0] < shape[0]:
+            buf = np.empty(shape, dtype = dtype)
+            buffers[k] = buf
+        return buf[0:shape[0]]
+        
+    def read_item(self, i):
+    
+        """Reads item i into its slot of the ring."""
+        
+        start = time.time()
+        ifile, rows = self.items[i]
+        slot = i % len(self.slots)
+        
+        extnames = ['SCI','DQ'] if self.DQ else ['SCI']
+        arrays = []
+        hdu_list = fits.open(ifile, memmap = True)
+        try:
+            for extname in extnames:
+                for chip in self.chips:
+                    hdu = hdu_list[extname,chip]
+                    if rows is None:
+                        data = hdu.data
+                    else:
+                        data = hdu.section[rows[0]:rows[1],:]
+                    buf = self.get_buffer(slot, len(arrays), data.shape, data.dtype)
+                    np.copyto(buf, data)
+                    arrays.append(buf)
+        finally:
+            hdu_list.close()
+            
+        nbytes = sum([ar.nbytes for ar in arrays])
+        record_read(nbytes)
+        with self._lock:
+            self.stats['n_reads'] += 1
+            self.stats['bytes_read'] += nbytes
+            self.stats['read_s'] += time.time() - start
+            
+        n = len(self.chips)
+        return (ifile, rows, arrays[0:n], arrays[n:])
+        
+    def __iter__(self):
+    
+        n_items = len(self.items)
+        
+        #without read-ahead, the consumer waits for every read
+        if self.depth == 0:
+            for i in range(n_items):
+                start = time.time()
+                item = self.read_item(i)
+                stall = time.time() - start
+                self.stats['stall_s'] += stall
+                record_stall(stall)
+                yield item
+            return
+            
+        pool = ThreadPoolExecutor(max_workers = self.threads)
+        futures = {}
+        try:
+            for i in range(min(self.depth + 1, n_items)):
+                futures[i] = pool.submit(self.read_item, i)
+                
+            for i in range(n_items):
+                future = futures.pop(i)
+                start = time.time()
+                item = future.result()
+                stall = time.time() - start
+                self.stats['stall_s'] += stall
+                record_stall(stall)
+                
+                yield item
+                
+                #the slot of item i is free again once the consumer asks for i + 1
+                if i + self.depth + 1 < n_items:
+                    futures[i + self.depth + 1] = pool.submit(self.read_item,
+                                                              i + self.depth + 1)
+        finally:
+            for future in futures.values():
+                future.cancel()
+            pool.shutdown(wait = True)
@@ -0,0 +1,251 @@
+from astropy.io import fits
+import datetime
+import glob
+import os
+import sqlite3
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from paths_and_params import paths
+
+""" Reads the header keywords needed to sort FLT files, and keeps them in a SQLite
+	index keyed by rootname so that later stages can look files up without 
+	re-globbing the data directory or re-opening the files.
+	
+	Only the primary header block of each file is read, and files are read on a pool
+	of threads since the work is I/O bound.
+	
+	Files are added to the index when sort_new_data moves them into the data 
+	directory. Before the first file is added, and before the stages first list
+	their input files (get_indexed_files), the index is backfilled from the 
+	directory layout of the data directory (one glob, no header reads), and the 
+	data directory is marked as backfilled in the index. Files removed from the 
+	data directory are dropped from the index when get_indexed_files finds them 
+	missing; files copied in by hand are not seen until the index is rebuilt with
+	backfill_index (qe_pixels.py index).
+	
+"""
+
+MJD_ZERO = datetime.date(1858,11,17)
+
+def date_obs_to_mjd(date_obs):
+
+    """Converts a DATE-OBS string (YYYY-MM-DD) to MJD, at 00:00 UTC of that day."""
+    
+    date = datetime.datetime.strptime(date_obs,'%Y-%m-%d').date()
+    return float((date - MJD_ZERO).days)
+    
+def read_header_info(ifile):
+
+    """Reads the primary header of ifile (and nothing else).
+    
+        Returns
+        -------
+        
+        header_info: tuple
+            (file_path, filter, proposal_id, date_obs, mjd, size)
+            
+    """
+    
+    with open(ifile,'rb') as f:
+        hdr = fits.Header.fromfile(f)
+        
+    date_obs = hdr['DATE-OBS']
+    return (ifile, hdr['FILTER'], str(hdr['PROPOSID']), date_obs, 
+            date_obs_to_mjd(date_obs), os.path.getsize(ifile))
+            
+def scan_headers(ifiles, threads = 8):
+
+    """Reads the primary header info of every file in ifiles on a pool of threads. 
+        Returns a list of tuples in the same order as ifiles, see read_header_info."""
+        
+    with ThreadPoolExecutor(max_workers = threads) as pool:
+        return list(pool.map(read_header_info, ifiles))
+        
+def open_index(index_path):
+
+    """Opens (and creates, if needed) the header index database."""
+    
+    index_dir = os.path.dirname(os.path.abspath(index_path))
+    if not os.path.isdir(index_dir):
+        os.makedirs(index_dir)
+    conn = sqlite3.connect(index_path)
+    conn.execute('''CREATE TABLE IF NOT EXISTS files (
+                        rootname TEXT PRIMARY KEY,
+                        filter TEXT,
+                        proposid TEXT,
+                        date_obs TEXT,
+                        mjd REAL,
+                        anneal_mjd TEXT,
+                        size INTEGER,
+                        path TEXT)''')
+    conn.execute('CREATE INDEX IF NOT EXISTS files_filter ON files (filter, anneal_mjd)')
+    conn.execute('CREATE TABLE IF NOT EXISTS backfilled (data_dir TEXT PRIMARY KEY)')
+    return conn
+    
+def update_index(index_path, rows):
+
+    """Adds or replaces entries in the header index.
+    
+        Parameters
+        ----------
+        
+        index_path: string
+            Path to the SQLite index.
+            
+        rows: list of tuples
+            (path, filter, proposal_id, date_obs, mjd, anneal_mjd, size) for each 
+            file, where path is the file's final location.
+            
+    """
+    
+    conn = open_index(index_path)
+    with conn:
+        conn.executemany('INSERT OR REPLACE INTO files VALUES (?,?,?,?,?,?,?,?)',
+                         [(os.path.basename(row[0]).split('_')[0],) + tuple(row[1:]) \
+                          + (row[0],) for row in rows])
+    conn.close()
+    
+def backfill_index(index_path, data_dir):
+
+    """Replaces the entries of the files under data_dir in the header index with
+        the FLT files found in data_dir. The filter, proposal ID, anneal epoch and
+        visit date of each file are taken from its directory,
+        data_dir/filter/proposal_id/anneal_mjd/date_obs, so no header is read.
+        Returns the number of files indexed."""
+        
+    data_dir = data_dir.rstrip('/')
+    rows = []
+    for ifile in glob.glob(data_dir+'/*/*/*/*/*flt.fits'):
+        filt, prop_id, anneal_mjd, date_obs = ifile.split('/')[-5:-1]
+        rows.append((ifile, filt, prop_id, date_obs, date_obs_to_mjd(date_obs), 
+                     anneal_mjd, os.path.getsize(ifile)))
+                     
+    conn = open_index(index_path)
+    with conn:
+        conn.execute('DELETE FROM files WHERE substr(path,1,?) = ?',
+                     (len(data_dir)+1, data_dir+'/'))
+        conn.execute('INSERT OR REPLACE INTO backfilled VALUES (?)', (data_dir,))
+    conn.close()
+    update_index(index_path, rows)
+    print('Indexed {} files in {}.'.format(len(rows),data_dir))
+    return len(rows)
+    
+def ensure_backfilled(index_path, data_dir):
+
+    """Backfills the index from data_dir (see backfill_index) unless it was 
+        backfilled before. Called before files are first added to the index, so 
+        an archive sorted before the index existed is not left out of it."""
+        
+    conn = open_index(index_path)
+    done = conn.execute('SELECT 1 FROM backfilled WHERE data_dir = ?',
+                        (data_dir.rstrip('/'),)).fetchone() is not None
+    conn.close()
+    if not done:
+        backfill_index(index_path, data_dir)
+        
+def remove_from_index(index_path, ifiles):
+
+    """Removes the entries of the files ifiles from the header index."""
+    
+    conn = open_index(index_path)
+    with conn:
+        conn.executemany('DELETE FROM files WHERE path = ?', [(f,) for f in ifiles])
+    conn.close()
+    
+def query_index(index_path, filt = None, prop_ids = None, anneal_mjd = None,
+                date_obs = None, data_dir = None):
+                
+    """Returns the paths of indexed files matching the given filter, proposal IDs,
+        anneal date, visit date and data directory. Arguments left as None are not
+        used to select.
+        
+        Parameters
+        ----------
+        
+        filt: string
+            Filter.
+            
+        prop_ids: list of strings or ints
+            Proposal IDs.
+            
+        anneal_mjd: string
+            Anneal epoch, as used in the data directory names.
+            
+        date_obs: string
+            Visit date (DATE-OBS).
+            
+        data_dir: string
+            Data directory the files are in.
+            
+        Returns
+        -------
+        
+        paths: list of strings
+            Paths to the matching files, sorted by rootname.
+            
+    """
+    
+    query = 'SELECT path FROM files WHERE 1'
+    values = []
+    for column, value in (('filter',filt),('anneal_mjd',anneal_mjd),
+                          ('date_obs',date_obs)):
+        if value is not None:
+            query += ' AND {} = ?'.format(column)
+            values.append(value)
+    if prop_ids is not None:
+        query += ' AND proposid IN ({})'.format(','.join(['?']*len(prop_ids)))
+        values += [str(prop_id) for prop_id in prop_ids]
+    if data_dir is not None:
+        data_dir = data_dir.rstrip('/')
+        query += ' AND substr(path,1,?) = ?'
+        values += [len(data_dir)+1, data_dir+'/']
+    query += ' ORDER BY rootname'
+    
+    conn = open_index(index_path)
+    paths = [row[0] for row in conn.execute(query, values)]
+    conn.close()
+    return paths
+    
+def get_index_path(data_dir):
+
+    """Returns the header index of data_dir: paths()['header_index'] for the data
+        directory of paths(), otherwise data_dir/.header_index.db, so that stages
+        run on another data directory keep their own index."""
+        
+    monitor_paths = paths()
+    if os.path.abspath(data_dir) == os.path.abspath(monitor_paths['data_dir']):
+        return monitor_paths['header_index']
+    return os.path.join(data_dir, '.header_index.db')
+    
+def get_indexed_files(data_dir, filt = None, prop_ids = None, index_path = None):
+
+    """Returns the paths of the FLT files in data_dir, of filter filt and proposals 
+        prop_ids if given, from the header index (see get_index_path). The index 
+        is first backfilled from data_dir if it never was (see ensure_backfilled).
+        Indexed files that no longer exist are dropped from the index, so a file
+        deleted by hand is not handed to the stages."""
+        
+    if index_path is None:
+        index_path = get_index_path(data_dir)
+    ensure_backfilled(index_path, data_dir)
+    ifiles = query_index(index_path, filt = filt, prop_ids = prop_ids, 
+                         data_dir = data_dir)
+                         
+    exists = [os.path.isfile(ifile) for ifile in ifiles]
+    missing = [ifile for ifile, found in zip(ifiles, exists) if not found]
+    if len(missing) > 0:
+        print('Dropping {} missing files from the header index.'.format(len(missing)))
+        remove_from_index(index_path, missing)
+    return [ifile for ifile, found in zip(ifiles, exists) if found]
+                       
+def group_files(ifiles, level = 1):
+
+    """Groups file paths by their directory `level` levels up (1: the visit 
+        directory, 4: the filter directory). Returns an OrderedDict of sorted 
+        directories to sorted lists of paths."""
+        
+    groups = {}
+    for ifile in ifiles:
+        groups.setdefault(ifile.rsplit('/', level)[0], []).append(ifile)
+    return OrderedDict([(key, sorted(groups[key])) for key in sorted(groups)])
+
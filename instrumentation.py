@@ -0,0 +1,264 @@
+import contextlib
+import cProfile
+import functools
+import glob
+import inspect
+import json
+import os
+import resource
+import threading
+import time
+
+""" Lightweight instrumentation of the pipeline stages. 
+
+	When a run report is enabled (start_run, or the QE_RUN_REPORT environment 
+	variable, which worker processes inherit), every instrumented stage appends one
+	JSON line to the report with its wall and CPU time, the number of files and bytes
+	read and written during the stage, the time spent waiting for prefetched reads
+	(see fits_reader.py), and its peak RSS. If a profile directory is 
+	set, the combine functions also dump cProfile statistics there.
+	
+	Worker processes write their records to their own <report>.<pid> file rather 
+	than to the report, since concurrent appends to one file are not atomic on 
+	NFS, and the parent merges these into the report with merge_worker_reports 
+	when the pool is done (see task_pool.run_tasks).
+	
+	Without a report, the hooks only update a few counters.
+	
+"""
+
+REPORT_ENV = 'QE_RUN_REPORT'
+REPORT_OWNER_ENV = 'QE_RUN_REPORT_PID'
+PROFILE_ENV = 'QE_PROFILE_DIR'
+
+_counters = {'files_read': 0, 'bytes_read': 0, 'files_written': 0, 'bytes_written': 0,
+             'read_stall_s': 0.}
+
+#reads are recorded from the prefetch threads too
+_counters_lock = threading.Lock()
+
+#open stages of this process, innermost last
+_stages = []
+
+_profiling = [False]
+
+#a report enabled through the environment belongs to the first process to see it
+if os.environ.get(REPORT_ENV) is not None and os.environ.get(REPORT_OWNER_ENV) is None:
+    os.environ[REPORT_OWNER_ENV] = str(os.getpid())
+
+def start_run(report_path, profile_dir = None):
+
+    """Turns on the run report (appended to report_path) and, if profile_dir is 
+        given, profiling of the combine functions, for this process and any worker
+        processes started after."""
+        
+    os.environ[REPORT_ENV] = os.path.abspath(report_path)
+    os.environ[REPORT_OWNER_ENV] = str(os.getpid())
+    if profile_dir is not None:
+        if not os.path.isdir(profile_dir):
+            os.makedirs(profile_dir)
+        os.environ[PROFILE_ENV] = os.path.abspath(profile_dir)
+        
+def record_read(nbytes, nfiles = 1):
+
+    with _counters_lock:
+        _counters['files_read'] += nfiles
+        _counters['bytes_read'] += int(nbytes)
+    
+def record_write(nbytes, nfiles = 1):
+
+    with _counters_lock:
+        _counters['files_written'] += nfiles
+        _counters['bytes_written'] += int(nbytes)
+        
+def record_stall(seconds):
+
+    with _counters_lock:
+        _counters['read_stall_s'] += seconds
+    
+def get_peak_rss():
+
+    """Peak resident memory of this process in bytes, since the last 
+        reset_peak_rss where supported."""
+        
+    try:
+        with open('/proc/self/status','r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError):
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    
+def reset_peak_rss():
+
+    """Resets the peak RSS (Linux only), so it can be measured per stage."""
+    
+    try:
+        with open('/proc/self/clear_refs','w') as f:
+            f.write('5')
+    except (IOError, OSError):
+        pass
+        
+def get_record_path():
+
+    """The report itself in the process that started the run, 
+        <report>.<pid> in any other."""
+        
+    report_path = os.environ[REPORT_ENV]
+    if os.environ.get(REPORT_OWNER_ENV) in (None, str(os.getpid())):
+        return report_path
+    return '{}.{}'.format(report_path, os.getpid())
+    
+def write_record(record):
+
+    with open(get_record_path(),'a') as f:
+        f.write(json.dumps(record)+'\n')
+        
+def merge_worker_reports():
+
+    """Appends the records of the worker processes (<report>.<pid> files) to the 
+        report, in order of their start time, and removes the worker files. Call 
+        once the workers have finished."""
+        
+    report_path = os.environ.get(REPORT_ENV)
+    if report_path is None or get_record_path() != report_path:
+        return
+        
+    worker_files = glob.glob(glob.escape(report_path)+'.*')
+    worker_files = [f for f in worker_files if f.rsplit('.',1)[1].isdigit()]
+    if len(worker_files) == 0:
+        return
+        
+    lines = []
+    for worker_file in worker_files:
+        with open(worker_file,'r') as f:
+            lines += [line for line in f if line.strip() != '']
+    lines.sort(key = lambda line: json.loads(line)['start'])
+    with open(report_path,'a') as f:
+        f.writelines(lines)
+    for worker_file in worker_files:
+        os.remove(worker_file)
+        
+
+@contextlib.contextmanager
+def stage(name, **tags):
+
+    """Context manager that records one stage of the run in the report.
+    
+        Parameters
+        ----------
+        
+        name: string
+            Name of the stage.
+            
+        tags: 
+            Extra fields for the record, e.g. filt = 'F218W'.
+            
+    """
+    
+    if os.environ.get(REPORT_ENV) is None:
+        yield
+        return
+        
+    #keep the peak of the enclosing stage before resetting it for this one
+    if len(_stages) > 0:
+        _stages[-1]['peak_rss'] = max(_stages[-1]['peak_rss'], get_peak_rss())
+    reset_peak_rss()
+    
+    current = {'peak_rss': get_peak_rss()}
+    _stages.append(current)
+    counters_start = dict(_counters)
+    start, cpu_start = time.time(), time.process_time()
+    error = None
+    
+    try:
+        yield
+    except BaseException as e:
+        error = repr(e)
+        raise
+    finally:
+        _stages.pop()
+        peak_rss = max(current['peak_rss'], get_peak_rss())
+        if len(_stages) > 0:
+            _stages[-1]['peak_rss'] = max(_stages[-1]['peak_rss'], peak_rss)
+            
+        record = {'stage': name, 'pid': os.getpid(), 'start': start,
+                  'wall_s': round(time.time() - start, 4),
+                  'cpu_s': round(time.process_time() - cpu_start, 4),
+                  'peak_rss_mb': round(peak_rss / 2.**20, 1)}
+        for key in _counters:
+            record[key] = _counters[key] - counters_start[key]
+        record['read_stall_s'] = round(record['read_stall_s'], 4)
+        record.update(tags)
+        if error is not None:
+            record['error'] = error
+        write_record(record)
+        
+@contextlib.contextmanager
+def profiled(name):
+
+    """Runs the enclosed code under cProfile if a profile directory is set, and 
+        dumps the statistics to <profile dir>/<name>_<pid>_<time>.prof."""
+        
+    profile_dir = os.environ.get(PROFILE_ENV)
+    if profile_dir is None or _profiling[0]:
+        yield
+        return
+        
+    profile = cProfile.Profile()
+    _profiling[0] = True
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+        _profiling[0] = False
+        profile.dump_stats(os.path.join(profile_dir,'{}_{}_{}.prof'.format(name,
+                           os.getpid(),int(time.time()*1000))))
+                           
+def instrumented(name = None, tag_args = (), profile = False):
+
+    """Decorator recording every call of a function as a stage (see stage).
+    
+        Parameters
+        ----------
+        
+        name: string
+            Stage name, default the function name.
+            
+        tag_args: tuple of strings
+            Names of arguments of the function whose values are added to the 
+            record (for lists, their length as 'n_<name>').
+            
+        profile: bool
+            If True, the call is also profiled when profiling is on.
+            
+    """
+    
+    def decorator(func):
+        stage_name = name or func.__name__
+        signature = inspect.signature(func)
+        
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if os.environ.get(REPORT_ENV) is None and not profile:
+                return func(*args, **kwargs)
+            tags = {}
+            if len(tag_args) > 0:
+                bound = signature.bind(*args, **kwargs)
+                bound.apply_defaults()
+                for arg in tag_args:
+                    value = bound.arguments[arg]
+                    if isinstance(value, (list, tuple)):
+                        tags['n_'+arg] = len(value)
+                    else:
+                        tags[arg] = value
+            with stage(stage_name, **tags):
+                if profile:
+                    with profiled(stage_name):
+                        return func(*args, **kwargs)
+                return func(*args, **kwargs)
+        return wrapper
+        
+    return decorator
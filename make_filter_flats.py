@@ -0,0 +1,307 @@
+import os
+import sys
+import shutil
+from collections import OrderedDict
+from paths_and_params import paths, params
+from QE_pixel_tools import *
+from task_pool import run_tasks, get_file_sizes, get_memory_budget
+from instrumentation import instrumented
+from header_index import get_indexed_files, group_files
+from fits_reader import PrefetchReader
+from dq_flags import or_dq, get_bad_pixel_mask, mask_bad_pixels
+from make_median_filter_flats import read_manifest, write_manifest, \
+     build_input_manifest, compare_manifests, get_cache_batches, \
+     make_filter_median_flat, write_filter_median_flat, get_median_flat_path, \
+     get_checkpoint_key
+from make_mean_visit_flats import make_mean_visit_flat, write_mean_visit_flat
+
+
+def group_by_visit(ifiles):
+
+    """Groups ifiles by visit directory, keeping their order."""
+    
+    visits = OrderedDict()
+    for filee in ifiles:
+        visits.setdefault(os.path.dirname(filee), []).append(filee)
+    return visits
+    
+    
+def plan_fused_combine(n_cube_files, n_visits, dims, n_chips, max_memory):
+
+    """Chooses the strip height of make_filter_flats within max_memory bytes.
+    
+    The visit means are full frames held until the end of the pass (float64
+    mean and uint16 DQ, 10 bytes a pixel per visit), the median is combined in
+    strips in the rest of the budget, see plan_combine, for a cube of n_cube_files
+    files a chip. Returns None if the visit means do not fit.
+    
+        """
+        
+    visit_bytes = n_visits * n_chips * dims[0] * dims[1] * 10
+    if visit_bytes > 0.5 * max_memory:
+        return None
+        
+    try:
+        strategy, strip_height = plan_combine(max(n_cube_files,1), dims, n_chips,
+                                              'median', max_memory - visit_bytes)
+    except MemoryError:
+        return None
+    return strip_height
+    
+    
+@instrumented(name='filter_flats', tag_args=('filt','ifiles'), profile=True)
+def make_filter_flats(data_dir, filt, ifiles):
+
+    """Makes the median flat of a filter and the mean flat of each of its visits
+        in one pass over the input files.
+        
+        The chips are read one strip of rows at a time. Each strip of each file
+        goes both into the median data cube of the strip and into the running
+        mean of the visit the file belongs to, so every file is read once instead
+        of once for the median flat and again for its visit's mean flat. All
+        flats are written at the end. The outputs are identical to
+        make_filter_median_flat and make_mean_visit_flat of every visit.
+        
+        The median flat manifest and tile cache are handled as in
+        make_filter_median_flat: if the inputs of the median flat are unchanged
+        only the visit means are made, and if params()['median_cache'] is set only
+        files not yet in the cache go into the median cube. If the visit means do
+        not fit in the memory budget, the flats are made separately.
+        
+        Finished strips of all the flats are checkpointed, so that an interrupted
+        run resumes from the first unfinished strip if the inputs are unchanged
+        (see make_filter_median_flat).
+        
+        Parameters
+        ----------
+        data_dir : string
+            Data directory
+            
+        filt : string
+            Filter.
+            
+        ifiles : list of strings
+            Paths to the input files, from every proposal.
+            
+    """
+    
+    chips = [1,2]
+    use_cache = params()['median_cache']
+    stats = params()['median_flat_stats']
+    
+    outfile_path_dir = data_dir + '/{}/'.format(filt)
+    outfile_path = get_median_flat_path(data_dir, filt)
+    manifest_path = outfile_path_dir+'{}_median_flat_manifest.json'.format(filt)
+    cache_dir = outfile_path_dir+'median_cache'
+    checkpoint_dir = outfile_path_dir+'median_checkpoint'
+    
+    visits = group_by_visit(ifiles)
+    
+    #same manifest as make_filter_median_flat, so the two can be used in turn
+    combine_params = {'avg_type': 'median', 'chips': chips,
+                      'combine_dq_arrays': True, 'mask_dq_each': False,
+                      'strip_height': params()['strip_height']}
+    #unset stats are left out, so existing manifests still match
+    if stats:
+        combine_params['stats'] = list(stats)
+    old_manifest = read_manifest(manifest_path)
+    manifest = build_input_manifest(ifiles, combine_params, old_manifest)
+    status, new_files = compare_manifests(old_manifest, manifest)
+    
+    if status == 'unchanged' and os.path.isfile(outfile_path):
+        print('Inputs for {} median flat unchanged, making visit means only.'.format(filt))
+        for visit_dir in visits:
+            make_mean_visit_flat(visit_dir, visits[visit_dir])
+        return
+        
+    old_batches, new_batch = [], None
+    if use_cache:
+        key = get_checkpoint_key(manifest, old_manifest, 'fused',
+                                 params()['strip_height'])
+        old_batches, new_batch, new_files = get_cache_batches(cache_dir, ifiles,
+                                    status, new_files, old_manifest,
+                                    clear = not checkpoint_matches(checkpoint_dir, key))
+    else:
+        new_files = list(ifiles)
+        
+    dims = get_chip_shape(ifiles[0],chips[0])
+    
+    #with the cache, each strip also holds the tiles of every old batch and their
+    #concatenation with the new files
+    n_cube_files = len(new_files) + len(ifiles) if use_cache else len(new_files)
+    strip_height = plan_fused_combine(n_cube_files, len(visits),
+                                      dims, len(chips), get_memory_budget())
+                                      
+    #the cached tiles must line up with those of make_filter_median_flat. If they
+    #do not fit, make_filter_median_flat combines without the cache
+    if use_cache and strip_height is not None:
+        if strip_height < params()['strip_height']:
+            strip_height = None
+        else:
+            strip_height = params()['strip_height']
+            
+    if strip_height is None:
+        print('Visit means of {} do not fit in memory, making flats separately.'.format(
+              filt))
+        make_filter_median_flat(data_dir, filt, ifiles)
+        for visit_dir in visits:
+            make_mean_visit_flat(visit_dir, visits[visit_dir])
+        return
+        
+    strip_height = min(strip_height, dims[0])
+    if not use_cache:
+        key = get_checkpoint_key(manifest, old_manifest, 'fused', strip_height)
+    done = read_checkpoint(checkpoint_dir, key)
+    
+    if use_cache:
+        batch_dir = os.path.join(cache_dir,new_batch)
+        if os.path.isdir(batch_dir) and len(done) == 0:
+            shutil.rmtree(batch_dir)
+        if not os.path.isdir(batch_dir):
+            os.makedirs(batch_dir)
+            
+    print('Making median filter flat and {} visit mean flats for {}, '.format(
+          len(visits),filt) + 'using {} files in strips of {} rows.'.format(
+          len(ifiles),strip_height))
+          
+    median_arrays = [np.empty(dims,dtype=np.float32) for chip in chips]
+    median_dq = np.zeros((len(chips),dims[0],dims[1]),dtype=np.uint16)
+    stats_arrays = make_stats_arrays(stats, len(chips), dims)
+    
+    #the mean of a visit is summed into its output array, strip by strip
+    visit_means = OrderedDict()
+    for visit_dir in visits:
+        visit_means[visit_dir] = (np.zeros((len(chips),dims[0],dims[1])),
+                                  np.zeros((len(chips),dims[0],dims[1]),dtype=np.uint16))
+    count_strip = np.empty((len(chips),strip_height,dims[1]),dtype=np.int32)
+    bad_strip = np.empty((strip_height,dims[1]),dtype=bool)
+    
+    new_index = dict([(filee, i) for i, filee in enumerate(new_files)])
+    strip_cube = np.empty((len(chips),len(new_files),strip_height,dims[1]),
+                          dtype=np.float32)
+                          
+    strips = [(y0,min(y0+strip_height,dims[0])) for y0 in range(0,dims[0],strip_height)]
+    
+    #strips finished by an interrupted run
+    for y0, y1 in strips:
+        if y0 in done:
+            strip = load_checkpoint_strip(checkpoint_dir, y0)
+            for j in range(len(chips)):
+                median_arrays[j][y0:y1] = strip['sci'][j]
+            median_dq[:,y0:y1] = strip['dq']
+            for name in stats_arrays:
+                stats_arrays[name][:,y0:y1] = strip['stat_'+name]
+            for v, visit_dir in enumerate(visits):
+                visit_means[visit_dir][0][:,y0:y1] = strip['means'][v]
+    strips = [(y0, y1) for y0, y1 in strips if y0 not in done]
+    
+    #every strip of every file is read once, in this order, and read ahead
+    reader = iter(PrefetchReader([(filee,rows) for rows in strips for visit_dir in visits
+                                  for filee in visits[visit_dir]], chips, DQ=True))
+                                  
+    for y0, y1 in strips:
+        cube = strip_cube[:,:,0:y1-y0]
+        dq_union = np.zeros((len(chips),y1-y0,dims[1]),dtype=np.uint16)
+        
+        for visit_dir in visits:
+            sum_arrays = visit_means[visit_dir][0][:,y0:y1]
+            counts = count_strip[:,0:y1-y0]
+            counts[:] = 0
+            
+            for filee in visits[visit_dir]:
+                filee, rows, sci_arrays, dq_arrays = next(reader)
+                
+                for j in range(len(chips)):
+                    #median, same as make_avg_flat_array_strips
+                    if filee in new_index:
+                        cube[j][new_index[filee]] = sci_arrays[j]
+                        or_dq(dq_union[j], dq_arrays[j])
+                        
+                    #visit mean, same as make_mean_flat_array with mask_dq_each.
+                    #The visit DQ arrays are not combined (see make_mean_visit_flat)
+                    tmp = np.array(sci_arrays[j],dtype=np.float64)
+                    mask_bad_pixels(tmp, get_bad_pixel_mask(dq_arrays[j],
+                                    out=bad_strip[0:y1-y0]))
+                    valid = ~np.isnan(tmp)
+                    np.add(sum_arrays[j],tmp,out=sum_arrays[j],where=valid)
+                    counts[j] += valid
+                    
+            mean_strip = np.full(sum_arrays.shape, np.nan)
+            np.divide(sum_arrays,counts,out=mean_strip,where=counts>0)
+            sum_arrays[:] = mean_strip
+            
+        for j, chip in enumerate(chips):
+            stacks = [cube[j]]
+            if use_cache:
+                tile_name = 'chip{}_{}'.format(chip,y0)
+                np.save(os.path.join(batch_dir,tile_name+'_sci.npy'), cube[j])
+                np.save(os.path.join(batch_dir,tile_name+'_dq.npy'), dq_union[j])
+                for batch in old_batches:
+                    old_dir = os.path.join(cache_dir,batch)
+                    stacks.append(np.load(os.path.join(old_dir,tile_name+'_sci.npy')))
+                    or_dq(dq_union[j], np.load(os.path.join(old_dir,tile_name+'_dq.npy')))
+            median_cube = cube[j] if len(stacks) == 1 else \
+                          np.concatenate(stacks).astype(np.float32, copy=False)
+            nanmedian_cube(median_cube, out=median_arrays[j][y0:y1],
+                           stats_out=get_stats_out(stats_arrays,j,y0,y1))
+            median_dq[j][y0:y1] = dq_union[j]
+            
+        save_checkpoint_strip(checkpoint_dir, y0,
+                              sci = np.array([ar[y0:y1] for ar in median_arrays]),
+                              dq = median_dq[:,y0:y1],
+                              means = np.array([visit_means[visit_dir][0][:,y0:y1] \
+                                                for visit_dir in visits]),
+                              **get_stats_strip(stats_arrays, y0, y1))
+                              
+    for visit_dir in visits:
+        write_mean_visit_flat(visit_dir, list(visit_means[visit_dir][0]),
+                              visit_means[visit_dir][1])
+                              
+    write_filter_median_flat(data_dir, filt, ifiles, median_arrays, median_dq,
+                             stats = stats_arrays if stats else None)
+                             
+    #manifest is written last, so an interrupted run is redone next time
+    if use_cache:
+        manifest['batches'] = old_batches + [new_batch]
+    write_manifest(manifest, manifest_path)
+    clear_checkpoint(checkpoint_dir)
+    
+    
+@instrumented()
+def main_make_filter_flats(data_dir, workers = 1):
+
+    """Main function that makes the median flat field of each filter and the
+        mean flat of each visit, reading every file once. Replaces running
+        main_make_median_flats (from all proposals) then main_make_mean_visit_flats.
+        
+        Parameters
+        ----------
+        data_dir : string
+            Data directory
+            
+        workers : int
+            Number of processes filters are combined on in parallel.
+            
+        Returns
+        -------
+        failed : list of tuples
+            (name, traceback) of every filter that failed, see run_tasks.
+            
+             """
+             
+    tasks = []
+    for filter_dir, ifiles in group_files(get_indexed_files(data_dir), level = 4).items():
+        filt = os.path.basename(filter_dir)
+        tasks.append(('filter flats '+filt, get_file_sizes(ifiles),
+                      make_filter_flats, (data_dir, filt, ifiles)))
+                      
+    failed = run_tasks(tasks, workers = workers, max_memory = params()['max_memory'])
+    return failed
+    
+    
+if __name__ == '__main__':
+
+    data_dir = paths()['data_dir']
+    failed = main_make_filter_flats(data_dir)
+    if len(failed) > 0:
+        sys.exit(1)
@@ -1,34 +1,81 @@
-from astropy.io import fits
-import glob
 import os 
-from paths_and_params import paths
+import sys
+from paths_and_params import paths, params
 from QE_pixel_tools import *
+from task_pool import run_tasks, get_file_sizes
+from instrumentation import instrumented
+from header_index import get_indexed_files, group_files
+from pixel_history import get_history_dir, append_epoch
+
+
+@instrumented(name='mean_visit_flat', tag_args=('visit_dir','ifiles'))
+def make_mean_visit_flat(visit_dir, ifiles):
+
+    """Makes the mean flat of the files ifiles in one visit directory."""
+    
+    visit_date = os.path.basename(visit_dir)
+    filt = visit_dir.split('/')[-4]
+    
+    print('Making mean epoch flat for ' + filt+ ', visit date', visit_date)
+    sci_arrays,dq_arrays = make_avg_flat_array(ifiles,'mean',[1,2],
+                                               combine_dq_arrays = False,
+                                               mask_dq_each = True)
+    write_mean_visit_flat(visit_dir, sci_arrays, dq_arrays)
+    
+    
+def get_mean_flat_path(visit_dir):
+
+    """Returns the path of the mean flat of a visit directory."""
+    
+    visit_date = os.path.basename(visit_dir)
+    mjd = visit_dir.split('/')[-2]
+    filt = visit_dir.split('/')[-4]
+    return visit_dir+'/mean_flat_'+filt+'_'+mjd+'_'+visit_date+'.fits'
+    
+    
+def write_mean_visit_flat(visit_dir, sci_arrays, dq_arrays):
+
+    """Writes the mean flat of a visit directory, and adds it to the pixel 
+        history of the filter."""
+        
+    visit_date = os.path.basename(visit_dir)
+    mjd = visit_dir.split('/')[-2]
+    
+    mean_array_1, mean_array_2= sci_arrays[0],sci_arrays[1]
+    dq_array_1,dq_array_2 = dq_arrays[0],dq_arrays[1]
+    
+    outfile_path = get_mean_flat_path(visit_dir)
+    print('Writing out', outfile_path)
+    write_full_frame_uvis_image(mean_array_1,mean_array_2,dq_array_1,dq_array_2,
+    							outfile_path,
+    							compression = params()['output_compression']['mean_flat'])
+    
+    #add the visit to the pixel history of the filter
+    if params()['pixel_history']:
+        prop_dir = os.path.dirname(os.path.dirname(visit_dir))
+        store_dir = get_history_dir(os.path.dirname(prop_dir))
+        epoch_key = '/'.join(visit_dir.split('/')[-3:])
+        append_epoch(store_dir,epoch_key,[mean_array_1,mean_array_2],
+                     dq_arrays = [dq_array_1,dq_array_2],
+                     anneal_mjd = mjd,date_obs = visit_date,
+                     prop_id = os.path.basename(prop_dir))
 
             
-def main_make_mean_visit_flats(data_dir):
-
-    visit_dirs = glob.glob(data_dir+'/*/*/*/*')
-    
-    for visit_dir in visit_dirs:    
-        visit_date = os.path.basename(visit_dir)
-        mjd = visit_dir.split('/')[-2]
-        filt = visit_dir.split('/')[-4]
-        ifiles = glob.glob(visit_dir+'/*flt.fits')
-        if len(ifiles) > 0:
-            print('Making mean epoch flat for ' + filt+ ', visit date', visit_date)
-            sci_arrays,dq_arrays = make_avg_flat_array(ifiles,'mean',[1,2],
-                                                       combine_dq_arrays = Fakse,
-                                                       mask_dq_each = True)
-            mean_array_1, mean_array_2= sci_arrays[0],sci_arrays[1]
-            dq_array_1,dq_array_2 = dq_arrays[0],dq_arrays[1]
-            
-            outfile_path = visit_dir+'/mean_flat_'+filt+'_'+mjd+'_'+visit_date+'.fits'
-            print('Writing out', outfile_path)
-            write_full_frame_uvis_image(mean_array_1,mean_array_2,dq_array_1,dq_array_2,
-            							outfile_path)
+@instrumented()
+def main_make_mean_visit_flats(data_dir, workers = 1):
+
+    tasks = []
+    for visit_dir, ifiles in group_files(get_indexed_files(data_dir)).items():
+        tasks.append(('mean flat '+visit_dir, get_file_sizes(ifiles),
+                      make_mean_visit_flat, (visit_dir, ifiles)))
+                          
+    failed = run_tasks(tasks, workers = workers, max_memory = params()['max_memory'])
+    return failed
             
         
 if __name__ == '__main__':
 
     data_dir = paths()['data_dir']
-    main_make_mean_visit_flats(data_dir)
+    failed = main_make_mean_visit_flats(data_dir)
+    if len(failed) > 0:
+        sys.exit(1)
@@ -1,8 +1,14 @@
-from astropy.io import fits
-import glob
+import hashlib
+import json
 import os 
-from paths_and_params import paths
+import sys
+import shutil
+from paths_and_params import paths, params
 from QE_pixel_tools import *
+from task_pool import run_tasks, get_file_sizes, get_memory_budget
+from instrumentation import instrumented
+from header_index import get_indexed_files, group_files
+from dq_flags import or_dq, union_dq
 
 """ Creates an 'ideal' median flat field for each filter. 
 	
@@ -11,117 +17,471 @@ from QE_pixel_tools import *
 	
 """
 
-def write_temp_split_files(ifiles):
+def log_file_names(ifile_paths,log_file_outfile_path):
 
-    """To avoid running out of memory, when trying to combine more than ~150 images,
-        create temporary files that split the full frame into pieces, combine them 
-        piecewise. This functionality assumes disk space is not limited so that temp
-        files can be all created at once, then deleted. 
-        
-        Each chip is split into quadrants for a total of 8 temporary files for each
-        full frame image. The DQ arrays are split up accordingly and written to the 
-        temporary files as well. 
+    """Creates a log file of the rootnames of files that went in to making the median
+        flat for each filter.
         
         Parameters
         ----------
-        ifiles: list of strings
-            List of paths to all files that should be split.
+        
+        ifile_paths: list of strings
+            list of input files to write out to log file
             
+        log_file_outfile_path: string
+            full path to txt file that file names should be logged in
+        
         Outputs
         -------
-            For each file in ifiles, a temporary fits file that is a quarter segment of 
-            the full chip. Temporary files contain the science array and the DQ array. 
+        
+        A text file of all rootnames in ifiles_paths, at the location specified
+        by log_file_outfile_path.
+        
+    """
+        
+    rootnames = [os.path.basename(f) for f in ifile_paths]
+        
+    print('Logging files used to create median flat.')
+    with open(log_file_outfile_path,'a') as f:
+        for rootname in rootnames:
+            f.write(rootname+'\n')
+            
+def file_checksum(ifile, blocksize = 2**20):
+
+    """Returns the sha1 hex digest of the contents of ifile."""
+    
+    sha = hashlib.sha1()
+    with open(ifile,'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            sha.update(block)
+    return sha.hexdigest()
+    
+def read_manifest(manifest_path):
+
+    """Reads the input manifest of a median flat. Returns None if there is no 
+        manifest (i.e the median flat has never been made with a manifest)."""
+        
+    if not os.path.isfile(manifest_path):
+        return None
+    with open(manifest_path,'r') as f:
+        return json.load(f)
+        
+def write_manifest(manifest, manifest_path):
+
+    with open(manifest_path,'w') as f:
+        json.dump(manifest, f, indent = 1, sort_keys = True)
+        
+def build_input_manifest(ifiles, combine_params, old_manifest = None):
+
+    """Creates a manifest of the files that go in to making a median flat, and the 
+        parameters used to combine them. 
+        
+        The content hash of a file is only recomputed when its size or modification
+        time differ from the entry in old_manifest, so unchanged inputs are not 
+        re-read.
+        
+        Parameters
+        ----------
+        
+        ifiles: list of strings
+            Paths to input files.
             
-            The names of the output temporary files contain the rootname of the original 
-            file, the chip (1 or 2) and which quadrant (A,B,C,or D clockwise from the top 
-            left), and appended with '.temp'. For example - 'ic5y17f7q_chip1_D.temp' -
-            would be the bottom right quadrant of chip 1 for the full frame image in 
-            ic5y17f7q_flt.fits.
+        combine_params: dict
+            Parameters that the median flat depends on.
             
+        old_manifest: dict or None
+            Manifest from the previous run.
+            
+        Returns
+        -------
+        
+        manifest: dict
+            {'params': combine_params, 'batches': [], 
+             'files': {path: {'size':, 'mtime':, 'sha1':}}}
+             
     """
+    
+    old_files = {}
+    if old_manifest is not None:
+        old_files = old_manifest['files']
+        
+    files = {}
+    for ifile in ifiles:
+        stat = os.stat(ifile)
+        entry = {'size': stat.st_size, 'mtime': stat.st_mtime}
+        old_entry = old_files.get(ifile)
+        if old_entry is not None and old_entry['size'] == entry['size'] \
+           and old_entry['mtime'] == entry['mtime']:
+            entry['sha1'] = old_entry['sha1']
+        else:
+            entry['sha1'] = file_checksum(ifile)
+        files[ifile] = entry
         
-    for fnumber, ifile in enumerate(ifiles):
+    return {'params': combine_params, 'batches': [], 'files': files}
     
-        print(fnumber,'of',len(ifiles))
+def compare_manifests(old_manifest, manifest):
+
+    """Compares the manifest of the current inputs to the one from the last time 
+        the median flat was made.
         
-        sci_arrays, dq_arrays = open_fits(ifile,[1,2],DQ = True)
-        ch1, ch2 = sci_arrays[0],sci_arrays[1]
-        dq1,dq2 = dq_arrays[0],dq_arrays[1]
+        Returns
+        -------
         
-        #split each chip in 2 pieces
+        status: string
+            'unchanged' if inputs and parameters are the same, 'added' if the only 
+            change is new input files, otherwise 'changed'.
+            
+        new_files: list of strings
+            Input files not in old_manifest.
+            
+    """
+    
+    if old_manifest is None or old_manifest['params'] != manifest['params']:
+        return ('changed', sorted(manifest['files']))
         
-        sci_arrays = (ch1[0:1025,0:2048],ch1[0:1025,2048:],ch1[1025:,0:2048],
-                      ch1[1025:,2048:], ch2[0:1025,0:2048],ch2[0:1025,2048:],
-                      ch2[1025:,0:2048],ch2[1025:,2048:])
-                  
-        dq_arrays = (dq1[0:1025,0:2048],dq1[0:1025,2048:],dq1[1025:,0:2048],
-                     dq1[1025:,2048:], dq2[0:1025,0:2048],dq2[0:1025,2048:],
-                     dq2[1025:,0:2048],dq2[1025:,2048:])
-                  
+    old_files, files = old_manifest['files'], manifest['files']
+    
+    for ifile in old_files:
+        if ifile not in files or files[ifile]['sha1'] != old_files[ifile]['sha1']:
+            return ('changed', sorted(files))
+            
+    new_files = sorted([ifile for ifile in files if ifile not in old_files])
+    if len(new_files) == 0:
+        return ('unchanged', new_files)
+    return ('added', new_files)
+    
+@instrumented(tag_args=('new_files','old_batches'), profile=True)
+def make_median_from_tile_cache(new_files, cache_dir, old_batches, new_batch, 
+                                chips = [1,2], strip_height = 64, 
+                                checkpoint_dir = None, checkpoint_key = None,
+                                stats = None):
+                                
+    """Median combines files using a persistent per-tile cache of the inputs, so 
+        that adding files to a median flat only reads the new files.
         
-        #write out temporary files
+        The chips are combined in horizontal strips (tiles) of strip_height rows. 
+        For each tile, the data of new_files are read and saved to 
+        cache_dir/new_batch, then combined with the data of the same tile from 
+        every batch in old_batches. The DQ array is the union of all input DQ 
+        arrays. The result is identical to make_avg_flat_array(all files, 'median',
+        chips, combine_dq_arrays = True).
         
-        sections = [('_chip{0}_{1}'.format(i,j),i) for i in ('1','2') \
-                    for j in ('A','B','C','D')]
+        Costs: the cache stores a float32 copy of the SCI data of every file 
+        (roughly the size of the SCI extensions of the inputs on disk), and each 
+        update reads every old batch of every tile, so its I/O grows with the whole
+        history of the filter. What it saves is opening and decoding the old FITS
+        files. See params()['median_cache'], off by default.
         
-        for i, ar in enumerate(sci_arrays):
-            temp_path = ifile.replace('_flt.fits','') + sections[i][0]+'.temp'
-            chip = int(sections[i][1])
+        Parameters
+        ----------
+        
+        new_files: list of strings
+            Paths to input files not yet in the cache.
             
-            dq_ar = dq_arrays[i]
+        cache_dir: string
+            Directory of the tile cache.
             
-            #if not os.path.isfile(temp_path):
-            if True:
-                pri = fits.PrimaryHDU() #dummy primary extension
-                
-                hdu1 = fits.ImageHDU(ar)
-                hdu1.header['EXTNAME'] = 'SCI'
-                hdu1.header['EXTVER'] = int(chip)
-                
-                hdu2 = fits.ImageHDU(dq_ar)
-                hdu2.header['EXTNAME'] = 'DQ'
-                hdu2.header['EXTVER'] = int(chip)
+        old_batches: list of strings
+            Names of previously cached batches to include.
+            
+        new_batch: string
+            Name of the batch new_files are cached as.
+            
+        checkpoint_dir, checkpoint_key: strings
+            Checkpoint of the finished tiles, see make_avg_flat_array_strips. The
+            tiles of new_batch already saved by an interrupted call are kept.
+            
+        stats: list of strings
+            Other statistics of each pixel, see make_avg_flat_array.
+            
+        Returns
+        -------
+        
+        Same as make_avg_flat_array.
+        
+    """
+    
+    chips = sorted(chips)
+    
+    dims = get_chip_shape(new_files[0],chips[0])
     
+    median_arrays = [np.empty(dims,dtype=np.float32) for chip in chips]
+    DQ_array_chips = np.zeros((len(chips),dims[0],dims[1]),dtype=np.uint16)
+    stats_arrays = make_stats_arrays(stats or [], len(chips), dims)
+    
+    done = []
+    if checkpoint_dir is not None:
+        done = read_checkpoint(checkpoint_dir, checkpoint_key)
+        
+    batch_dir = os.path.join(cache_dir,new_batch)
+    if os.path.isdir(batch_dir) and len(done) == 0:
+        shutil.rmtree(batch_dir)
+    if not os.path.isdir(batch_dir):
+        os.makedirs(batch_dir)
+    
+    print('computing median of {} cached batches and {} new images...'.format(
+          str(len(old_batches)),str(len(new_files))))
+    
+    for y0 in range(0,dims[0],strip_height):
+        y1 = min(y0+strip_height,dims[0])
+        
+        if y0 in done:
+            strip = load_checkpoint_strip(checkpoint_dir, y0)
+            for j in range(len(chips)):
+                median_arrays[j][y0:y1] = strip['sci'][j]
+            DQ_array_chips[:,y0:y1] = strip['dq']
+            for name in stats_arrays:
+                stats_arrays[name][:,y0:y1] = strip['stat_'+name]
+            continue
+            
+        #read the strip from the new files
+        new_sci = [[] for chip in chips]
+        new_dq = [[] for chip in chips]
+        for filee in new_files:
+            sci_arrays,dq_arrays = open_fits_section(filee,chips,(y0,y1),DQ=True)
+            for j in range(len(chips)):
+                new_sci[j].append(sci_arrays[j])
+                new_dq[j].append(dq_arrays[j])
                 
-                hdulist = fits.HDUList([pri,hdu1,hdu2])
-                hdulist.writeto(temp_path,overwrite=True) 
-            else:
-                pass
+        for j, chip in enumerate(chips):
+            tile_name = 'chip{}_{}'.format(chip,y0)
+            sci_stack = np.array(new_sci[j])
+            dq_union = union_dq(new_dq[j])
+            np.save(os.path.join(batch_dir,tile_name+'_sci.npy'), sci_stack)
+            np.save(os.path.join(batch_dir,tile_name+'_dq.npy'), dq_union)
+            
+            stacks = [sci_stack]
+            for batch in old_batches:
+                old_dir = os.path.join(cache_dir,batch)
+                stacks.append(np.load(os.path.join(old_dir,tile_name+'_sci.npy')))
+                or_dq(dq_union, np.load(os.path.join(old_dir,tile_name+'_dq.npy')))
                 
+            cube = np.concatenate(stacks).astype(np.float32, copy=False)
+            nanmedian_cube(cube, out=median_arrays[j][y0:y1],
+                           stats_out=get_stats_out(stats_arrays,j,y0,y1))
+            DQ_array_chips[j][y0:y1] = dq_union
+            
+        if checkpoint_dir is not None:
+            save_checkpoint_strip(checkpoint_dir, y0, 
+                                  sci = np.array([ar[y0:y1] for ar in median_arrays]),
+                                  dq = DQ_array_chips[:,y0:y1],
+                                  **get_stats_strip(stats_arrays, y0, y1))
+            
+    if stats:
+        return (median_arrays,DQ_array_chips,stats_arrays)
+    return (median_arrays,DQ_array_chips)
+    
+@instrumented(name='median_flat', tag_args=('filt','ifiles'))
+def make_filter_median_flat(data_dir, filt, ifiles):
 
-def log_file_names(ifile_paths,log_file_outfile_path):
-
-    """Creates a log file of the rootnames of files that went in to making the median
-        flat for each filter.
+    """Makes the median flat field of one filter from ifiles, unless its inputs 
+        are unchanged since the last run. See main_make_median_flats.
         
         Parameters
         ----------
-        
-        ifile_paths: list of strings
-            list of input files to write out to log file
+        data_dir : string
+            Data directory
             
-        log_file_outfile_path: string
-            full path to txt file that file names should be logged in
+        filt : string
+            Filter.
+            
+        ifiles : list of strings
+            Paths to the input files.
+            
+    """
+    
+    strip_height = params()['strip_height']
+    use_cache = params()['median_cache']
+    stats = params()['median_flat_stats']
+    
+    outfile_path_dir = data_dir + '/{}/'.format(filt)
+    outfile_path = get_median_flat_path(data_dir, filt)
+    manifest_path = outfile_path_dir+'{}_median_flat_manifest.json'.format(filt)
+    cache_dir = outfile_path_dir+'median_cache'
+    checkpoint_dir = outfile_path_dir+'median_checkpoint'
+    
+    #skip filters whose inputs have not changed since the last run
+    combine_params = {'avg_type': 'median', 'chips': [1,2], 
+                      'combine_dq_arrays': True, 'mask_dq_each': False,
+                      'strip_height': strip_height}
+    #unset stats are left out, so existing manifests still match
+    if stats:
+        combine_params['stats'] = list(stats)
+    old_manifest = read_manifest(manifest_path)
+    manifest = build_input_manifest(ifiles, combine_params, old_manifest)
+    status, new_files = compare_manifests(old_manifest, manifest)
+    
+    if status == 'unchanged' and os.path.isfile(outfile_path):
+        print('Inputs for {} median flat unchanged, skipping.'.format(filt))
+        return
         
-        Outputs
-        -------
+    print('Making median filter flat for ' + filt)
+    
+    #the tiles of the cache have a fixed height, if the cube of all files of one
+    #tile does not fit in memory the flat is combined without the cache
+    if use_cache and not cache_fits_in_memory(ifiles, strip_height):
+        print('Tiles of {} rows of all {} files of {} do not fit in memory, '.format(
+              strip_height, len(ifiles), filt) + 'combining without the tile cache.')
+        use_cache = False
+        if os.path.isdir(cache_dir):
+            shutil.rmtree(cache_dir)
+    
+    #finished strips are checkpointed, so an interrupted build resumes where it 
+    #stopped if the inputs are the same
+    if use_cache:
+        key = get_checkpoint_key(manifest, old_manifest, 'cache', strip_height)
+        old_batches, new_batch, new_files = get_cache_batches(cache_dir, ifiles, 
+                                    status, new_files, old_manifest,
+                                    clear = not checkpoint_matches(checkpoint_dir, key))
         
-        A text file of all rootnames in ifiles_paths, at the location specified
-        by log_file_outfile_path.
+        print('Using {} files, {} new.'.format(len(ifiles),len(new_files)))
+        result = make_median_from_tile_cache(new_files,cache_dir,
+                                                   old_batches,new_batch,
+                                                   chips = [1,2],
+                                                   strip_height = strip_height,
+                                                   checkpoint_dir = checkpoint_dir,
+                                                   checkpoint_key = key,
+                                                   stats = stats)
+        manifest['batches'] = old_batches + [new_batch]
         
-    """
+    else:
+        dims = get_chip_shape(ifiles[0],1)
+        strategy, plan_height = plan_combine(len(ifiles),dims,2,'median',
+                                             get_memory_budget())
         
-    rootnames = [os.path.basename(f) for f in ifile_paths]
+        if strategy == 'memory':
+            print('Using {} files'.format(len(ifiles)))
+            result = make_avg_flat_array(ifiles,'median',[1,2],
+                                                       combine_dq_arrays = True,
+                                                       mask_dq_each = False,
+                                                       stats = stats)
+
+        else:
+            print('Using {} files. Combining in strips.'.format(len(ifiles)))
+            key = get_checkpoint_key(manifest, old_manifest, 'strips', plan_height)
+            result = make_avg_flat_array_strips(ifiles,'median',[1,2],
+                                                       strip_height = plan_height,
+                                                       combine_dq_arrays = True,
+                                                       mask_dq_each = False,
+                                                       checkpoint_dir = checkpoint_dir,
+                                                       checkpoint_key = key,
+                                                       stats = stats)
+                                                   
+    write_filter_median_flat(data_dir, filt, ifiles, result[0], result[1],
+                             stats = result[2] if stats else None)
+    
+    #manifest is written last, so an interrupted run is redone next time
+    write_manifest(manifest, manifest_path)
+    clear_checkpoint(checkpoint_dir)
+    
+    
+def cache_fits_in_memory(ifiles, strip_height, n_files = None):
+
+    """Returns True if tiles of strip_height rows of n_files files (default all of
+        ifiles) can be median combined within get_memory_budget(). 
         
-    print('Logging files used to create median flat.')
-    with open(log_file_outfile_path,'a') as f:
-        for rootname in rootnames:
-            f.write(rootname+'\n')
-            
-def main_make_median_flats(data_dir,prop_ids = 'all'):
+        make_median_from_tile_cache holds, for one chip at a time, the tiles read 
+        from every batch and their concatenation, twice the float32 cube of the 
+        chip, which plan_combine budgets as a 2 chip cube.
+        """
+        
+    if n_files is None:
+        n_files = len(ifiles)
+    dims = get_chip_shape(ifiles[0],1)
+    try:
+        strategy, plan_height = plan_combine(n_files, dims, 2, 'median',
+                                             get_memory_budget())
+    except MemoryError:
+        return False
+    return plan_height >= min(strip_height, dims[0])
+    
+    
+def get_checkpoint_key(manifest, old_manifest, mode, strip_height):
+
+    """Returns the key of the checkpoint of a median flat build (see 
+        QE_pixel_tools.read_checkpoint): a hash of the content of the inputs, the 
+        combine parameters, the cache batches being extended and how the strips 
+        are made."""
+        
+    old_batches = None
+    if old_manifest is not None:
+        old_batches = old_manifest['batches']
+    key = {'files': dict([(path, entry['sha1']) for path, entry in \
+                          manifest['files'].items()]),
+           'params': manifest['params'], 'old_batches': old_batches,
+           'mode': mode, 'strip_height': strip_height}
+    return hashlib.sha1(json.dumps(key, sort_keys = True).encode()).hexdigest()
+    
+    
+def get_cache_batches(cache_dir, ifiles, status, new_files, old_manifest,
+                      clear = True):
+
+    """Returns (old_batches, new_batch, new_files) for updating the tile cache 
+        of a median flat, see make_median_from_tile_cache. If the cache can not be
+        extended (inputs changed, or batches missing) it is cleared (unless clear 
+        is False, when resuming a checkpoint), and every file goes into the new 
+        batch."""
+        
+    old_batches = []
+    if status == 'added':
+        old_batches = old_manifest['batches']
+    if not all([os.path.isdir(os.path.join(cache_dir,batch)) \
+                for batch in old_batches]) or status == 'unchanged':
+        old_batches = []
+    if len(old_batches) == 0:
+        new_files = sorted(ifiles)
+        if clear and os.path.isdir(cache_dir):
+            shutil.rmtree(cache_dir)
+    new_batch = 'batch_{:03d}'.format(len(old_batches))
+    
+    return (old_batches, new_batch, new_files)
+    
+    
+def get_median_flat_path(data_dir, filt):
+
+    """Returns the path of the median flat of a filter."""
+    
+    return data_dir + '/{}/'.format(filt) +'{}_median_flat.fits'.format(filt)
+    
+    
+def write_filter_median_flat(data_dir, filt, ifiles, sci_arrays, dq_arrays, stats = None):
+
+    """Writes the median flat of a filter (with the extensions of stats, see 
+        write_full_frame_uvis_image) and the log of its input files."""
+    
+    outfile_path_dir = data_dir + '/{}/'.format(filt)
+    outfile_path = get_median_flat_path(data_dir, filt)
+    
+    median_array_1, median_array_2= sci_arrays[0],sci_arrays[1]
+    dq_array_1,dq_array_2 = dq_arrays[0],dq_arrays[1]
+        
+    print('Writing out', outfile_path)
+    
+    #make log of files that went into making median flat
+    log_file_path = outfile_path_dir+'/{}_median_flat_log_file.txt'.format(filt)
+    with open(log_file_path,'w') as f:
+        f.write('List of files used to create {}.\n'.format(log_file_path))
+    log_file_names(ifiles,log_file_path)
+
+    write_full_frame_uvis_image(median_array_1,median_array_2,dq_array_1,
+                                dq_array_2,outfile_path,
+                                compression = params()['output_compression']['median_flat'],
+                                stats = stats)
+
+
+@instrumented()
+def main_make_median_flats(data_dir,prop_ids = 'all',workers = 1):
 
     """Main function that makes median flat fields for each filter.
     
+       The input files are listed from the header index (see 
+       header_index.get_indexed_files). A manifest of the input files (path, 
+       size, mtime and sha1) and combine parameters is written next to each 
+       median flat. Filters whose inputs are 
+       unchanged since the last run are skipped, and filters that only gained files
+       are updated from the tile cache (see make_median_from_tile_cache) when 
+       params()['median_cache'] is set.
+    
        Parameters
        ----------
        data_dir : string
@@ -132,109 +492,40 @@ def main_make_median_flats(data_dir,prop_ids = 'all'):
             
             Otherwise, a list of proposal IDs (string, or int) that median flat field 
             should be created from should be supplied.
+            
+       workers : int
+            Number of processes filters are median combined on in parallel.
+            
+       Returns
+       -------
+       failed : list of tuples
+            (name, traceback) of every filter that failed, see run_tasks.
                 
              """
     
     if prop_ids == 'all':
         print('Making median filter flat from all proposals.')
-        dirs = glob.glob(data_dir+'/*/*')
+        all_files = get_indexed_files(data_dir)
     
     else:
         print('Making median filter flat from proposals ', prop_ids)
-        dirs = []
-        for id in prop_ids:
-            dirs += glob.glob(data_dir+'/*/{}'.format(str(id)))
-
-    filters = [item.split('/')[-2] for item in dirs]
-    filters = set(filters)
-
-    for i, filt in enumerate(filters):
+        all_files = get_indexed_files(data_dir, prop_ids = prop_ids)
+    
+    tasks = []
+    for filter_dir, ifiles in group_files(all_files, level = 4).items():
+        filt = os.path.basename(filter_dir)
+        tasks.append(('median flat '+filt, get_file_sizes(ifiles),
+                      make_filter_median_flat, (data_dir, filt, ifiles)))
+                          
+    failed = run_tasks(tasks, workers = workers, max_memory = params()['max_memory'])
+    return failed
     
-        ifiles = []
-        for dir in dirs:
-            if filt in dir:
-                ifiles += glob.glob(dir+'/*/*/*flt.fits')
-                
-        if len(ifiles) > 0:
-            if len(ifiles) < 150:
-                print('Making median filter flat for ' + filt)
-                print('Using {} files'.format(len(ifiles)))
-                sci_arrays,dq_arrays = make_avg_flat_array(ifiles,'median',[1,2],
-                                                           combine_dq_arrays = True,
-                                                           mask_dq_each = False)
-                                                           
-                median_array_1, median_array_2= sci_arrays[0],sci_arrays[1]
-                dq_array_1,dq_array_2 = dq_arrays[0],dq_arrays[1]
-
-            else:
-                print('Making median filter flat for ' + filt)
-                print('Using {} files. Creating temp files.'.format(len(ifiles)))
-                write_temp_split_files(ifiles)
-                print('All temp files created.')
-                
-                ifiles_chip1A = glob.glob(dirs[i]+'/*/*/*chip1_A*.temp')
-                ifiles_chip1B = glob.glob(dirs[i]+'/*/*/*chip1_B*.temp')
-                ifiles_chip1C = glob.glob(dirs[i]+'/*/*/*chip1_C*.temp')
-                ifiles_chip1D = glob.glob(dirs[i]+'/*/*/*chip1_D*.temp')
-                
-                ifiles_chip2A = glob.glob(dirs[i]+'/*/*/*chip2_A*.temp')
-                ifiles_chip2B = glob.glob(dirs[i]+'/*/*/*chip2_B*.temp')
-                ifiles_chip2C = glob.glob(dirs[i]+'/*/*/*chip2_C*.temp')
-                ifiles_chip2D = glob.glob(dirs[i]+'/*/*/*chip2_D*.temp')
-                
-                m1A,dq1A = make_avg_flat_array(ifiles_chip1A,'median',[1],
-                           combine_dq_arrays = False,mask_dq_each = True)
-                m1B,dq1B= make_avg_flat_array(ifiles_chip1B,'median',[1],
-                          combine_dq_arrays = False,mask_dq_each = True)
-                m1C,dq1C= make_avg_flat_array(ifiles_chip1C,'median',[1],
-                          combine_dq_arrays = False,mask_dq_each = True)
-                m1D,dq1D= make_avg_flat_array(ifiles_chip1D,'median',[1],
-                          combine_dq_arrays = False,mask_dq_each = True)
-                
-                m2A,dq2A = make_avg_flat_array(ifiles_chip2A,'median',[2],
-                           combine_dq_arrays = False,mask_dq_each = True)
-                m2B,dq2B = make_avg_flat_array(ifiles_chip2B,'median',[2],
-                           combine_dq_arrays = False,mask_dq_each = True)
-                m2C,dq2C = make_avg_flat_array(ifiles_chip2C,'median',[2],
-                           combine_dq_arrays = False,mask_dq_each = True)
-                m2D,dq2D = make_avg_flat_array(ifiles_chip2D,'median',[2],
-                           combine_dq_arrays = False,mask_dq_each = True)
-
-                #recombine to full frame to write out 
-                median_array_1 = np.hstack((np.vstack((m1A[0],m1C[0])),
-                                 np.vstack((m1B[0],m1D[0]))))
-                median_array_2 = np.hstack((np.vstack((m2A[0],m2C[0])),
-                                 np.vstack((m2B[0],m2D[0]))))
-                
-                dq_array_1 = np.hstack((np.vstack((dq1A[0],dq1C[0])),
-                             np.vstack((dq1B[0],dq1D[0]))))
-                dq_array_2 = np.hstack((np.vstack((dq2A[0],dq2C[0])),
-                             np.vstack((dq2B[0],dq2D[0]))))
-                
-                #remove temporary files 
-                print('Removing temporary spliced files.')
-                all_temp =ifiles_chip1A+ifiles_chip1B+ifiles_chip2A+ifiles_chip2B
-                
-                for item in all_temp:
-                    os.remove(item)           
-                
-            outfile_path_dir = data_dir + '/{}/'.format(filt)
-            outfile_path = outfile_path_dir +'{}_median_flat.fits'.format(filt)
-            print('Writing out', outfile_path)
-            
-            #make log of files that went into making median flat
-            log_file_path = outfile_path_dir+'/{}_median_flat_log_file.txt'.format(filt)
-            with open(log_file_path,'w') as f:
-                f.write('List of files used to create {}.\n'.format(log_file_path))
-            log_file_names(ifiles,log_file_path)
-
-            write_full_frame_uvis_image(median_array_1,median_array_2,dq_array_1,
-                                        dq_array_2,outfile_path)
-                
 
 if __name__ == '__main__':
 
     data_dir = paths()['data_dir']
-    main_make_median_flats(data_dir,prop_ids='all')
+    failed = main_make_median_flats(data_dir,prop_ids='all')
+    if len(failed) > 0:
+        sys.exit(1)
     
 
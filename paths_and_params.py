@@ -4,9 +4,106 @@ def paths():
     dict = {'prop_ids':[13169,13585,14027,14389,14546],
             'data_dir': base_path+'data',
             'new_data_dir': base_path+'new_data',
-            'anneal_info_dir':base_path+'anneal_info'
+            'anneal_info_dir':base_path+'anneal_info',
+            'header_index': base_path+'/header_index.db',
+            'pipeline_state': base_path+'/pipeline_state.json'
            }
     
     return dict
 
-  
+def params():
+
+    """Tuning parameters for the pipeline.
+    
+        strip_height: number of detector rows in each tile of the median flat 
+            tile cache.
+            
+        median_cache: if True, median flats keep a per-tile cache of their inputs
+            on disk (filter_dir/median_cache) so that adding new files only 
+            requires reading the new FITS files. The cache holds a float32 copy of 
+            the SCI data of every input file, about as much disk as the SCI 
+            extensions of the FLTs themselves, and every update still reads the
+            whole cache back (all batches of every tile), so I/O per update grows
+            with the number of files of the filter; it only saves the FITS 
+            decoding of the old files. Off by default.
+            
+        max_memory: memory in bytes the combine steps may use (shared between
+            parallel workers). Without the tile cache, median flats are combined 
+            in memory or in strips depending on what fits (see 
+            QE_pixel_tools.plan_combine). If None, 80% of the physical memory of 
+            the node. Each pool worker's share is also set as its RLIMIT_AS (see 
+            task_pool.limit_worker_memory), which caps virtual memory: memory 
+            mapped FITS reads, thread stacks and malloc arenas count against it,
+            so leave headroom above the arrays the combine holds.
+            
+        io_threads: number of threads used to read FITS headers, and at most 
+            to read ahead FITS data.
+            
+        read_ahead: number of files (or strips) the combine steps read ahead on
+            background threads (see fits_reader.PrefetchReader). Each file read 
+            ahead of a full frame combine holds one frame of SCI and DQ data. 0 
+            turns read-ahead off.
+        
+        chip_cache_bytes: size of the in-memory cache (per process) of arrays 
+            read with QE_pixel_tools.load_chip and of derived products like the 
+            masked median flats, see QE_pixel_tools.get_cached.
+            
+        pixel_history: if True, every visit mean flat is also added to the pixel
+            history store of its filter (see pixel_history.py).
+            
+        anom_output: format of the low QE pixel lists. 'table' for one binary 
+            table per filter (see find_anom_pixels.load_anom_table), 'dat' for a 
+            text file per epoch and threshold, or 'both'.
+            
+        output_compression: tile compression of the median flats and visit mean
+            flats. For each product, None (uncompressed), 'lossless' (float32, 
+            GZIP) or a quantize level, e.g. 16 (float32 quantized to 1/16 of the 
+            noise, RICE). See QE_pixel_tools.write_full_frame_uvis_image.
+            
+        watch_poll_s, watch_settle_s, watch_debounce_s, watch_median_interval_s: 
+            watch mode (see watch_new_data.py). Seconds between polls of 
+            new_data_dir, that a file must be unchanged before it is read, that a 
+            visit must get no new files before it is processed, and between 
+            rebuilds of the median flats.
+            
+        dq_bad_bits: DQ flags (bits) that make a pixel bad, where the visit mean
+            flats and the anomalous pixel search mask pixels. 0xFFFF masks any 
+            flagged pixel. See dq_flags.py.
+            
+        sigma_clip_sigma, sigma_clip_iters: clipping threshold (in standard 
+            deviations) and maximum number of iterations of the 'sigma_clip' 
+            combine, see QE_pixel_tools.sigma_clip_cube.
+            
+        median_flat_stats: other statistics of each pixel's input values written 
+            as extra extensions of the median flats, taken from the data sorted 
+            for the median (see QE_pixel_tools.get_cube_stats): 'mad', 'n_valid'
+            and percentiles such as 'p16'. Empty to write SCI and DQ only.
+            
+        anom_min_significance: if set, pixels are only reported as anomalous if 
+            their deviation from the median flat is at least this many sigma, 
+            with sigma = 1.4826 * MAD of the median flat (which must have 'mad' 
+            in median_flat_stats, checked when the anomalous pixel search 
+            starts). See find_anom_pixels.get_significance_images.
+    """
+
+    dict = {'strip_height': 64,
+            'median_cache': False,
+            'max_memory': None,
+            'io_threads': 8,
+            'read_ahead': 2,
+            'chip_cache_bytes': 512 * 2**20,
+            'pixel_history': True,
+            'anom_output': 'table',
+            'output_compression': {'median_flat': None, 'mean_flat': None},
+            'watch_poll_s': 30,
+            'watch_settle_s': 60,
+            'watch_debounce_s': 600,
+            'watch_median_interval_s': 86400,
+            'dq_bad_bits': 0xFFFF,
+            'sigma_clip_sigma': 3.,
+            'sigma_clip_iters': 5,
+            'median_flat_stats': [],
+            'anom_min_significance': None
+           }
+    
+    return dict
@@ -0,0 +1,229 @@
+import fcntl
+import glob
+import json
+import os
+import shutil
+import numpy as np
+from QE_pixel_tools import open_fits
+from dq_flags import as_dq
+
+""" Per filter store of the history of every pixel over all visits (epochs), so the
+	evolution of a pixel or region can be read without opening any FITS files.
+	
+	The store is a directory with one file per (chip, spatial chunk). Each chunk 
+	file is a raw float32 array of shape (n_epochs, chunk_y, chunk_x) that grows by
+	one slab every time an epoch is appended, and is read back with np.memmap. 
+	Stores made with DQ arrays keep, next to each chunk file, a uint16 array of the
+	DQ flags of the same pixels (.dq), so pixels can be masked with any set of bad
+	bits without opening the mean flats. history.json lists the epochs in the order
+	they were appended. Appends take a lock on the store so parallel workers can 
+	write to the same filter.
+	
+"""
+
+CHUNK_SHAPE = (256,256)
+
+def get_history_dir(filter_dir):
+
+    """Directory of the pixel history store of a filter."""
+    
+    return os.path.join(filter_dir,'pixel_history')
+    
+def read_history_index(store_dir):
+
+    """Reads history.json, returns None if the store does not exist yet."""
+    
+    index_path = os.path.join(store_dir,'history.json')
+    if not os.path.isfile(index_path):
+        return None
+    with open(index_path,'r') as f:
+        return json.load(f)
+        
+def write_history_index(store_dir, index):
+
+    index_path = os.path.join(store_dir,'history.json')
+    with open(index_path+'.tmp','w') as f:
+        json.dump(index, f, indent = 1)
+    os.rename(index_path+'.tmp',index_path)
+    
+def get_chunks(index):
+
+    """Yields (chip, y0, y1, x0, x1, chunk file name) of every chunk in the store."""
+    
+    ny, nx = index['chip_shape']
+    cy, cx = index['chunk_shape']
+    for chip in index['chips']:
+        for y0 in range(0,ny,cy):
+            for x0 in range(0,nx,cx):
+                yield (chip, y0, min(y0+cy,ny), x0, min(x0+cx,nx),
+                       'chip{}_y{}_x{}.bin'.format(chip,y0,x0))
+                       
+def write_slab(chunk_path, data, n_epochs, i):
+
+    """Writes the slab data of epoch i to a chunk file of n_epochs slabs, 
+        replacing the slab if it exists."""
+        
+    #not append mode, which would write every slab at the end of the file
+    with open(chunk_path,'r+b' if os.path.isfile(chunk_path) else 'w+b') as f:
+        #drop anything past the last indexed epoch (an interrupted append)
+        f.truncate(n_epochs * data.nbytes)
+        f.seek(i * data.nbytes)
+        f.write(data.tobytes())
+        
+def append_epoch(store_dir, epoch_key, sci_arrays, chips = [1,2], dq_arrays = None,
+                 **epoch_info):
+
+    """Adds an epoch (a visit mean flat) to the pixel history store. If epoch_key
+        is already in the store, its values are replaced instead.
+        
+        Parameters
+        ----------
+        
+        store_dir: string
+            Directory of the store, created if needed.
+            
+        epoch_key: string
+            Unique name of the epoch, e.g. 'proposal/anneal_mjd/visit_date'.
+            
+        sci_arrays: list of arrays
+            Science arrays of the epoch for each chip in chips.
+            
+        dq_arrays: list of arrays
+            DQ arrays of the epoch for each chip in chips. A new store keeps DQ 
+            flags if its first epoch has them, and then every epoch must.
+            
+        epoch_info:
+            Extra information stored with the epoch (e.g. anneal_mjd, date_obs).
+            
+    """
+    
+    if not os.path.isdir(store_dir):
+        os.makedirs(store_dir)
+        
+    with open(os.path.join(store_dir,'lock'),'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        
+        index = read_history_index(store_dir)
+        if index is None:
+            index = {'chip_shape': list(sci_arrays[0].shape), 'chips': list(chips),
+                     'chunk_shape': list(CHUNK_SHAPE), 'dtype': 'float32',
+                     'dq': dq_arrays is not None, 'epochs': []}
+        if index.get('dq', False) and dq_arrays is None:
+            raise ValueError('The pixel history in {} keeps DQ flags, epoch {} has '
+                             'none.'.format(store_dir, epoch_key))
+                     
+        keys = [epoch['key'] for epoch in index['epochs']]
+        if epoch_key in keys:
+            i = keys.index(epoch_key)
+        else:
+            i = len(keys)
+            
+        for chip, y0, y1, x0, x1, chunk_name in get_chunks(index):
+            j = index['chips'].index(chip)
+            chunk_path = os.path.join(store_dir,chunk_name)
+            write_slab(chunk_path, np.ascontiguousarray(sci_arrays[j][y0:y1,x0:x1],
+                       dtype = np.float32), len(keys), i)
+            if index.get('dq', False):
+                write_slab(get_dq_chunk_path(chunk_path), np.ascontiguousarray(
+                           as_dq(dq_arrays[j][y0:y1,x0:x1])), len(keys), i)
+                
+        epoch = {'key': epoch_key}
+        epoch.update(epoch_info)
+        if i == len(keys):
+            index['epochs'].append(epoch)
+        else:
+            index['epochs'][i] = epoch
+        write_history_index(store_dir, index)
+        
+def get_dq_chunk_path(chunk_path):
+
+    """Path of the DQ flags of a chunk file."""
+    
+    return chunk_path[:-len('.bin')]+'.dq'
+    
+def read_region(store_dir, index, chip, y0, y1, x0, x1, dq = False):
+
+    """Reads the region [y0:y1, x0:x1] of a chip from the chunk files (or their
+        DQ flags), in the order the epochs were appended."""
+        
+    n_epochs = len(index['epochs'])
+    dtype = np.uint16 if dq else np.float32
+    region = np.empty((n_epochs,y1-y0,x1-x0),dtype=dtype)
+    
+    for c, cy0, cy1, cx0, cx1, chunk_name in get_chunks(index):
+        if c != chip or cy1 <= y0 or cy0 >= y1 or cx1 <= x0 or cx0 >= x1:
+            continue
+        chunk_path = os.path.join(store_dir,chunk_name)
+        if dq:
+            chunk_path = get_dq_chunk_path(chunk_path)
+        chunk = np.memmap(chunk_path, dtype = dtype, mode = 'r', 
+                          shape = (n_epochs,cy1-cy0,cx1-cx0))
+        ry0, ry1 = max(y0,cy0), min(y1,cy1)
+        rx0, rx1 = max(x0,cx0), min(x1,cx1)
+        region[:,ry0-y0:ry1-y0,rx0-x0:rx1-x0] = chunk[:,ry0-cy0:ry1-cy0,rx0-cx0:rx1-cx0]
+        del chunk
+    return region
+    
+def get_region_history(store_dir, chip, y0, y1, x0, x1, dq = False):
+
+    """Returns the history of the region [y0:y1, x0:x1] of a chip.
+    
+        Returns
+        -------
+        
+        epochs: list of dicts
+            Information of each epoch, sorted by date_obs (if stored).
+            
+        history: array
+            float32 array of shape (n_epochs, y1-y0, x1-x0).
+            
+        dq_history: array
+            Only if dq is True: uint16 array of the DQ flags of the same pixels
+            (see has_dq).
+            
+    """
+    
+    index = read_history_index(store_dir)
+    n_epochs = len(index['epochs'])
+    history = read_region(store_dir, index, chip, y0, y1, x0, x1)
+    
+    order = sorted(range(n_epochs), key = lambda i: index['epochs'][i].get('date_obs',''))
+    epochs = [index['epochs'][i] for i in order]
+    if dq:
+        dq_history = read_region(store_dir, index, chip, y0, y1, x0, x1, dq = True)
+        return (epochs, history[order], dq_history[order])
+    return (epochs, history[order])
+    
+def has_dq(store_dir):
+
+    """Returns True if the pixel history store keeps the DQ flags of its epochs."""
+    
+    index = read_history_index(store_dir)
+    return index is not None and index.get('dq', False)
+    
+def get_pixel_history(store_dir, chip, y, x):
+
+    """Returns (epochs, values) for one pixel, see get_region_history."""
+    
+    epochs, history = get_region_history(store_dir, chip, y, y+1, x, x+1)
+    return (epochs, history[:,0,0])
+
+def rebuild_history(filter_dir):
+
+    """Creates the pixel history store of a filter, with DQ flags, from the visit 
+        mean flats already in its directory (e.g. flats made before the store 
+        existed). A store already there is replaced."""
+        
+    store_dir = get_history_dir(filter_dir)
+    if os.path.isdir(store_dir):
+        shutil.rmtree(store_dir)
+    mean_flats = sorted(glob.glob(filter_dir+'/*/*/*/mean_flat_*.fits'))
+    for mean_flat in mean_flats:
+        visit_dir = os.path.dirname(mean_flat)
+        prop_id, anneal_mjd, visit_date = visit_dir.split('/')[-3:]
+        print('Adding', os.path.basename(mean_flat), 'to the pixel history.')
+        sci_arrays, dq_arrays = open_fits(mean_flat,[1,2],DQ=True)
+        append_epoch(store_dir, '/'.join([prop_id,anneal_mjd,visit_date]),
+                     sci_arrays, dq_arrays = dq_arrays, anneal_mjd = anneal_mjd,
+                     date_obs = visit_date, prop_id = prop_id)
+    return store_dir
@@ -0,0 +1,209 @@
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+from paths_and_params import paths
+
+""" Command line interface of the QE pixel monitor.
+
+	    python qe_pixels.py <subcommand> [options]
+	    
+	Subcommands: run, update-anneals, sort, index, median, visit-means, find-anom,
+	watch and status. Each subcommand imports the modules it needs when it runs, so that
+	cheap subcommands (status, update-anneals) do not load astropy, numpy or the
+	pipeline stages.
+	
+	Subcommands that run pipeline tasks return the tasks that failed, and the
+	command exits with status 1 if there are any.
+	
+"""
+
+def cmd_run(args):
+
+    from wrapper_run_QE_pixels import main_run_QE_pixels
+    from watch_new_data import main_watch_new_data
+    
+    pathss = paths()
+    failed = main_run_QE_pixels(pathss, workers = args.workers, dry_run = args.dry_run)
+    if args.watch and not args.dry_run:
+        main_watch_new_data(pathss)
+    return failed
+    
+def cmd_update_anneals(args):
+
+    from download_new_anneal_file import main_update_anneal_file
+    
+    main_update_anneal_file(paths()['anneal_info_dir'])
+    
+def cmd_sort(args):
+
+    from sort_new_data import main_sort_new_data
+    
+    main_sort_new_data(paths())
+    
+def cmd_index(args):
+
+    from header_index import backfill_index, get_index_path
+    
+    data_dir = paths()['data_dir']
+    backfill_index(get_index_path(data_dir), data_dir)
+    
+def cmd_median(args):
+
+    from make_median_filter_flats import main_make_median_flats
+    
+    prop_ids = 'all' if args.prop_ids is None else args.prop_ids
+    return main_make_median_flats(paths()['data_dir'], prop_ids = prop_ids,
+                                  workers = args.workers)
+                                  
+def cmd_visit_means(args):
+
+    from make_mean_visit_flats import main_make_mean_visit_flats
+    
+    return main_make_mean_visit_flats(paths()['data_dir'], workers = args.workers)
+    
+def cmd_find_anom(args):
+
+    from find_anom_pixels import main_find_anom_pixels
+    
+    return main_find_anom_pixels(paths()['data_dir'], mask_border = not args.no_mask_border,
+                                 workers = args.workers)
+                                 
+def cmd_watch(args):
+
+    from watch_new_data import main_watch_new_data
+    
+    main_watch_new_data(paths())
+    
+def get_status(pathss):
+
+    """Returns a summary of the data directory from file names, file times and
+        the JSON manifests only: the files waiting in new_data_dir, and for each
+        filter its files, visits and flats."""
+        
+    data_dir = pathss['data_dir']
+    status = {'new_files': len(glob.glob(pathss['new_data_dir']+'/*flt.fits')),
+              'filters': []}
+              
+    for filter_dir in sorted(glob.glob(data_dir+'/*/')):
+        filter_dir = filter_dir.rstrip('/')
+        filt = os.path.basename(filter_dir)
+        ifiles = glob.glob(filter_dir+'/*/*/*/*flt.fits')
+        visit_dirs = set([os.path.dirname(ifile) for ifile in ifiles])
+        mean_flats = glob.glob(filter_dir+'/*/*/*/mean_flat_*.fits')
+        
+        median_flat = filter_dir+'/{}_median_flat.fits'.format(filt)
+        manifest_path = filter_dir+'/{}_median_flat_manifest.json'.format(filt)
+        median = 'missing'
+        if os.path.isfile(median_flat):
+            median = time.strftime('%Y-%m-%d %H:%M',
+                                   time.localtime(os.path.getmtime(median_flat)))
+            if os.path.isfile(manifest_path):
+                with open(manifest_path,'r') as f:
+                    n_new = len(set(ifiles) - set(json.load(f)['files']))
+                if n_new > 0:
+                    median += ' ({} new files)'.format(n_new)
+                    
+        journal_path = filter_dir+'/median_checkpoint/journal.json'
+        if os.path.isfile(journal_path):
+            with open(journal_path,'r') as f:
+                median += ' (interrupted build, {} strips done)'.format(
+                          len(json.load(f)['done']))
+                          
+        status['filters'].append({'filter': filt, 'files': len(ifiles),
+                                  'visits': len(visit_dirs),
+                                  'mean_flats': len(mean_flats), 'median_flat': median,
+                                  'anom_table': os.path.isfile(filter_dir+
+                                  '/results/{}_anom_pixels.npy'.format(filt))})
+                                  
+    return status
+    
+def cmd_status(args):
+
+    pathss = paths()
+    status = get_status(pathss)
+    
+    print('{} files waiting in {}'.format(status['new_files'], pathss['new_data_dir']))
+    print('{:<8} {:>7} {:>7} {:>11} {:>11}  {}'.format('filter','files','visits',
+          'mean flats','anom table','median flat'))
+    for row in status['filters']:
+        print('{:<8} {:>7} {:>7} {:>11} {:>11}  {}'.format(row['filter'],row['files'],
+              row['visits'],row['mean_flats'],'yes' if row['anom_table'] else 'no',
+              row['median_flat']))
+              
+    if os.path.isfile(pathss['pipeline_state']):
+        with open(pathss['pipeline_state'],'r') as f:
+            state = json.load(f)
+        print('Stage graph: {} nodes built, state updated {}.'.format(
+              len(state['nodes']), time.strftime('%Y-%m-%d %H:%M',
+              time.localtime(os.path.getmtime(pathss['pipeline_state'])))))
+              
+def get_parser():
+
+    parser = argparse.ArgumentParser(prog = 'qe-pixels',
+                                     description = 'QE pixel monitor of WFC3/UVIS.')
+    parser.add_argument('--report', default = None,
+                        help = 'append per-stage timings, I/O and memory to this '
+                        'JSON lines file')
+    parser.add_argument('--profile-dir', default = None,
+                        help = 'write cProfile stats of the combine steps here')
+    subparsers = parser.add_subparsers(dest = 'command')
+    subparsers.required = True
+    
+    def add_command(name, func, help, workers = False):
+        subparser = subparsers.add_parser(name, help = help)
+        subparser.set_defaults(func = func)
+        if workers:
+            subparser.add_argument('--workers', type = int, default = 1,
+                                   help = 'number of processes filters / visits '
+                                   'are run on')
+        return subparser
+        
+    run = add_command('run', cmd_run, 'run the whole pipeline, rebuilding only '
+                      'out of date products', workers = True)
+    run.add_argument('--dry-run', action = 'store_true',
+                     help = 'print what would be rebuilt and the estimated cost, '
+                     'without running anything')
+    run.add_argument('--watch', action = 'store_true',
+                     help = 'after the run, keep watching new_data_dir')
+                     
+    add_command('update-anneals', cmd_update_anneals,
+                'download the anneal dates and update anneal_mjds.txt')
+    add_command('sort', cmd_sort, 'sort new_data_dir into the data directory')
+    add_command('index', cmd_index, 'rebuild the header index from the data directory')
+    
+    median = add_command('median', cmd_median, 'make the median flat of each filter',
+                         workers = True)
+    median.add_argument('--prop-ids', nargs = '+', default = None,
+                        help = 'proposals to use, default all')
+                        
+    add_command('visit-means', cmd_visit_means, 'make the mean flat of each visit',
+                workers = True)
+                
+    find_anom = add_command('find-anom', cmd_find_anom, 'find low QE pixels in each '
+                            'visit mean flat', workers = True)
+    find_anom.add_argument('--no-mask-border', action = 'store_true',
+                           help = 'do not mask the top and bottom rows of the chips')
+                           
+    add_command('watch', cmd_watch, 'watch new_data_dir and process new visits')
+    add_command('status', cmd_status, 'summarize the data directory and flats')
+    
+    return parser
+    
+def main(argv = None):
+
+    args = get_parser().parse_args(argv)
+    
+    if args.report is not None:
+        from instrumentation import start_run
+        start_run(args.report, profile_dir = args.profile_dir)
+        
+    failed = args.func(args)
+    if failed is not None and len(failed) > 0:
+        sys.exit(1)
+        
+if __name__ == '__main__':
+
+    main()
@@ -1,21 +1,16 @@
-from astropy.io import fits
-from astropy.time import Time
 import glob
 import os
 from paths_and_params import *
+from header_index import scan_headers, update_index, get_index_path, ensure_backfilled
+from anneal_calendar import AnnealCalendar
+from instrumentation import instrumented
 import shutil
     
 def open_anneal_mjd_list():
 
     """Opens anneal_mjds.txt and returns a list of anneal dates (in MJD)."""
     
-    anneal_mjds = []
-    with open('anneal_mjds.txt','r') as f:
-        anneal_mjds = f.readlines()
-     
-    anneal_mjds = [item.replace('\n','') for item in anneal_mjds]
-        
-    return anneal_mjds
+    return list(AnnealCalendar.load().labels)
     
 def get_nearest_anneal_date(mjd,anneal_mjds):
     
@@ -35,16 +30,12 @@ def get_nearest_anneal_date(mjd,anneal_mjds):
         
         """
 
-    anneal_mjds = ['0'] + anneal_mjds
-
-    for i in range(len(anneal_mjds)-1):
-        if (mjd > float(anneal_mjds[i]))  & (mjd <= float(anneal_mjds[i+1])):
-            nearest_anneal_mjd = anneal_mjds[i+1]
-            return nearest_anneal_mjd
+    return AnnealCalendar(anneal_mjds).nearest_anneal(mjd)
                 
 def get_info_new_files(new_files):
 
-    """Opens up each new files and retrieves header information needed for sorting.
+    """Reads the primary header of each new file and retrieves the information 
+        needed for sorting. Headers are read on a pool of threads.
     
         Parameters
         ----------
@@ -55,44 +46,46 @@ def get_info_new_files(new_files):
         -------
             new_files_info : list of tuples
                 For each file path, a tuple containing 
-                (file_path, filter, proposal_id, nearest_anneal_mjd, date_obs(iso)).
+                (file_path, filter, proposal_id, nearest_anneal_mjd, date_obs(iso),
+                mjd, size).
         
         """
-    anneal_mjds = open_anneal_mjd_list()
-    new_files_info = []
+    headers_info = scan_headers(new_files, threads = params()['io_threads'])
     
-    for f in new_files:
-        hdr = fits.open(f)[0].header 
-        filter_name = hdr['FILTER']
-        prop_id = hdr['PROPOSID']
-        date_obs = fits.open(f)[0].header['DATE-OBS']
-        t = Time(date_obs,format = 'iso')
-        #find nearest anneal date
-        nearest_anneal_mjd = get_nearest_anneal_date(t.mjd,anneal_mjds)
-        new_files_info.append((f,filter_name,str(prop_id),nearest_anneal_mjd,date_obs))
+    #find nearest anneal date of all files at once
+    mjds = [header_info[4] for header_info in headers_info]
+    nearest_anneal_mjds = AnnealCalendar.load().assign(mjds)
+    
+    new_files_info = []
+    for header_info, nearest_anneal_mjd in zip(headers_info, nearest_anneal_mjds):
+        f, filter_name, prop_id, date_obs, mjd, size = header_info
+        new_files_info.append((f,filter_name,prop_id,nearest_anneal_mjd,date_obs,mjd,
+                               size))
             
     return new_files_info
     
                 
 def make_dirs_move_files(new_files_info,data_dir):
 
-    """Opens up each new files and retrieves header information needed for sorting.
+    """Moves each new file to data_dir/filter/proposal_id/anneal_mjd/date_obs.
     
         Parameters
         ----------
-            new_files : list of strings 
-                List of paths of all _flt.fits files in the new_data directory.
+            new_files_info : list of tuples
+                Output of get_info_new_files.
                 
         Returns
         -------
-            new_files_info : list of tuples
-                For each file path, a tuple containing 
-                (file_path, filter, proposal_id, nearest_anneal_mjd, date_obs(iso)).
+            moved_files_info : list of tuples
+                Same as new_files_info, with file_path replaced by the new location
+                of the file.
         
         """
     
+    moved_files_info = []
+    
     for item in new_files_info:
-        file_path, filt, prop_id, nearest_anneal_mjd, date_obs = item
+        file_path, filt, prop_id, nearest_anneal_mjd, date_obs = item[:5]
         dest=data_dir+'/{0}/{1}/{2}/{3}'.format(filt,prop_id,nearest_anneal_mjd,date_obs)
         
         if not os.path.isdir(dest):
@@ -100,17 +93,48 @@ def make_dirs_move_files(new_files_info,data_dir):
         
         print('moving',os.path.basename(file_path),'to',dest)
         shutil.move(file_path,dest)
+        moved_files_info.append((os.path.join(dest,os.path.basename(file_path)),) + \
+                                tuple(item[1:]))
+                                
+    return moved_files_info
+
+def sort_files(paths, new_files_info):
 
+    """Moves files into the data directory and records them in the header index.
+        new_files_info is the output of get_info_new_files, returns the output 
+        of make_dirs_move_files. Files taken after the last anneal in 
+        anneal_mjds.txt have no anneal epoch yet, and are left where they are."""
+        
+    for item in new_files_info:
+        if item[3] is None:
+            print('{} was taken after the last known anneal, leaving it until the '
+                  'anneal dates are updated.'.format(os.path.basename(item[0])))
+    new_files_info = [item for item in new_files_info if item[3] is not None]
+    
+    #index the files already in the data directory before adding new ones
+    index_path = get_index_path(paths['data_dir'])
+    ensure_backfilled(index_path, paths['data_dir'])
+    
+    moved_files_info = make_dirs_move_files(new_files_info,paths['data_dir'])
+    
+    #path, filter, proposal_id, date_obs, mjd, anneal_mjd, size
+    rows = [(item[0],item[1],item[2],item[4],item[5],item[3],item[6]) \
+            for item in moved_files_info]
+    update_index(index_path, rows)
+    return moved_files_info
+    
+@instrumented()
 def main_sort_new_data(paths):
 
+    """Sorts the files in new_data_dir into the data directory, and records them 
+        in the header index (see header_index.query_index)."""
     
-    new_data_dir,data_dir = paths['new_data_dir'],paths['data_dir']
+    new_data_dir = paths['new_data_dir']
     new_files = glob.glob(new_data_dir+'/*flt.fits')
     new_files_info = get_info_new_files(new_files)
-    make_dirs_move_files(new_files_info,data_dir)
+    sort_files(paths, new_files_info)
     
 if __name__ == '__main__':
 
     paths = paths()
     main_sort_new_data(paths)   
-
@@ -0,0 +1,390 @@
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+from paths_and_params import paths, params
+from task_pool import run_tasks
+from instrumentation import instrumented
+from header_index import get_indexed_files, group_files
+from make_median_filter_flats import build_input_manifest, make_filter_median_flat, \
+     get_median_flat_path
+from make_mean_visit_flats import make_mean_visit_flat, get_mean_flat_path
+from make_filter_flats import make_filter_flats
+from find_anom_pixels import find_anom_pixels_multi, combine_anom_table, get_bands, \
+     get_output_path, get_table_part_path, check_significance_params
+     
+""" Make-style dependency tracking for the products of the pipeline.
+
+	Every unit of work (one filter's median flat, one visit's mean flat, one
+	visit's anomalous pixels, one filter's anomalous pixel table) is a node that
+	declares its input files, the parameters it depends on and its output files.
+	The fingerprint of a node is the sha1 of the content hashes of its inputs and
+	its parameters. A node is rebuilt if its fingerprint differs from the last
+	successful build, if an output is missing, or if one of its inputs is the
+	output of a node that is being rebuilt. Everything else is skipped.
+	
+	Fingerprints, the content hashes of the files (recomputed only when their size
+	or modification time change) and the measured speed of each stage are kept in
+	the state file, paths()['pipeline_state'].
+	
+"""
+
+def make_node(name, stage, func, args, inputs, outputs, node_params = None):
+
+    """Returns a node of the stage graph (a dict).
+    
+        Parameters
+        ----------
+        
+        name: string
+            Unique name of the node.
+            
+        stage: string
+            Stage the node is run in. Nodes of a stage are run together (in
+            parallel), stages are run in the order their first node is given.
+            
+        func, args:
+            The work of the node is func(*args).
+            
+        inputs, outputs: lists of strings
+            Paths of the files the node reads and writes.
+            
+        node_params: dict
+            Parameters (JSON serializable) the outputs depend on.
+            
+    """
+    
+    return {'name': name, 'stage': stage, 'func': func, 'args': args,
+            'inputs': sorted(inputs), 'outputs': list(outputs),
+            'params': node_params or {}}
+            
+def read_state(state_path):
+
+    """Reads the state of the stage graph, empty if it was never run."""
+    
+    if not os.path.isfile(state_path):
+        return {'files': {}, 'nodes': {}, 'rates': {}}
+    with open(state_path,'r') as f:
+        return json.load(f)
+        
+def write_state(state, state_path):
+
+    #write then rename, so an interrupted write leaves the old state
+    tmp_path = state_path + '.tmp'
+    with open(tmp_path,'w') as f:
+        json.dump(state, f, indent = 1, sort_keys = True)
+    os.rename(tmp_path, state_path)
+    
+def node_fingerprint(node, state):
+
+    """Returns the fingerprint of a node from the content of its inputs, or None
+        if an input does not exist. Content hashes are taken from (and added to)
+        state['files']."""
+        
+    if not all([os.path.isfile(path) for path in node['inputs']]):
+        return None
+        
+    files = build_input_manifest(node['inputs'], {}, {'files': state['files']})['files']
+    state['files'].update(files)
+    
+    sha = hashlib.sha1()
+    for path in node['inputs']:
+        sha.update((path + files[path]['sha1']).encode())
+    sha.update(json.dumps(node['params'], sort_keys = True).encode())
+    return sha.hexdigest()
+    
+def get_input_bytes(node):
+
+    return sum([os.path.getsize(path) for path in node['inputs'] \
+                if os.path.isfile(path)])
+                
+def find_stale_nodes(nodes, state):
+
+    """Returns the nodes that need to be rebuilt, in order, as (node, reason)
+        tuples."""
+        
+    stale = []
+    stale_outputs = set()
+    
+    for node in nodes:
+        reason = None
+        if any([path in stale_outputs for path in node['inputs']]):
+            reason = 'upstream rebuilt'
+        elif node['name'] not in state['nodes']:
+            reason = 'new'
+        else:
+            fingerprint = node_fingerprint(node, state)
+            if fingerprint is None:
+                reason = 'inputs missing'
+            elif fingerprint != state['nodes'][node['name']]:
+                reason = 'inputs changed'
+            elif not all([os.path.isfile(path) for path in node['outputs']]):
+                reason = 'outputs missing'
+                
+        if reason is not None:
+            stale.append((node, reason))
+            stale_outputs.update(node['outputs'])
+            
+    return stale
+    
+def print_plan(stale, n_nodes, state):
+
+    """Prints the nodes that would be rebuilt and the estimated cost: bytes read
+        and, for stages run before, time at the speed measured last run."""
+        
+    print('{} of {} nodes would be rebuilt.'.format(len(stale), n_nodes))
+    
+    total_bytes, total_s = 0, 0.
+    for node, reason in stale:
+        nbytes = get_input_bytes(node)
+        total_bytes += nbytes
+        rate = state['rates'].get(node['stage'])
+        estimate = ''
+        if rate is not None:
+            total_s += rate * nbytes
+            estimate = '~{:.0f} s'.format(rate * nbytes)
+        print('  {:<12} {:<60} {:<17} {:>8.1f} MB {}'.format(node['stage'],
+              node['name'], reason, nbytes / 2.**20, estimate))
+              
+    print('Estimated cost: {:.1f} MB read, ~{:.0f} s (stages with a measured speed'
+          ' only; inputs made upstream are not counted).'.format(
+          total_bytes / 2.**20, total_s))
+          
+def get_tasks(stale_nodes):
+
+    """Returns (task, node names) for each stale node: tasks as in task_pool."""
+    
+    return [((node['name'], get_input_bytes(node), node['func'], node['args']),
+             [node['name']]) for node in stale_nodes]
+             
+def run_graph(nodes, state_path, workers = 1, dry_run = False,
+              get_tasks = get_tasks):
+              
+    """Rebuilds the stale nodes of a stage graph, stage by stage.
+    
+        Parameters
+        ----------
+        
+        nodes: list of dicts
+            Nodes (see make_node), in an order where every node comes after the
+            nodes making its inputs.
+            
+        state_path: string
+            Path of the state file.
+            
+        dry_run: bool
+            If True, only print what would be rebuilt.
+            
+        get_tasks: function
+            Returns the tasks doing the work of a list of stale nodes of one
+            stage, and the names of the nodes each task covers, e.g. to run
+            several nodes as one task.
+            
+        Returns
+        -------
+        
+        failed: list of strings
+            Names of the nodes that failed or were not run because a node they
+            depend on failed.
+            
+    """
+    
+    state = read_state(state_path)
+    stale = find_stale_nodes(nodes, state)
+    
+    if dry_run:
+        print_plan(stale, len(nodes), state)
+        return []
+        
+    print('Rebuilding {} of {} nodes.'.format(len(stale), len(nodes)))
+    
+    #forget files that no longer exist
+    state['files'] = dict([(path, entry) for path, entry in state['files'].items() \
+                           if os.path.isfile(path)])
+                           
+    stages = OrderedDict()
+    for node, reason in stale:
+        stages.setdefault(node['stage'], []).append(node)
+        
+    failed = []
+    failed_outputs = set()
+    
+    for stage_name, stage_nodes in stages.items():
+    
+        #nodes whose inputs failed to build are not run
+        runnable = []
+        for node in stage_nodes:
+            if any([path in failed_outputs for path in node['inputs']]):
+                failed.append(node['name'])
+                failed_outputs.update(node['outputs'])
+            else:
+                runnable.append(node)
+        if len(runnable) == 0:
+            continue
+            
+        tasks = get_tasks(runnable)
+        start = time.time()
+        failed_tasks = run_tasks([task for task, names in tasks], workers = workers,
+                                 max_memory = params()['max_memory'])
+        failed_tasks = [name for name, error in failed_tasks]
+        elapsed = time.time() - start
+        
+        failed_nodes = set()
+        for task, names in tasks:
+            if task[0] in failed_tasks:
+                failed_nodes.update(names)
+                
+        for node in runnable:
+            if node['name'] in failed_nodes:
+                failed.append(node['name'])
+                failed_outputs.update(node['outputs'])
+            else:
+                state['nodes'][node['name']] = node_fingerprint(node, state)
+                
+        nbytes = sum([task[1] for task, names in tasks])
+        if nbytes > 0:
+            state['rates'][stage_name] = elapsed / nbytes
+            
+        write_state(state, state_path)
+        
+    #keep the content hashes taken while looking for stale nodes
+    write_state(state, state_path)
+    return failed
+    
+def build_pipeline_graph(data_dir, filters = None):
+
+    """Returns the nodes of the pipeline after new data are sorted: the median
+        flat of each filter, the mean flat of each visit, the anomalous pixels
+        of each visit and the anomalous pixel table of each filter. If filters is
+        given, only for those filters."""
+        
+    check_significance_params()
+    bands = get_bands()
+    anom_output = params()['anom_output']
+    compression = params()['output_compression']
+    
+    flat_nodes, anom_nodes, table_nodes = [], [], []
+    
+    #input files from the header index, one query for the whole data directory
+    filter_files = group_files(get_indexed_files(data_dir), level = 4)
+    
+    for filter_dir, ifiles in filter_files.items():
+        filt = os.path.basename(filter_dir)
+        if filters is not None and filt not in filters:
+            continue
+        visit_files = group_files(ifiles)
+        
+        median_flat = get_median_flat_path(data_dir, filt)
+        flat_nodes.append(make_node('median:'+filt, 'flats', make_filter_median_flat,
+                                    (data_dir, filt, ifiles), ifiles, [median_flat],
+                                    {'compression': compression['median_flat'],
+                                     'stats': params()['median_flat_stats']}))
+                                     
+        table_parts = []
+        for visit_dir in visit_files:
+            visit = '/'.join(visit_dir.split('/')[-4:])
+            mean_flat = get_mean_flat_path(visit_dir)
+            flat_nodes.append(make_node('visit_mean:'+visit, 'flats',
+                                        make_mean_visit_flat,
+                                        (visit_dir, visit_files[visit_dir]),
+                                        visit_files[visit_dir], [mean_flat],
+                                        {'compression': compression['mean_flat'],
+                                         'dq_bad_bits': params()['dq_bad_bits']}))
+                                         
+            outputs = []
+            if anom_output in ('table','both'):
+                outputs.append(get_table_part_path(mean_flat, median_flat))
+                table_parts.append(outputs[-1])
+            if anom_output in ('dat','both'):
+                outputs += [get_output_path(mean_flat, median_flat, threshold,
+                                            lower_bound) for threshold, lower_bound in bands]
+            anom_nodes.append(make_node('anom_pixels:'+visit, 'anom_pixels',
+                                        find_anom_pixels_multi,
+                                        (mean_flat, median_flat, bands, True, True),
+                                        [mean_flat, median_flat], outputs,
+                                        {'bands': bands, 'mask_DQ': True,
+                                         'mask_border': True,
+                                         'dq_bad_bits': params()['dq_bad_bits'],
+                                         'min_significance':
+                                         params()['anom_min_significance'],
+                                         'anom_output': anom_output}))
+                                         
+        if len(table_parts) > 0:
+            table_path = filter_dir+'/results/{}_anom_pixels.npy'.format(filt)
+            table_nodes.append(make_node('anom_table:'+filt, 'anom_table',
+                                         combine_anom_table, (filter_dir,),
+                                         table_parts, [table_path]))
+                                         
+    return flat_nodes + anom_nodes + table_nodes
+    
+def get_pipeline_tasks(stale_nodes):
+
+    """get_tasks of the pipeline graph: if the median flat and every visit mean
+        flat of a filter are stale, they are made in one pass over the files with
+        make_filter_flats."""
+        
+    by_filter = OrderedDict()
+    for node in stale_nodes:
+        if node['stage'] == 'flats':
+            filt = node['name'].split(':')[1].split('/')[0]
+            by_filter.setdefault(filt, []).append(node)
+            
+    fused = set()
+    tasks = []
+    for filt, filter_nodes in by_filter.items():
+        median_nodes = [node for node in filter_nodes if node['name'] == 'median:'+filt]
+        if len(median_nodes) == 0:
+            continue
+        data_dir, filt, ifiles = median_nodes[0]['args']
+        n_visits = len(set([os.path.dirname(path) for path in ifiles]))
+        if len(filter_nodes) == n_visits + 1:
+            names = [node['name'] for node in filter_nodes]
+            tasks.append((('filter flats '+filt, get_input_bytes(median_nodes[0]),
+                           make_filter_flats, (data_dir, filt, ifiles)), names))
+            fused.update(names)
+            
+    return tasks + get_tasks([node for node in stale_nodes \
+                              if node['name'] not in fused])
+                              
+@instrumented()
+def main_run_stage_graph(data_dir, state_path, workers = 1, dry_run = False):
+
+    """Makes the median flats, visit mean flats and anomalous pixel lists that
+        are out of date with their inputs (see build_pipeline_graph).
+        
+        Parameters
+        ----------
+        data_dir : string
+            Data directory
+            
+        state_path : string
+            Path of the state file of the stage graph.
+            
+        workers : int
+            Number of processes the nodes of a stage are run on in parallel.
+            
+        dry_run : bool
+            If True, print what would be rebuilt and the estimated cost, without
+            running anything.
+            
+        Returns
+        -------
+        failed : list of strings
+            Names of the nodes that failed or were skipped.
+            
+    """
+    
+    nodes = build_pipeline_graph(data_dir)
+    failed = run_graph(nodes, state_path, workers = workers,
+                       dry_run = dry_run, get_tasks = get_pipeline_tasks)
+    if len(failed) > 0:
+        print('{} nodes failed or were skipped:'.format(len(failed)))
+        for name in failed:
+            print('  '+name)
+    return failed
+    
+if __name__ == '__main__':
+
+    pathss = paths()
+    main_run_stage_graph(pathss['data_dir'], pathss['pipeline_state'], dry_run = True)
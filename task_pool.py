@@ -0,0 +1,160 @@
+import os
+import resource
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from paths_and_params import params
+from instrumentation import merge_worker_reports
+
+""" Runs the independent units of work of a pipeline stage (one filter's median flat,
+	one visit's mean flat, one epoch's anomalous pixels...) either serially or on a 
+	pool of worker processes.
+	
+	A task is a tuple (name, cost, func, args). Tasks are dispatched largest cost 
+	first, so that a long job is not left to run alone at the end. A task that raises
+	is logged and skipped without stopping the other tasks. If a worker dies (killed
+	by the OOM killer, a segfault...) the pool breaks, and the tasks that had not
+	finished are reported as failed instead of aborting the stage.
+	
+	The failed tasks are returned by run_tasks, and the main_* functions of the
+	stages return them so that their scripts exit with status 1.
+	
+"""
+
+#set in worker processes by limit_worker_memory
+_worker_memory_budget = None
+
+def get_total_memory():
+
+    """Returns the physical memory of the node in bytes."""
+    
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    
+def get_worker_memory_budget(workers, max_memory = None):
+
+    """Returns the memory (in bytes) each of `workers` processes may use, so that 
+        together they stay under max_memory. If max_memory is None, 80% of the 
+        physical memory of the node is shared between the workers."""
+        
+    if max_memory is None:
+        max_memory = int(0.8 * get_total_memory())
+    return int(max_memory // workers)
+    
+def get_memory_budget():
+
+    """Returns the memory (in bytes) the current process may use: the worker 
+        budget inside a pool worker, otherwise params()['max_memory'] (or 80% of 
+        the physical memory)."""
+        
+    if _worker_memory_budget is not None:
+        return _worker_memory_budget
+    return get_worker_memory_budget(1, params()['max_memory'])
+    
+def limit_worker_memory(memory_budget):
+
+    """Pool initializer, caps the address space of a worker process so that a task
+        that goes over its budget fails with a MemoryError instead of bringing down
+        the node.
+        
+        RLIMIT_AS limits virtual memory, not resident memory: memory mapped files
+        (FITS sections, the pixel history store), thread stacks and the shared 
+        libraries all count against it, although they take little physical memory.
+        The cap is therefore a safety net against runaway allocations, not an 
+        accounting of RSS; a task that maps large files can fail under it while 
+        well within its budget, in which case raise params()['max_memory'] or run
+        fewer workers. The budget itself (get_memory_budget) is what the combine 
+        steps plan their strips with.
+        
+        """
+        
+    global _worker_memory_budget
+    _worker_memory_budget = memory_budget
+    
+    soft, hard = resource.getrlimit(resource.RLIMIT_AS)
+    if hard != resource.RLIM_INFINITY:
+        memory_budget = min(memory_budget, hard)
+    resource.setrlimit(resource.RLIMIT_AS, (memory_budget, hard))
+    
+def run_task(task):
+
+    """Runs one task, returns (name, error). error is None if the task succeeded, 
+        otherwise the formatted traceback."""
+        
+    name, cost, func, args = task
+    try:
+        func(*args)
+        return (name, None)
+    except Exception:
+        return (name, traceback.format_exc())
+        
+def get_file_sizes(ifiles):
+
+    """Total size in bytes of ifiles, used as the cost of a task."""
+    
+    return sum([os.path.getsize(f) for f in ifiles])
+    
+def run_tasks(tasks, workers = 1, max_memory = None):
+
+    """Runs tasks, largest first, serially if workers is 1 or else on a pool of 
+        `workers` processes.
+        
+        Parameters
+        ----------
+        
+        tasks: list of tuples
+            (name, cost, func, args) for each task. func must be a module level
+            function so it can be sent to the worker processes.
+            
+        workers: int
+            Number of worker processes.
+            
+        max_memory: int or None
+            Total memory in bytes the workers may use, see 
+            get_worker_memory_budget.
+            
+        Returns
+        -------
+        
+        failed: list of tuples
+            (name, traceback) of every task that raised.
+            
+    """
+    
+    tasks = sorted(tasks, key = lambda task: task[1], reverse = True)
+    failed = []
+    
+    if workers <= 1:
+        results = (run_task(task) for task in tasks)
+        for name, error in results:
+            if error is not None:
+                print('Task {} failed:\n{}'.format(name,error))
+                failed.append((name,error))
+        return failed
+        
+    memory_budget = get_worker_memory_budget(workers, max_memory)
+    print('Running {} tasks on {} workers, {:.1f} GB each.'.format(len(tasks),workers,
+          memory_budget/1e9))
+          
+    with ProcessPoolExecutor(max_workers = workers, initializer = limit_worker_memory,
+                             initargs = (memory_budget,)) as pool:
+        futures = {}
+        for task in tasks:
+            #the pool can break while tasks are still being submitted
+            try:
+                futures[pool.submit(run_task, task)] = task[0]
+            except BrokenProcessPool:
+                print('Task {} failed:\n{}'.format(task[0],traceback.format_exc()))
+                failed.append((task[0],traceback.format_exc()))
+                
+        for future in as_completed(futures):
+            #a dead worker breaks the pool, every unfinished task raises here
+            try:
+                name, error = future.result()
+            except BrokenProcessPool:
+                name, error = futures[future], traceback.format_exc()
+            if error is not None:
+                print('Task {} failed:\n{}'.format(name,error))
+                failed.append((name,error))
+                
+    merge_worker_reports()
+    return failed
@@ -0,0 +1,68 @@
+import os
+import sys
+
+#the pipeline modules live at the top of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+import pytest
+
+
+@pytest.fixture
+def make_flts():
+
+    """Returns a function that writes n synthetic full frame FLT files (SCI and DQ
+        extensions of chips 1 and 2) to a directory and returns their paths."""
+
+    from astropy.io import fits
+
+    def make(directory, n, shape = (40,24), seed = 0, filt = 'F225W', prop_id = 13169,
+             date_obs = '2013-05-01'):
+        rng = np.random.default_rng(seed)
+        os.makedirs(str(directory), exist_ok = True)
+        paths = []
+        for i in range(n):
+            primary = fits.PrimaryHDU()
+            primary.header['FILTER'] = filt
+            primary.header['PROPOSID'] = prop_id
+            primary.header['DATE-OBS'] = date_obs
+            hdus = [primary]
+            for chip in (1,2):
+                sci = fits.ImageHDU(rng.normal(1000, 30, shape).astype(np.float32))
+                sci.header['EXTNAME'], sci.header['EXTVER'] = 'SCI', chip
+                dq = np.zeros(shape, dtype = np.int16)
+                dq[rng.random(shape) < 0.02] = rng.choice([4, 16, 512])
+                dq = fits.ImageHDU(dq)
+                dq.header['EXTNAME'], dq.header['EXTVER'] = 'DQ', chip
+                hdus += [sci, dq]
+            path = os.path.join(str(directory), 'ic{:03d}{:03d}q_flt.fits'.format(seed, i))
+            fits.HDUList(hdus).writeto(path, overwrite = True)
+            paths.append(path)
+        return paths
+
+    return make
+
+
+@pytest.fixture
+def set_params(monkeypatch):
+
+    """Returns a function that overrides entries of paths_and_params.params() in
+        every pipeline module already imported. Successive calls add to the
+        earlier overrides."""
+
+    import paths_and_params
+    functions = [paths_and_params.params]
+
+    def set_params(**overrides):
+        default = functions[-1]
+        def params():
+            params_dict = default()
+            params_dict.update(overrides)
+            return params_dict
+        for module in list(sys.modules.values()):
+            if getattr(module, 'params', None) in functions and \
+               getattr(module, '__file__', None) is not None:
+                monkeypatch.setattr(module, 'params', params)
+        functions.append(params)
+
+    return set_params
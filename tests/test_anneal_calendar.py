@@ -0,0 +1,47 @@
+import os
+import anneal_calendar
+from anneal_calendar import AnnealCalendar
+from download_new_anneal_file import write_mjd_to_file
+
+
+def test_assign():
+
+    calendar = AnnealCalendar(['56000.5', '55000.0', '57000'])
+    assert list(calendar.assign([54000., 55000., 55000.1, 57000.5])) == \
+           ['55000.0', '55000.0', '56000.5', None]
+
+
+def test_load_sees_updates(tmp_path, monkeypatch):
+
+    anneal_info_dir = str(tmp_path)
+    monkeypatch.setattr(anneal_calendar, 'paths',
+                        lambda: {'anneal_info_dir': anneal_info_dir})
+
+    write_mjd_to_file(['55000.0', '56000.0'], anneal_info_dir)
+    assert anneal_calendar.get_anneal_file() == os.path.join(anneal_info_dir,
+                                                             'anneal_mjds.txt')
+    assert AnnealCalendar.load().nearest_anneal(56500.) is None
+
+    #an update, even within the same second, is seen by the next load
+    write_mjd_to_file(['55000.0', '56000.0', '57000.0'], anneal_info_dir)
+    assert AnnealCalendar.load().nearest_anneal(56500.) == '57000.0'
+    assert AnnealCalendar.load().nearest_anneal(56500.) == '57000.0'
+
+
+def test_bundled_file_is_not_cached_in_the_source_tree(tmp_path, monkeypatch):
+
+    anneal_info_dir = str(tmp_path / 'anneal_info')
+    monkeypatch.setattr(anneal_calendar, 'paths',
+                        lambda: {'anneal_info_dir': anneal_info_dir})
+    anneal_calendar._loaded_calendars.clear()
+
+    bundled_file = os.path.join(anneal_calendar.ANNEAL_INFO_DIR, 'anneal_mjds.txt')
+    assert anneal_calendar.get_anneal_file() == bundled_file
+    assert len(AnnealCalendar.load().mjds) > 0
+    assert not os.path.exists(bundled_file + '.npz')
+
+    #once the directory exists, the cache goes there
+    os.makedirs(anneal_info_dir)
+    anneal_calendar._loaded_calendars.clear()
+    AnnealCalendar.load()
+    assert os.listdir(anneal_info_dir) == ['anneal_mjds.txt.npz']
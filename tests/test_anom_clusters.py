@@ -0,0 +1,72 @@
+import numpy as np
+from anom_clusters import label_clusters, match_features, ClusterIndex
+
+
+def make_mask(shape, pixels):
+
+    mask = np.zeros(shape, dtype = bool)
+    for y, x in pixels:
+        mask[y,x] = True
+    return mask
+
+
+def test_label_clusters():
+
+    pixels = [(2,4), (2,5), (2,6), (3,4), (3,5), (3,6), (5,10), (6,11), (15,25)]
+    mask = make_mask((20,30), pixels)
+    dif_sci = np.zeros((20,30), dtype = np.float32)
+    dif_sci[2:4,4:7] = [[-2., -3., -4.], [-5., -6., -7.]]
+    dif_sci[5,10], dif_sci[6,11], dif_sci[15,25] = -3., -5., -9.
+
+    clusters = label_clusters(mask, dif_sci, 2, '55005.0_2013-05-01')
+    assert list(clusters['area']) == [6, 2, 1]
+    assert np.allclose(clusters['yc'], [2.5, 5.5, 15.])
+    assert np.allclose(clusters['xc'], [5., 10.5, 25.])
+    assert np.allclose(clusters['mean_dev'], [-4.5, -4., -9.])
+    assert np.allclose(clusters['min_dev'], [-7., -5., -9.])
+    assert [tuple(c[['y0','y1','x0','x1']]) for c in clusters] == \
+           [(2,4,4,7), (5,7,10,12), (15,16,25,26)]
+    assert set(clusters['chip']) == {2} and set(clusters['feature']) == {-1}
+
+    #without diagonal neighbours the second cluster splits in two
+    assert list(label_clusters(mask, dif_sci, 2, 'a', connectivity = 4)['area']) == \
+           [6, 1, 1, 1]
+    assert len(label_clusters(np.zeros((4,4), dtype = bool), dif_sci, 1, 'a')) == 0
+
+
+def test_grid_query_matches_brute_force():
+
+    rng = np.random.default_rng(0)
+    index = ClusterIndex(cell_size = 16)
+    boxes = []
+    for i in range(300):
+        chip, y0, x0 = rng.integers(1,3), rng.integers(0,200), rng.integers(0,200)
+        box = (chip, y0, y0 + rng.integers(1,40), x0, x0 + rng.integers(1,40))
+        index.insert(*(box + (i,)))
+        boxes.append(box)
+
+    for i in range(200):
+        chip, y0, x0 = rng.integers(1,3), rng.integers(-10,200), rng.integers(-10,200)
+        y1, x1 = y0 + rng.integers(1,30), x0 + rng.integers(1,30)
+        expected = [k for k, (c, by0, by1, bx0, bx1) in enumerate(boxes)
+                    if c == chip and by0 < y1 and y0 < by1 and bx0 < x1 and x0 < bx1]
+        assert sorted(index.query(chip, y0, y1, x0, x1)) == expected
+
+
+def test_match_features_across_epochs():
+
+    dif_sci = np.full((60,60), -3., dtype = np.float32)
+    first = make_mask((60,60), [(10,10), (10,11), (40,40)])
+    second = make_mask((60,60), [(11,13), (40,41), (50,5)])
+    clusters = np.concatenate([label_clusters(first, dif_sci, 1, 'epoch_1'),
+                               label_clusters(first, dif_sci, 2, 'epoch_1'),
+                               label_clusters(second, dif_sci, 1, 'epoch_2')])
+
+    match_features(clusters, match_radius = 2, cell_size = 16)
+    features = dict([((c['epoch'], int(c['chip']), int(c['y0']), int(c['x0'])),
+                      int(c['feature'])) for c in clusters])
+    assert features == {('epoch_1', 1, 10, 10): 0, ('epoch_1', 1, 40, 40): 1,
+                        ('epoch_1', 2, 10, 10): 2, ('epoch_1', 2, 40, 40): 3,
+                        #within 2 pixels of a chip 1 feature of the first epoch
+                        ('epoch_2', 1, 11, 13): 0, ('epoch_2', 1, 40, 41): 1,
+                        ('epoch_2', 1, 50, 5): 4}
@@ -0,0 +1,14 @@
+from benchmarks.bench_stages import main_bench_stages
+
+
+def test_small_run(tmp_path):
+
+    report = main_bench_stages([2, 3], shape = (40,24), workdir = str(tmp_path),
+                               stages = ['open_fits', 'find_anom_pixels'])
+    results = report['results']
+    assert [(result['stage'], result['n_files']) for result in results] == \
+           [('open_fits', 2), ('open_fits', 3), ('find_anom_pixels', 1),
+            ('find_anom_pixels_multi', 1)]
+    for result in results:
+        assert 'error' not in result and result['wall_s'] > 0
+    assert report['shape'] == [40, 24]
@@ -0,0 +1,58 @@
+import numpy as np
+from dq_flags import as_dq, or_dq, union_dq, get_bad_pixel_mask, mask_bad_pixels, \
+                     pack_mask, unpack_mask
+
+
+def test_int16_viewed_as_uint16():
+
+    dq = np.array([[0, 4, -32768], [512, -1, 16]], dtype = np.int16)
+    view = as_dq(dq)
+    assert view.dtype == np.uint16 and np.shares_memory(view, dq)
+    assert view.tolist() == [[0, 4, 32768], [512, 65535, 16]]
+
+    #and back: writing the uint16 flags as int16 keeps every bit
+    assert np.array_equal(view.view(np.int16), dq)
+    assert as_dq(view) is view
+    assert as_dq(dq.astype(np.int32)).tolist() == view.tolist()
+
+
+def test_bad_bit_masking(set_params):
+
+    dq = np.array([[0, 4, 16], [512, 4 | 512, -32768]], dtype = np.int16)
+    assert get_bad_pixel_mask(dq, bad_bits = 0xFFFF).tolist() == \
+           [[False, True, True], [True, True, True]]
+    assert get_bad_pixel_mask(dq, bad_bits = 512).tolist() == \
+           [[False, False, False], [True, True, False]]
+    assert get_bad_pixel_mask(dq, bad_bits = 4 | 32768).tolist() == \
+           [[False, True, False], [False, True, True]]
+
+    set_params(dq_bad_bits = 16)
+    mask = get_bad_pixel_mask(dq)
+    assert mask.tolist() == [[False, False, True], [False, False, False]]
+
+    sci = np.ones(dq.shape, dtype = np.float32)
+    mask_bad_pixels(sci, mask)
+    assert np.isnan(sci).tolist() == mask.tolist()
+
+    mask = np.random.default_rng(0).random((5,37)) < 0.3
+    assert np.array_equal(unpack_mask(pack_mask(mask), mask.shape), mask)
+
+
+def test_union_dq():
+
+    rng = np.random.default_rng(0)
+    dq_arrays = [rng.choice([0, 4, 16, 512, -32768], (70,9)).astype(np.int16)
+                 for i in range(5)]
+    expected = np.bitwise_or.reduce(np.array(dq_arrays).view(np.uint16), axis = 0)
+
+    assert np.array_equal(union_dq(dq_arrays, block_rows = 16), expected)
+    assert np.array_equal(union_dq(np.array(dq_arrays)), expected)
+
+    out = np.zeros((70,9), dtype = np.uint16)
+    assert union_dq(dq_arrays, out = out) is out
+    assert np.array_equal(out, expected)
+
+    out = np.zeros((70,9), dtype = np.uint16)
+    for dq in dq_arrays:
+        or_dq(out, dq)
+    assert np.array_equal(out, expected)
@@ -0,0 +1,56 @@
+import os
+import numpy as np
+import pytest
+from astropy.io import fits
+from make_filter_flats import make_filter_flats
+from make_median_filter_flats import make_filter_median_flat, get_median_flat_path
+from make_mean_visit_flats import make_mean_visit_flat, get_mean_flat_path
+
+VISITS = [('F225W/13169/55005.0/2013-05-01', 5, 1), ('F225W/13585/55005.0/2013-06-01', 4, 2),
+          ('F225W/13169/55005.0/2013-07-01', 3, 3)]
+
+
+def read_flat(path):
+
+    with fits.open(path) as hdu_list:
+        return [np.array(hdu.data) for hdu in hdu_list[1:]]
+
+
+def make_visits(data_dir, make_flts, visits):
+
+    visit_files = {}
+    for visit, n, seed in visits:
+        visit_dir = os.path.join(data_dir, visit)
+        visit_files[visit_dir] = make_flts(visit_dir, n, seed = seed)
+    return visit_files
+
+
+@pytest.mark.parametrize('use_cache', [False, True])
+def test_fused_equals_separate(tmp_path, make_flts, set_params, use_cache):
+
+    set_params(median_cache = use_cache, strip_height = 16, pixel_history = False)
+    separate_dir, fused_dir = str(tmp_path / 'separate'), str(tmp_path / 'fused')
+    separate, fused = {}, {}
+
+    #the third visit is added later, to the tile cache when it is used
+    for visits in (VISITS[:2], VISITS[2:]):
+        separate.update(make_visits(separate_dir, make_flts, visits))
+        fused.update(make_visits(fused_dir, make_flts, visits))
+
+        ifiles = sorted(sum(separate.values(), []))
+        make_filter_median_flat(separate_dir, 'F225W', ifiles)
+        for visit_dir in sorted(separate):
+            make_mean_visit_flat(visit_dir, separate[visit_dir])
+        make_filter_flats(fused_dir, 'F225W', sorted(sum(fused.values(), [])))
+
+        pairs = [(get_median_flat_path(separate_dir, 'F225W'),
+                  get_median_flat_path(fused_dir, 'F225W'))]
+        pairs += [(get_mean_flat_path(a), get_mean_flat_path(b))
+                  for a, b in zip(sorted(separate), sorted(fused))]
+        for a, b in pairs:
+            for ext_a, ext_b in zip(read_flat(a), read_flat(b)):
+                assert np.array_equal(ext_a, ext_b, equal_nan = True)
+
+    if use_cache:
+        assert sorted(os.listdir(os.path.join(fused_dir, 'F225W/median_cache'))) == \
+               ['batch_000', 'batch_001']
@@ -0,0 +1,187 @@
+import os
+import numpy as np
+import pytest
+from find_anom_pixels import find_anom_pixels_stack, get_percent_dev_images, \
+                             get_band_pixel_locs, get_bands, check_significance_params, \
+                             find_anom_pixels_multi, combine_anom_table, load_anom_table, \
+                             get_table_part_path, get_output_path, ANOM_DTYPE
+from QE_pixel_tools import open_fits
+from make_mean_visit_flats import make_mean_visit_flat, get_mean_flat_path
+from make_median_filter_flats import make_filter_median_flat
+
+
+def test_stack_matches_epochs(tmp_path, make_flts, set_params):
+
+    set_params(median_cache = False)
+    data_dir = str(tmp_path)
+    filter_dir = os.path.join(data_dir, 'F225W')
+    visits = [('13169/55005.0/2013-05-01', 3), ('13169/55005.0/2013-05-09', 1),
+              ('13585/55005.0/2013-06-01', 2)]
+    ifiles, visit_dirs = [], []
+    for seed, (visit, n) in enumerate(visits):
+        visit_dirs.append(os.path.join(filter_dir, visit))
+        visit_files = make_flts(visit_dirs[-1], n, seed = seed,
+                                date_obs = visit.split('/')[-1])
+        make_mean_visit_flat(visit_dirs[-1], visit_files)
+        ifiles += visit_files
+    make_filter_median_flat(data_dir, 'F225W', ifiles)
+    median_flat = os.path.join(filter_dir, 'F225W_median_flat.fits')
+
+    bands = get_bands()
+    epochs, first_epoch, n_flagged, min_dev = find_anom_pixels_stack(filter_dir, bands,
+                                                                     mask_DQ = True)
+    assert [epoch['key'] for epoch in epochs] == [visit for visit, n in visits]
+
+    #count of each band over the epochs, one epoch at a time
+    expected = [np.zeros_like(n_flagged[0]), np.zeros_like(n_flagged[1])]
+    for visit_dir in visit_dirs:
+        dif_sci_arrays, epoch_sci_arrays = get_percent_dev_images(
+                                           get_mean_flat_path(visit_dir), median_flat,
+                                           mask_DQ = True)
+        for j, dif_sci in enumerate(dif_sci_arrays):
+            for b, locs in enumerate(get_band_pixel_locs(dif_sci, bands)):
+                expected[j][b][locs] += 1
+
+    for j in range(2):
+        assert n_flagged[j].sum() > 0
+        assert np.array_equal(n_flagged[j], expected[j])
+
+    #the DQ flags come from the pixel history, not from the mean flats
+    for visit_dir in visit_dirs:
+        os.remove(get_mean_flat_path(visit_dir))
+    epochs, first_epoch, n_flagged, min_dev = find_anom_pixels_stack(filter_dir, bands,
+                                                                     mask_DQ = True)
+    for j in range(2):
+        assert np.array_equal(n_flagged[j], expected[j])
+
+
+def test_significance_needs_mad(set_params):
+
+    set_params(anom_min_significance = 3., median_flat_stats = ['mad'])
+    check_significance_params()
+    set_params(median_flat_stats = [])
+    with pytest.raises(ValueError, match = 'median_flat_stats'):
+        check_significance_params()
+
+
+def test_combine_prunes_stale_parts(tmp_path, make_flts, set_params):
+
+    set_params(median_cache = False, anom_output = 'table')
+    data_dir = str(tmp_path)
+    filter_dir = os.path.join(data_dir, 'F225W')
+    ifiles = []
+    for seed, visit in enumerate(['13169/55005.0/2013-05-01', '13169/55005.0/2013-05-09']):
+        visit_files = make_flts(os.path.join(filter_dir, visit), 2, seed = seed)
+        make_mean_visit_flat(os.path.join(filter_dir, visit), visit_files)
+        ifiles += visit_files
+    make_filter_median_flat(data_dir, 'F225W', ifiles)
+    median_flat = os.path.join(filter_dir, 'F225W_median_flat.fits')
+
+    mean_flats = [get_mean_flat_path(os.path.dirname(visit_files[0])) for visit_files in \
+                  (ifiles[:2], ifiles[2:])]
+    for mean_flat in mean_flats:
+        find_anom_pixels_multi(mean_flat, median_flat, get_bands(), True)
+    table = load_anom_table(combine_anom_table(filter_dir))
+    assert set(table['date_obs']) == set([b'2013-05-01', b'2013-05-09'])
+
+    #the second visit is gone: its rows leave the table with its part
+    os.remove(mean_flats[1])
+    table = load_anom_table(combine_anom_table(filter_dir))
+    assert set(table['date_obs']) == set([b'2013-05-01'])
+    assert not os.path.isfile(get_table_part_path(mean_flats[1], median_flat))
+
+
+def make_visit_flats(filter_dir, make_flts):
+
+    """Two visits of F225W with their mean flats, and the median flat. Returns the
+        mean flats and the median flat."""
+
+    ifiles, mean_flats = [], []
+    for seed, visit in enumerate(['13169/55005.0/2013-05-01', '13585/55006.5/2013-06-01']):
+        visit_dir = os.path.join(filter_dir, visit)
+        visit_files = make_flts(visit_dir, 2, seed = seed, date_obs = visit[-10:])
+        make_mean_visit_flat(visit_dir, visit_files)
+        mean_flats.append(get_mean_flat_path(visit_dir))
+        ifiles += visit_files
+    make_filter_median_flat(os.path.dirname(filter_dir), 'F225W', ifiles)
+    return mean_flats, os.path.join(filter_dir, 'F225W_median_flat.fits')
+
+
+def get_single_band_rows(mean_flat, median_flat, threshold, lower_bound):
+
+    """The .dat rows of one band as find_anom_pixels wrote them before the bands
+        were searched together: np.where on the border masked deviation images."""
+
+    epoch_sci_arrays = open_fits(mean_flat, [1,2])
+    median_sci_arrays = open_fits(median_flat, [1,2])
+    rows = []
+    for chip, sci_epoch, sci_median in zip((1,2), epoch_sci_arrays, median_sci_arrays):
+        sci_epoch[0:10], sci_epoch[-10:] = np.nan, np.nan
+        sci_median[0:10], sci_median[-10:] = np.nan, np.nan
+        dif_sci = ((sci_epoch-sci_median)/sci_median)*100
+        with np.errstate(invalid = 'ignore'):
+            locs = np.where((dif_sci<threshold) & (dif_sci>lower_bound))
+        for coords, percent_dev, flux in zip(np.column_stack(locs), dif_sci[locs],
+                                             sci_epoch[locs]):
+            rows.append('{},{},{},{},{}\n'.format(chip, coords[0], coords[1],
+                                                  percent_dev, flux))
+    return rows
+
+
+def test_multi_band_matches_single_band(tmp_path, make_flts, set_params):
+
+    set_params(median_cache = False, anom_output = 'dat')
+    mean_flats, median_flat = make_visit_flats(str(tmp_path / 'F225W'), make_flts)
+
+    bands = get_bands()
+    n_rows = 0
+    for mean_flat in mean_flats:
+        find_anom_pixels_multi(mean_flat, median_flat, bands)
+        for threshold, lower_bound in bands:
+            expected = get_single_band_rows(mean_flat, median_flat, threshold,
+                                            lower_bound)
+            with open(get_output_path(mean_flat, median_flat, threshold,
+                                      lower_bound)) as f:
+                assert f.readlines() == ['#chip,xc,yc,percent_dev,counts\n'] + expected
+            n_rows += len(expected)
+    assert n_rows > 0
+
+
+def test_anom_table_round_trip(tmp_path, make_flts, set_params):
+
+    set_params(median_cache = False, anom_output = 'table')
+    filter_dir = str(tmp_path / 'F225W')
+    mean_flats, median_flat = make_visit_flats(filter_dir, make_flts)
+    bands = [(-1.0, -10.0), (-3.0, -6.0)]
+
+    expected = []
+    for mean_flat in mean_flats:
+        find_anom_pixels_multi(mean_flat, median_flat, bands)
+        anneal_mjd, date_obs = mean_flat[:-5].split('_')[-2:]
+        dif_sci_arrays, epoch_sci_arrays = get_percent_dev_images(mean_flat, median_flat)
+        for threshold, lower_bound in bands:
+            for chip in (1,2):
+                dif_sci, sci = dif_sci_arrays[chip-1], epoch_sci_arrays[chip-1]
+                with np.errstate(invalid = 'ignore'):
+                    ys, xs = np.where((dif_sci<threshold) & (dif_sci>lower_bound))
+                expected += [(float(anneal_mjd), date_obs.encode(), threshold,
+                              lower_bound, chip, y, x, dif_sci[y,x], sci[y,x])
+                             for y, x in zip(ys, xs)]
+    expected = np.array(expected, dtype = ANOM_DTYPE)
+
+    table = load_anom_table(combine_anom_table(filter_dir))
+    assert table.dtype == ANOM_DTYPE and len(table) == len(expected) > 0
+    for name in ANOM_DTYPE.names:
+        assert np.array_equal(np.sort(table, order = list(ANOM_DTYPE.names))[name],
+                              np.sort(expected, order = list(ANOM_DTYPE.names))[name])
+
+    #selections
+    table_path = os.path.join(filter_dir, 'results/F225W_anom_pixels.npy')
+    selected = load_anom_table(table_path, date_obs = '2013-06-01', chip = 2,
+                               region = (10, 30, 0, 12), threshold = -3.0)
+    keep = (expected['date_obs'] == b'2013-06-01') & (expected['chip'] == 2) & \
+           (expected['y'] >= 10) & (expected['y'] < 30) & (expected['x'] < 12) & \
+           (expected['threshold'] == -3.0)
+    assert len(selected) == keep.sum() > 0
+    assert set(load_anom_table(table_path, anneal_mjd = 55006.5)['date_obs']) == \
+           set([b'2013-06-01'])
@@ -0,0 +1,65 @@
+import numpy as np
+import pytest
+from fits_reader import PrefetchReader
+from QE_pixel_tools import open_fits, open_fits_section
+
+
+def read_all(reader):
+
+    """Copies of every item of reader, since its arrays are reused."""
+
+    return [(ifile, rows, [np.array(ar) for ar in sci_arrays],
+             [np.array(ar) for ar in dq_arrays])
+            for ifile, rows, sci_arrays, dq_arrays in reader]
+
+
+def test_order_with_reused_slots(tmp_path, make_flts):
+
+    ifiles = make_flts(str(tmp_path), 7)
+    reader = PrefetchReader(ifiles, [1,2], DQ = True, depth = 2, threads = 2)
+
+    views = []
+    for i, (ifile, rows, sci_arrays, dq_arrays) in enumerate(reader):
+        assert ifile == ifiles[i] and rows is None
+        expected_sci, expected_dq = open_fits(ifile, [1,2], DQ = True)
+        for a, b in zip(sci_arrays + dq_arrays, expected_sci + expected_dq):
+            assert np.array_equal(a, b)
+        views.append(sci_arrays[0])
+
+    #7 files through a ring of 3 slots
+    assert reader.stats['n_reads'] == 7
+    assert np.shares_memory(views[0], views[3]) and np.shares_memory(views[1], views[4])
+    assert not np.shares_memory(views[0], views[1])
+
+
+def test_depth_zero_same_as_read_ahead(tmp_path, make_flts):
+
+    ifiles = make_flts(str(tmp_path), 4, shape = (40,24))
+    items = [(ifile, rows) for rows in [(0,16), (16,32), (32,40)] for ifile in ifiles]
+
+    results = [read_all(PrefetchReader(items, [1,2], DQ = True, depth = depth))
+               for depth in (0, 1, 3)]
+    for result in results[1:]:
+        assert [item[0:2] for item in result] == [item[0:2] for item in results[0]]
+        for item, item_0 in zip(result, results[0]):
+            for a, b in zip(item[2] + item[3], item_0[2] + item_0[3]):
+                assert np.array_equal(a, b)
+
+    sci_arrays, dq_arrays = open_fits_section(ifiles[2], [1,2], (32,40), DQ = True)
+    assert np.array_equal(results[0][-2][2][1], sci_arrays[1])
+    assert results[0][-2][2][1].shape == (8,24)
+
+
+@pytest.mark.parametrize('depth', [0, 2])
+def test_read_error(tmp_path, make_flts, depth):
+
+    ifiles = make_flts(str(tmp_path), 5)
+    ifiles.insert(3, str(tmp_path / 'missing_flt.fits'))
+
+    read = []
+    with pytest.raises(IOError):
+        for ifile, rows, sci_arrays, dq_arrays in PrefetchReader(ifiles, [1,2],
+                                                                 depth = depth):
+            read.append(ifile)
+            assert dq_arrays == []
+    assert read == ifiles[0:3]
@@ -0,0 +1,110 @@
+import os
+from header_index import get_indexed_files, group_files, query_index, scan_headers, \
+                         update_index
+
+
+def test_scan_and_query(tmp_path, make_flts):
+
+    visit_1 = make_flts(str(tmp_path / 'visit_1'), 2)
+    visit_2 = make_flts(str(tmp_path / 'visit_2'), 1, seed = 1, prop_id = 13585,
+                        date_obs = '2013-06-01')
+    other = make_flts(str(tmp_path / 'other'), 1, seed = 2, filt = 'F336W')
+    ifiles = visit_1 + visit_2 + other
+
+    infos = scan_headers(ifiles, threads = 2)
+    assert [info[0:5] for info in infos[2:4]] == \
+           [(visit_2[0], 'F225W', '13585', '2013-06-01', 56444.),
+            (other[0], 'F336W', '13169', '2013-05-01', 56413.)]
+    assert [info[5] for info in infos] == [os.path.getsize(ifile) for ifile in ifiles]
+
+    index_path = str(tmp_path / 'index.db')
+    update_index(index_path, [info[0:5] + ('55005.0', info[5]) for info in infos])
+    assert query_index(index_path, filt = 'F225W') == visit_1 + visit_2
+    assert query_index(index_path, filt = 'F225W', prop_ids = [13585]) == visit_2
+    assert query_index(index_path, anneal_mjd = '55005.0', date_obs = '2013-05-01') == \
+           visit_1 + other
+
+    #entries are keyed by rootname, a file sorted again replaces its entry
+    moved = str(tmp_path / 'moved' / os.path.basename(other[0]))
+    update_index(index_path, [(moved,) + infos[3][1:5] + ('55005.0', infos[3][5])])
+    assert query_index(index_path, filt = 'F336W') == [moved]
+
+
+def test_backfill_and_query(tmp_path, make_flts):
+
+    data_dir = str(tmp_path / 'data')
+    index_path = str(tmp_path / 'index.db')
+    visit_1 = make_flts(os.path.join(data_dir, 'F225W/13169/55005.0/2013-05-01'), 2)
+    visit_2 = make_flts(os.path.join(data_dir, 'F225W/13585/55005.0/2013-06-01'), 1,
+                        seed = 1, prop_id = 13585, date_obs = '2013-06-01')
+    other = make_flts(os.path.join(data_dir, 'F336W/13169/55005.0/2013-05-01'), 1,
+                      seed = 2, filt = 'F336W')
+
+    #nothing of data_dir indexed yet: backfilled from the directory layout
+    ifiles = get_indexed_files(data_dir, index_path = index_path)
+    assert sorted(ifiles) == sorted(visit_1 + visit_2 + other)
+    assert get_indexed_files(data_dir, filt = 'F225W', prop_ids = [13585],
+                             index_path = index_path) == visit_2
+    assert query_index(index_path, anneal_mjd = '55005.0', date_obs = '2013-06-01') \
+           == visit_2
+
+    #once indexed, files enter through the index only
+    update_index(index_path, [(str(tmp_path / 'elsewhere/icxxxxxxq_flt.fits'), 'F225W',
+                               '13169', '2013-05-01', 56413., '55005.0', 0)])
+    assert len(get_indexed_files(data_dir, index_path = index_path)) == 4
+
+    groups = group_files(ifiles, level = 4)
+    assert list(groups) == [os.path.join(data_dir, 'F225W'), os.path.join(data_dir, 'F336W')]
+    assert list(group_files(groups[os.path.join(data_dir, 'F225W')])) == \
+           [os.path.dirname(visit_1[0]), os.path.dirname(visit_2[0])]
+
+
+def test_sorted_files_reach_the_stages(tmp_path, make_flts):
+
+    from sort_new_data import sort_files
+
+    data_dir = str(tmp_path / 'data')
+    old = make_flts(os.path.join(data_dir, 'F225W/13169/55005.0/2013-05-01'), 1)
+    assert get_indexed_files(data_dir) == old
+
+    new = make_flts(str(tmp_path / 'new_data'), 1, seed = 1)
+    sort_files({'data_dir': data_dir}, [(new[0], 'F225W', '13169', '55005.0',
+                                         '2013-05-09', 56421., 0)])
+    assert get_indexed_files(data_dir) == old + [os.path.join(data_dir,
+           'F225W/13169/55005.0/2013-05-09', os.path.basename(new[0]))]
+
+
+def test_sort_into_unindexed_archive(tmp_path, make_flts):
+
+    from sort_new_data import sort_files
+
+    data_dir = str(tmp_path / 'data')
+    index_path = str(tmp_path / 'data/.header_index.db')
+    archive = make_flts(os.path.join(data_dir, 'F225W/13169/55005.0/2013-05-01'), 3)
+
+    #the first sort indexes the archive before the new file
+    new = make_flts(str(tmp_path / 'new_data'), 1, seed = 1)
+    sort_files({'data_dir': data_dir}, [(new[0], 'F225W', '13169', '55005.0',
+                                         '2013-05-09', 56421., 0)])
+    sorted_file = os.path.join(data_dir, 'F225W/13169/55005.0/2013-05-09',
+                               os.path.basename(new[0]))
+    assert get_indexed_files(data_dir) == archive + [sorted_file]
+
+    #a file deleted by hand leaves the index
+    os.remove(archive[1])
+    assert get_indexed_files(data_dir) == [archive[0], archive[2], sorted_file]
+    assert query_index(index_path, data_dir = data_dir) == \
+           [archive[0], archive[2], sorted_file]
+
+
+def test_sort_into_new_data_dir(tmp_path, make_flts):
+
+    from sort_new_data import sort_files
+
+    data_dir = str(tmp_path / 'data')
+    new = make_flts(str(tmp_path / 'new_data'), 1)
+    sort_files({'data_dir': data_dir}, [(new[0], 'F225W', '13169', '55005.0',
+                                         '2013-05-09', 56421., 0)])
+    assert get_indexed_files(data_dir) == \
+           [os.path.join(data_dir, 'F225W/13169/55005.0/2013-05-09',
+                         os.path.basename(new[0]))]
@@ -0,0 +1,44 @@
+import json
+import os
+import pytest
+import instrumentation
+from instrumentation import instrumented, stage, record_read, record_write
+
+
+@instrumented(tag_args = ('filt', 'ifiles'))
+def combine(filt, ifiles):
+
+    record_read(100, nfiles = len(ifiles))
+    with stage('write', filt = filt):
+        record_write(40)
+
+
+@instrumented()
+def fail():
+
+    raise ValueError('bad input')
+
+
+def test_stage_records(tmp_path, monkeypatch):
+
+    report = str(tmp_path / 'report.jsonl')
+    monkeypatch.delenv(instrumentation.REPORT_ENV, raising = False)
+    combine('F225W', ['a', 'b'])
+    assert not os.path.exists(report)
+
+    monkeypatch.setenv(instrumentation.REPORT_ENV, report)
+    combine('F225W', ['a', 'b'])
+    with pytest.raises(ValueError):
+        fail()
+    with open(report) as f:
+        records = [json.loads(line) for line in f]
+
+    #the inner stage ends first, and its I/O counts in the outer one too
+    assert [record['stage'] for record in records] == ['write', 'combine', 'fail']
+    write, outer, failed = records
+    assert (write['filt'], write['files_written'], write['bytes_written'],
+            write['bytes_read']) == ('F225W', 1, 40, 0)
+    assert (outer['filt'], outer['n_ifiles'], outer['files_read'], outer['bytes_read'],
+            outer['bytes_written']) == ('F225W', 2, 2, 100, 40)
+    assert outer['pid'] == os.getpid() and outer['peak_rss_mb'] > 0
+    assert 'error' not in outer and failed['error'] == "ValueError('bad input')"
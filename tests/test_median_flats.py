@@ -0,0 +1,103 @@
+import os
+import shutil
+import numpy as np
+from astropy.io import fits
+import make_median_filter_flats
+from make_median_filter_flats import make_filter_median_flat, get_median_flat_path
+
+
+def make_filter_dir(data_dir, make_flts):
+
+    ifiles = make_flts(os.path.join(data_dir, 'F225W/13169/55005.0/2013-05-01'), 5,
+                       seed = 1)
+    ifiles += make_flts(os.path.join(data_dir, 'F225W/13585/55005.0/2013-06-01'), 4,
+                        seed = 2)
+    return sorted(ifiles)
+
+
+def read_flat(path):
+
+    with fits.open(path) as hdu_list:
+        return [np.array(hdu.data) for hdu in hdu_list[1:]]
+
+
+def test_cache_equals_memory(tmp_path, make_flts, set_params):
+
+    data_dirs = [str(tmp_path / 'memory'), str(tmp_path / 'cache')]
+    for data_dir, use_cache in zip(data_dirs, (False, True)):
+        set_params(median_cache = use_cache, strip_height = 16, pixel_history = False)
+        ifiles = make_filter_dir(data_dir, make_flts)
+        make_filter_median_flat(data_dir, 'F225W', ifiles)
+    assert os.path.isdir(os.path.join(data_dirs[1], 'F225W/median_cache'))
+
+    for a, b in zip(read_flat(get_median_flat_path(data_dirs[0], 'F225W')),
+                    read_flat(get_median_flat_path(data_dirs[1], 'F225W'))):
+        assert np.array_equal(a, b, equal_nan = True)
+
+
+def test_cache_over_budget(tmp_path, make_flts, set_params):
+
+    #9 files of 40 x 24 pixels in tiles of 64 rows need about 170 kB
+    set_params(median_cache = True, strip_height = 64, max_memory = 100000,
+               pixel_history = False)
+    data_dir = str(tmp_path)
+    ifiles = make_filter_dir(data_dir, make_flts)
+    assert not make_median_filter_flats.cache_fits_in_memory(ifiles, 64)
+
+    make_filter_median_flat(data_dir, 'F225W', ifiles)
+    assert not os.path.isdir(os.path.join(data_dir, 'F225W/median_cache'))
+
+    cube = np.array([fits.getdata(ifile, ('SCI',1)) for ifile in ifiles])
+    median = read_flat(get_median_flat_path(data_dir, 'F225W'))[0]
+    assert np.allclose(median, np.median(cube, axis = 0))
+
+
+def fresh_median(data_dir, ifiles, fresh_dir, set_params):
+
+    """Median flat of copies of ifiles made from scratch, without the cache."""
+
+    copies = []
+    for ifile in ifiles:
+        copy = os.path.join(fresh_dir, os.path.relpath(ifile, data_dir))
+        os.makedirs(os.path.dirname(copy), exist_ok = True)
+        shutil.copy(ifile, copy)
+        copies.append(copy)
+    set_params(median_cache = False)
+    make_filter_median_flat(fresh_dir, 'F225W', copies)
+    set_params(median_cache = True)
+    return read_flat(get_median_flat_path(fresh_dir, 'F225W'))
+
+
+def test_cache_added_removed_changed(tmp_path, make_flts, set_params, capsys):
+
+    set_params(median_cache = True, strip_height = 16, pixel_history = False)
+    data_dir = str(tmp_path / 'data')
+    ifiles = make_filter_dir(data_dir, make_flts)
+    make_filter_median_flat(data_dir, 'F225W', ifiles)
+
+    #new files only: the cached tiles are extended with the new files
+    ifiles = sorted(ifiles + make_flts(os.path.join(data_dir,
+                                       'F225W/13169/55005.0/2013-07-01'), 3, seed = 3))
+    capsys.readouterr()
+    make_filter_median_flat(data_dir, 'F225W', ifiles)
+    assert 'Using 12 files, 3 new.' in capsys.readouterr().out
+    assert sorted(os.listdir(os.path.join(data_dir, 'F225W/median_cache'))) == \
+           ['batch_000', 'batch_001']
+    for a, b in zip(read_flat(get_median_flat_path(data_dir, 'F225W')),
+                    fresh_median(data_dir, ifiles, str(tmp_path / 'added'), set_params)):
+        assert np.array_equal(a, b, equal_nan = True)
+
+    #a removed file, then a changed file, each rebuild the cache from all files
+    def change_file():
+        with fits.open(ifiles[0], mode = 'update') as hdu_list:
+            hdu_list['SCI',1].data[:] += 500.
+    for name, modify in (('removed', lambda: os.remove(ifiles.pop(4))),
+                         ('changed', change_file)):
+        modify()
+        capsys.readouterr()
+        make_filter_median_flat(data_dir, 'F225W', ifiles)
+        assert 'Using 11 files, 11 new.' in capsys.readouterr().out
+        assert os.listdir(os.path.join(data_dir, 'F225W/median_cache')) == ['batch_000']
+        for a, b in zip(read_flat(get_median_flat_path(data_dir, 'F225W')),
+                        fresh_median(data_dir, ifiles, str(tmp_path / name), set_params)):
+            assert np.array_equal(a, b, equal_nan = True)
@@ -0,0 +1,58 @@
+import numpy as np
+import pytest
+from pixel_history import append_epoch, get_region_history, get_pixel_history, \
+                          read_history_index, has_dq
+
+
+def make_epoch(value, shape = (300,20)):
+
+    return [np.full(shape, value, dtype = np.float32),
+            np.full(shape, value + 0.5, dtype = np.float32)]
+
+
+def test_append_epochs(tmp_path):
+
+    store_dir = str(tmp_path / 'pixel_history')
+    append_epoch(store_dir, 'a', make_epoch(1.), date_obs = '2013-05-01')
+    append_epoch(store_dir, 'b', make_epoch(2.), date_obs = '2013-04-01')
+
+    epochs, history = get_region_history(store_dir, 2, 250, 300, 0, 20)
+    assert [epoch['key'] for epoch in epochs] == ['b', 'a']
+    assert history.shape == (2, 50, 20)
+    assert np.all(history[0] == 2.5) and np.all(history[1] == 1.5)
+
+
+def test_replace_epoch(tmp_path):
+
+    store_dir = str(tmp_path / 'pixel_history')
+    append_epoch(store_dir, 'a', make_epoch(1.), date_obs = '2013-05-01')
+    append_epoch(store_dir, 'b', make_epoch(2.), date_obs = '2013-06-01')
+    append_epoch(store_dir, 'a', make_epoch(7.), date_obs = '2013-05-01')
+
+    assert [epoch['key'] for epoch in read_history_index(store_dir)['epochs']] == \
+           ['a', 'b']
+    epochs, values = get_pixel_history(store_dir, 1, 299, 19)
+    assert list(values) == [7., 2.]
+
+    #the chunk files hold one slab per epoch, nothing stale at the end
+    n_bytes = sum([chunk.stat().st_size for chunk in
+                   (tmp_path / 'pixel_history').glob('*.bin')])
+    assert n_bytes == 2 * 2 * 300 * 20 * 4
+    epochs, history = get_region_history(store_dir, 1, 0, 300, 0, 20)
+    assert np.all(history[0] == 7.) and np.all(history[1] == 2.)
+
+
+def test_dq_flags(tmp_path):
+
+    store_dir = str(tmp_path / 'pixel_history')
+    dq = [np.zeros((300,20), dtype = np.int16), np.zeros((300,20), dtype = np.int16)]
+    dq[1][299,19] = -32768
+    append_epoch(store_dir, 'a', make_epoch(1.), dq_arrays = dq, date_obs = '2013-05-01')
+    with pytest.raises(ValueError):
+        append_epoch(store_dir, 'b', make_epoch(2.), date_obs = '2013-06-01')
+
+    assert has_dq(store_dir)
+    epochs, history, dq_history = get_region_history(store_dir, 2, 290, 300, 10, 20,
+                                                     dq = True)
+    assert dq_history.dtype == np.uint16
+    assert dq_history[0,-1,-1] == 32768 and dq_history.sum() == 32768
@@ -0,0 +1,294 @@
+import numpy as np
+import pytest
+from QE_pixel_tools import plan_combine, SIGMA_CLIP_BLOCK_ROWS
+
+
+def test_plan_combine_sigma_clip_temporaries():
+
+    dims, n_files = (2051, 4096), 100
+    median_row = 2 * n_files * dims[1] * 5 + 2 * dims[1] * 24
+    clip_block = n_files * SIGMA_CLIP_BLOCK_ROWS * dims[1] * 18
+    max_memory = int((50 * median_row + clip_block) / 0.8)
+
+    assert plan_combine(n_files, dims, 2, 'median', max_memory) == \
+           ('tiled', int(0.8 * max_memory // median_row))
+    assert plan_combine(n_files, dims, 2, 'sigma_clip', max_memory) == ('tiled', 50)
+    with pytest.raises(MemoryError):
+        plan_combine(n_files, dims, 2, 'sigma_clip', int(clip_block / 0.8))
+
+
+@pytest.mark.parametrize('kind', ['raw', 'scaled', 'compressed'])
+def test_open_fits_section(tmp_path, kind):
+
+    from astropy.io import fits
+    from QE_pixel_tools import open_fits_section
+
+    rng = np.random.default_rng(0)
+    sci = [rng.normal(1000, 30, (40,24)).astype(np.float32) for chip in (1,2)]
+    dq = [rng.choice([0, 4, 40000], (40,24)).astype(np.uint16) for chip in (1,2)]
+    hdus = [fits.PrimaryHDU()]
+    for chip in (1,2):
+        if kind == 'compressed':
+            chip_hdus = [fits.CompImageHDU(sci[chip-1], name = 'SCI',
+                                           compression_type = 'GZIP_1',
+                                           quantize_level = 0.),
+                         fits.CompImageHDU(dq[chip-1], name = 'DQ')]
+        else:
+            chip_hdus = [fits.ImageHDU(sci[chip-1].copy(), name = 'SCI'),
+                         fits.ImageHDU(dq[chip-1], name = 'DQ')]
+            if kind == 'scaled':
+                chip_hdus[0].scale('int16', bzero = 1000., bscale = 0.01)
+        for hdu in chip_hdus:
+            hdu.header['EXTVER'] = chip
+        hdus += chip_hdus
+    path = str(tmp_path / 'flat.fits')
+    fits.HDUList(hdus).writeto(path)
+
+    sci_arrays, dq_arrays = open_fits_section(path, [1,2], (5,17), DQ = True)
+    for chip in (1,2):
+        atol = 0.01 if kind == 'scaled' else 0.
+        assert np.allclose(sci_arrays[chip-1], sci[chip-1][5:17], rtol = 0., atol = atol)
+        assert np.array_equal(dq_arrays[chip-1], dq[chip-1][5:17])
+
+
+@pytest.mark.parametrize('compression', [None, 'lossless', 16])
+def test_compressed_flat_round_trip(tmp_path, compression):
+
+    from QE_pixel_tools import open_fits, write_full_frame_uvis_image
+
+    rng = np.random.default_rng(0)
+    sci = [rng.normal(1000, 30, (40,24)) for chip in (1,2)]
+    dq = [rng.choice([0, 4, 512], (40,24)).astype(np.int16) for chip in (1,2)]
+    paths = [str(tmp_path / 'flat_{}.fits'.format(i)) for i in range(2)]
+    for path in paths:
+        write_full_frame_uvis_image(sci[0], sci[1], dq[0], dq[1], path,
+                                    compression = compression)
+
+    sci_arrays, dq_arrays = open_fits(paths[0], [1,2], DQ = True)
+    for chip in (1,2):
+        assert np.array_equal(dq_arrays[chip-1], dq[chip-1])
+        if compression is None:
+            assert np.array_equal(sci_arrays[chip-1], sci[chip-1])
+        elif compression == 'lossless':
+            assert np.array_equal(sci_arrays[chip-1], sci[chip-1].astype(np.float32))
+        else:
+            #quantized to about 30 / 16 of the noise, the same in both files
+            assert np.abs(sci_arrays[chip-1] - sci[chip-1]).max() < 2.
+            assert np.array_equal(sci_arrays[chip-1], open_fits(paths[1], [chip])[0])
+
+    with pytest.raises(ValueError):
+        write_full_frame_uvis_image(sci[0], sci[1], dq[0], dq[1], paths[0],
+                                    compression = 'rice')
+
+
+def test_strips_match_full_frame(tmp_path, make_flts):
+
+    from astropy.io import fits
+    from QE_pixel_tools import make_avg_flat_array, make_avg_flat_array_strips
+
+    ifiles = make_flts(str(tmp_path), 5)
+    with fits.open(ifiles[0], mode = 'update') as hdu_list:
+        hdu_list['SCI',1].data[20:22,3] = np.nan
+
+    #strips of 16 rows, the last one shorter
+    for avg_type in ('median', 'mean'):
+        expected = make_avg_flat_array(ifiles, avg_type, [1,2], combine_dq_arrays = True)
+        result = make_avg_flat_array_strips(ifiles, avg_type, [1,2], strip_height = 16,
+                                            combine_dq_arrays = True)
+        for j in range(2):
+            assert np.allclose(result[0][j], expected[0][j], rtol = 1e-12, atol = 0.,
+                               equal_nan = True)
+        assert np.array_equal(result[1], expected[1])
+
+
+def make_cube(seed, n_files = 15, shape = (12,10)):
+
+    """Float32 cube with outliers, NaNs and one pixel with no valid values."""
+
+    rng = np.random.default_rng(seed)
+    cube = rng.normal(1000, 30, (n_files,) + shape).astype(np.float32)
+    cube[rng.random(cube.shape) < 0.05] = 5000.
+    cube[rng.random(cube.shape) < 0.1] = np.nan
+    cube[:,0,0] = np.nan
+    return cube
+
+
+def test_nanmedian_cube_matches_numpy():
+
+    from QE_pixel_tools import nanmedian_cube, make_stats_arrays, get_stats_out
+
+    cube = make_cube(0)
+    stats = ['mad', 'n_valid', 'p16', 'p84']
+    stats_arrays = make_stats_arrays(stats, 1, cube.shape[1:])
+    with np.errstate(all = 'ignore'), pytest.warns(RuntimeWarning):
+        median = np.nanmedian(cube, axis = 0)
+        mad = np.nanmedian(np.abs(cube - median), axis = 0)
+        percentiles = np.nanpercentile(cube, [16, 84], axis = 0)
+
+    out = nanmedian_cube(cube.copy(), stats_out = get_stats_out(stats_arrays, 0))
+    assert np.allclose(out, median, equal_nan = True)
+    assert np.allclose(stats_arrays['mad'][0], mad, equal_nan = True)
+    assert np.array_equal(stats_arrays['n_valid'][0], (~np.isnan(cube)).sum(axis = 0))
+    assert np.allclose(stats_arrays['p16'][0], percentiles[0], equal_nan = True)
+    assert np.allclose(stats_arrays['p84'][0], percentiles[1], equal_nan = True)
+
+
+@pytest.mark.filterwarnings('ignore:Input data contains invalid values')
+@pytest.mark.parametrize('sigma, iters', [(3., 5), (2., 1), (2.5, 10)])
+def test_sigma_clip_cube_matches_astropy(sigma, iters):
+
+    from astropy.stats import sigma_clip
+    from QE_pixel_tools import sigma_clip_cube
+
+    cube = make_cube(1)
+    clipped = sigma_clip(cube.astype(np.float64), sigma = sigma, maxiters = iters,
+                         cenfunc = 'mean', stdfunc = 'std', axis = 0, masked = True)
+    with np.errstate(all = 'ignore'):
+        expected = clipped.mean(axis = 0).filled(np.nan)
+
+    out, n_clipped = sigma_clip_cube(cube, sigma = sigma, iters = iters)
+    assert n_clipped.sum() > 0
+    assert np.allclose(out, expected, rtol = 1e-6, equal_nan = True)
+    assert np.array_equal(n_clipped, (clipped.mask & ~np.isnan(cube)).sum(axis = (1,2)))
+
+
+def test_checkpoint_resume(tmp_path, make_flts, monkeypatch):
+
+    import QE_pixel_tools
+    from QE_pixel_tools import make_avg_flat_array_strips
+
+    ifiles = make_flts(str(tmp_path / 'visit'), 7)
+    kwargs = {'strip_height': 8, 'combine_dq_arrays': True, 'stats': ['mad', 'p16']}
+    expected = make_avg_flat_array_strips(ifiles, 'median', [1,2], **kwargs)
+
+    #interrupted after 2 of the 5 strips
+    checkpoint_dir = str(tmp_path / 'checkpoint')
+    nanmedian_cube = QE_pixel_tools.nanmedian_cube
+    calls = []
+    def interrupted(*args, **kw):
+        calls.append(1)
+        if len(calls) > 4:
+            raise KeyboardInterrupt
+        return nanmedian_cube(*args, **kw)
+    monkeypatch.setattr(QE_pixel_tools, 'nanmedian_cube', interrupted)
+    with pytest.raises(KeyboardInterrupt):
+        make_avg_flat_array_strips(ifiles, 'median', [1,2], checkpoint_dir = checkpoint_dir,
+                                   checkpoint_key = 'key', **kwargs)
+
+    #resumed: only the 3 strips left of each chip are combined
+    del calls[:]
+    monkeypatch.setattr(QE_pixel_tools, 'nanmedian_cube',
+                        lambda *args, **kw: calls.append(1) or nanmedian_cube(*args, **kw))
+    result = make_avg_flat_array_strips(ifiles, 'median', [1,2],
+                                        checkpoint_dir = checkpoint_dir,
+                                        checkpoint_key = 'key', **kwargs)
+    assert len(calls) == 6
+    for j in range(2):
+        assert np.array_equal(result[0][j], expected[0][j], equal_nan = True)
+    assert np.array_equal(result[1], expected[1])
+    for name in kwargs['stats']:
+        assert np.array_equal(result[2][name], expected[2][name], equal_nan = True)
+
+
+def test_cache_eviction(set_params):
+
+    from QE_pixel_tools import get_cached, clear_cache, get_cache_info
+
+    set_params(chip_cache_bytes = 3 * 800)
+    clear_cache()
+    hits = get_cache_info()['hits']
+    made = []
+    def make(key):
+        return lambda: made.append(key) or np.full(100, float(len(made)))
+
+    for key in 'abc':
+        get_cached(key, make(key))
+    assert get_cached('a', make('a'))[0] == 1.
+    get_cached('d', make('d'))
+
+    #b was the least recently used
+    info = get_cache_info()
+    assert (info['entries'], info['bytes'], info['hits'] - hits) == (3, 2400, 1)
+    get_cached('b', make('b'))
+    get_cached('a', make('a'))
+    assert made == ['a', 'b', 'c', 'd', 'b']
+
+    #a value over the budget is returned, not cached
+    assert len(get_cached('big', lambda: np.zeros(400))) == 400
+    assert get_cache_info()['entries'] == 3
+    clear_cache()
+
+
+def test_load_chip_invalidated_on_mtime(tmp_path, make_flts):
+
+    import os
+    from astropy.io import fits
+    from QE_pixel_tools import load_chip, load_masked_flat, clear_cache
+
+    clear_cache()
+    ifile = make_flts(str(tmp_path), 1)[0]
+    os.utime(ifile, (1e9, 1e9))
+    sci = load_chip(ifile, 1)
+    masked = load_masked_flat(ifile, [1,2], mask_DQ = True)
+    assert load_chip(ifile, 1) is sci
+    assert load_masked_flat(ifile, [1,2], mask_DQ = True) is masked
+
+    with fits.open(ifile, mode = 'update') as hdu_list:
+        hdu_list['SCI',1].data[:] = 7.
+        hdu_list['DQ',1].data[:] = 0
+    os.utime(ifile, (1e9 + 1, 1e9 + 1))
+    assert np.all(load_chip(ifile, 1) == 7.)
+    assert np.all(load_masked_flat(ifile, [1,2], mask_DQ = True)[0][10:-10] == 7.)
+    clear_cache()
+
+
+def test_cached_arrays_read_only(tmp_path, make_flts):
+
+    from QE_pixel_tools import load_chip, load_masked_flat, writable_copy, clear_cache
+
+    clear_cache()
+    ifile = make_flts(str(tmp_path), 1)[0]
+    sci = load_chip(ifile, 2)
+    masked = load_masked_flat(ifile, [1,2])
+    for ar in [sci, load_chip(ifile, 2, 'DQ')] + masked:
+        assert not ar.flags.writeable
+        with pytest.raises(ValueError):
+            ar[0,0] = 0
+    assert np.isnan(masked[1][0:10]).all() and not np.isnan(masked[1][10:-10]).any()
+
+    copy = writable_copy(sci)
+    copy[0,0] = 0
+    assert sci[0,0] != 0
+    clear_cache()
+
+
+def test_running_mean_matches_numpy(tmp_path, make_flts):
+
+    from astropy.io import fits
+    from QE_pixel_tools import make_mean_flat_array
+
+    ifiles = make_flts(str(tmp_path), 6)
+    for i, ifile in enumerate(ifiles):
+        with fits.open(ifile, mode = 'update') as hdu_list:
+            hdu_list['SCI',2].data[5,0:i] = np.nan
+            #flagged in every file, so no valid value is left with mask_dq_each
+            hdu_list['DQ',1].data[3,3] = 16
+    cube = np.array([[fits.getdata(ifile, ('SCI',chip)) for chip in (1,2)]
+                     for ifile in ifiles], dtype = np.float64)
+    dq = np.array([[fits.getdata(ifile, ('DQ',chip)) for chip in (1,2)]
+                   for ifile in ifiles]).view(np.uint16)
+
+    means, dq_union = make_mean_flat_array(ifiles, [1,2], combine_dq_arrays = True)
+    for j in range(2):
+        with np.errstate(all = 'ignore'):
+            assert np.allclose(means[j], np.nanmean(cube[:,j], axis = 0), rtol = 1e-12)
+    assert np.array_equal(dq_union, np.bitwise_or.reduce(dq, axis = 0))
+
+    masked = np.where(dq != 0, np.nan, cube)
+    means, dq_union = make_mean_flat_array(ifiles, [1,2], mask_dq_each = True)
+    with np.errstate(all = 'ignore'), pytest.warns(RuntimeWarning):
+        expected = np.nanmean(masked, axis = 0)
+    for j in range(2):
+        assert np.allclose(means[j], expected[j], rtol = 1e-12, equal_nan = True)
+    assert np.isnan(means[0][3,3]) and np.isnan(means[0]).sum() == 1
+    assert not dq_union.any()
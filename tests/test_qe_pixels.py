@@ -0,0 +1,58 @@
+import os
+import subprocess
+import sys
+import pytest
+import qe_pixels
+from qe_pixels import get_parser, main
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_subcommands():
+
+    parser = get_parser()
+    args = parser.parse_args(['run', '--workers', '3', '--dry-run'])
+    assert (args.func, args.workers, args.dry_run, args.watch) == \
+           (qe_pixels.cmd_run, 3, True, False)
+
+    args = parser.parse_args(['--report', 'report.jsonl', 'median', '--prop-ids',
+                              '13169', '13585'])
+    assert (args.func, args.prop_ids, args.workers, args.report) == \
+           (qe_pixels.cmd_median, ['13169', '13585'], 1, 'report.jsonl')
+
+    args = parser.parse_args(['find-anom', '--no-mask-border'])
+    assert args.func == qe_pixels.cmd_find_anom and args.no_mask_border
+
+    for command, func in (('update-anneals', qe_pixels.cmd_update_anneals),
+                          ('sort', qe_pixels.cmd_sort), ('index', qe_pixels.cmd_index),
+                          ('visit-means', qe_pixels.cmd_visit_means),
+                          ('watch', qe_pixels.cmd_watch),
+                          ('status', qe_pixels.cmd_status)):
+        assert parser.parse_args([command]).func == func
+
+    with pytest.raises(SystemExit):
+        parser.parse_args([])
+    with pytest.raises(SystemExit):
+        parser.parse_args(['status', '--workers', '2'])
+
+
+def test_failed_tasks_exit_status(monkeypatch):
+
+    monkeypatch.setattr(qe_pixels, 'cmd_visit_means', lambda args: [('visit', 'error')])
+    with pytest.raises(SystemExit) as exit_info:
+        main(['visit-means'])
+    assert exit_info.value.code == 1
+
+    monkeypatch.setattr(qe_pixels, 'cmd_visit_means', lambda args: [])
+    main(['visit-means'])
+
+
+def test_status_imports_no_pipeline():
+
+    script = ('import sys, qe_pixels\n'
+              'qe_pixels.main(["status"])\n'
+              'print(sorted([name for name in ("numpy", "astropy", "QE_pixel_tools") '
+              'if name in sys.modules]))\n')
+    output = subprocess.check_output([sys.executable, '-c', script], cwd = REPO_DIR,
+                                     universal_newlines = True)
+    assert output.splitlines()[-1] == '[]'
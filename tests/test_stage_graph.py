@@ -0,0 +1,159 @@
+import json
+import os
+import pytest
+from stage_graph import make_node, run_graph, find_stale_nodes, read_state, \
+                        get_pipeline_tasks
+
+calls = []
+
+
+def copy_file(src, dst):
+
+    calls.append(os.path.basename(dst))
+    with open(src) as f:
+        text = f.read()
+    with open(dst, 'w') as f:
+        f.write(text + '+')
+
+
+def fail(src, dst):
+
+    calls.append(os.path.basename(dst))
+    raise ValueError('bad input')
+
+
+def interrupt(src, dst):
+
+    raise KeyboardInterrupt
+
+
+def make_chain(tmp_path, second = copy_file):
+
+    """a.txt -> b.txt -> c.txt, in two stages, and an independent d.txt -> e.txt."""
+
+    a, b, c, d, e = [str(tmp_path / name) for name in ('a.txt','b.txt','c.txt',
+                                                       'd.txt','e.txt')]
+    for path in (a, d):
+        if not os.path.isfile(path):
+            with open(path, 'w') as f:
+                f.write(os.path.basename(path))
+    return [make_node('b', 'first', copy_file, (a, b), [a], [b]),
+            make_node('e', 'first', copy_file, (d, e), [d], [e]),
+            make_node('c', 'second', second, (b, c), [b], [c], {'version': 1})]
+
+
+def test_unchanged_nodes_skipped(tmp_path):
+
+    state_path = str(tmp_path / 'state.json')
+    del calls[:]
+    assert run_graph(make_chain(tmp_path), state_path) == []
+    assert calls == ['b.txt', 'e.txt', 'c.txt']
+
+    del calls[:]
+    assert run_graph(make_chain(tmp_path), state_path) == []
+    assert calls == []
+
+    #a new modification time alone does not make a node stale
+    os.utime(str(tmp_path / 'a.txt'), (1e9, 1e9))
+    assert find_stale_nodes(make_chain(tmp_path), read_state(state_path)) == []
+
+
+def test_rebuild_propagates_downstream(tmp_path):
+
+    state_path = str(tmp_path / 'state.json')
+    run_graph(make_chain(tmp_path), state_path)
+
+    with open(str(tmp_path / 'a.txt'), 'w') as f:
+        f.write('changed')
+    stale = find_stale_nodes(make_chain(tmp_path), read_state(state_path))
+    assert [(node['name'], reason) for node, reason in stale] == \
+           [('b', 'inputs changed'), ('c', 'upstream rebuilt')]
+
+    del calls[:]
+    run_graph(make_chain(tmp_path), state_path)
+    assert calls == ['b.txt', 'c.txt']
+    with open(str(tmp_path / 'c.txt')) as f:
+        assert f.read() == 'changed++'
+
+
+def test_failed_node_skips_downstream(tmp_path):
+
+    state_path = str(tmp_path / 'state.json')
+    nodes = make_chain(tmp_path)
+    nodes[0] = make_node('b', 'first', fail, nodes[0]['args'], nodes[0]['inputs'],
+                         nodes[0]['outputs'])
+    del calls[:]
+    assert run_graph(nodes, state_path) == ['b', 'c']
+    assert calls == ['b.txt', 'e.txt']
+    assert sorted(read_state(state_path)['nodes']) == ['e']
+
+    #the failed nodes are tried again next run
+    del calls[:]
+    assert run_graph(make_chain(tmp_path), state_path) == []
+    assert calls == ['b.txt', 'c.txt']
+
+
+def test_dry_run_reasons(tmp_path, capsys):
+
+    state_path = str(tmp_path / 'state.json')
+    run_graph(make_chain(tmp_path), state_path)
+
+    with open(str(tmp_path / 'd.txt'), 'w') as f:
+        f.write('changed')
+    os.remove(str(tmp_path / 'c.txt'))
+    nodes = make_chain(tmp_path) + [make_node('f', 'second', copy_file,
+                                              (str(tmp_path / 'e.txt'),
+                                               str(tmp_path / 'f.txt')),
+                                              [str(tmp_path / 'e.txt')],
+                                              [str(tmp_path / 'f.txt')])]
+    capsys.readouterr()
+    del calls[:]
+    assert run_graph(nodes, state_path, dry_run = True) == []
+    assert calls == []
+
+    lines = capsys.readouterr().out.splitlines()
+    assert lines[0] == '3 of 4 nodes would be rebuilt.'
+    reasons = dict([(line.split()[1], ' '.join(line.split()[2:4])) for line in lines[1:4]])
+    assert reasons == {'e': 'inputs changed', 'c': 'outputs missing',
+                       'f': 'upstream rebuilt'}
+    assert lines[-1].startswith('Estimated cost:')
+
+
+def test_state_kept_after_partial_run(tmp_path):
+
+    state_path = str(tmp_path / 'state.json')
+    with pytest.raises(KeyboardInterrupt):
+        run_graph(make_chain(tmp_path, second = interrupt), state_path)
+
+    #the first stage was recorded before the interruption
+    with open(state_path) as f:
+        assert sorted(json.load(f)['nodes']) == ['b', 'e']
+
+    del calls[:]
+    assert run_graph(make_chain(tmp_path), state_path) == []
+    assert calls == ['c.txt']
+
+
+def test_filter_flats_fused(tmp_path):
+
+    visit_dirs = [str(tmp_path / 'F225W/13169/55005.0' / date) for date in
+                  ('2013-05-01', '2013-05-09')]
+    ifiles = [os.path.join(visit_dir, 'ic000000q_flt.fits') for visit_dir in visit_dirs]
+    median = make_node('median:F225W', 'flats', copy_file,
+                       (str(tmp_path), 'F225W', ifiles), [], [])
+    visits = [make_node('visit_mean:F225W/13169/55005.0/' + os.path.basename(visit_dir),
+                        'flats', copy_file, (visit_dir, [ifile]), [], [])
+              for visit_dir, ifile in zip(visit_dirs, ifiles)]
+    anom = make_node('anom_pixels:F225W/13169/55005.0/2013-05-01', 'anom_pixels',
+                     copy_file, (), [], [])
+
+    #every flat of the filter is stale: one pass over the files
+    tasks = get_pipeline_tasks([median] + visits + [anom])
+    assert [(task[0], names) for task, names in tasks] == \
+           [('filter flats F225W', ['median:F225W'] + [node['name'] for node in visits]),
+            (anom['name'], [anom['name']])]
+    assert tasks[0][0][2].__name__ == 'make_filter_flats'
+
+    #one visit up to date: the flats are made separately
+    tasks = get_pipeline_tasks([median, visits[1]])
+    assert [names for task, names in tasks] == [['median:F225W'], [visits[1]['name']]]
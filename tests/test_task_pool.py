@@ -0,0 +1,63 @@
+import json
+import os
+import instrumentation
+from instrumentation import instrumented, start_run
+from task_pool import run_tasks
+
+
+def succeed():
+
+    pass
+
+
+def fail():
+
+    raise ValueError('bad input')
+
+
+def kill_worker():
+
+    os._exit(1)
+
+
+def test_failed_tasks_returned():
+
+    tasks = [('ok', 1, succeed, ()), ('bad', 2, fail, ())]
+    failed = run_tasks(tasks, workers = 1)
+    assert [name for name, error in failed] == ['bad']
+    assert 'ValueError' in failed[0][1]
+
+
+def test_broken_pool_marks_tasks_failed():
+
+    tasks = [('killed', 3, kill_worker, ())] + \
+            [('ok {}'.format(i), 1, succeed, ()) for i in range(4)]
+    failed = run_tasks(tasks, workers = 2, max_memory = 2**34)
+    names = [name for name, error in failed]
+    assert 'killed' in names
+    assert 'BrokenProcessPool' in dict(failed)['killed']
+
+
+@instrumented()
+def record_stage():
+
+    pass
+
+
+def test_worker_records_merged(tmp_path, monkeypatch):
+
+    report = str(tmp_path / 'report.jsonl')
+    #start_run sets these, the monkeypatch restores them afterwards
+    monkeypatch.setenv(instrumentation.REPORT_ENV, report)
+    monkeypatch.setenv(instrumentation.REPORT_OWNER_ENV, '')
+    start_run(report)
+
+    tasks = [('task{}'.format(i), 1, record_stage, ()) for i in range(6)]
+    assert run_tasks(tasks, workers = 2) == []
+    assert os.listdir(str(tmp_path)) == ['report.jsonl']
+    with open(report) as f:
+        records = [json.loads(line) for line in f]
+    assert [record['stage'] for record in records] == ['record_stage'] * 6
+    assert os.getpid() not in [record['pid'] for record in records]
+    starts = [record['start'] for record in records]
+    assert starts == sorted(starts)
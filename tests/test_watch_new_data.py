@@ -0,0 +1,41 @@
+import os
+import anneal_calendar
+from watch_new_data import NewDataWatcher
+
+
+def test_bad_and_late_files(tmp_path, monkeypatch, make_flts):
+
+    anneal_info_dir = str(tmp_path / 'anneal_info')
+    os.makedirs(anneal_info_dir)
+    with open(os.path.join(anneal_info_dir, 'anneal_mjds.txt'), 'w') as f:
+        f.write('56500.0\n')
+    monkeypatch.setattr(anneal_calendar, 'paths',
+                        lambda: {'anneal_info_dir': anneal_info_dir})
+
+    paths = {'new_data_dir': str(tmp_path / 'new_data'), 'data_dir': str(tmp_path / 'data'),
+             'pipeline_state': str(tmp_path / 'state.json')}
+    good = make_flts(paths['new_data_dir'], 1, seed = 1, date_obs = '2013-05-01')
+    late = make_flts(paths['new_data_dir'], 1, seed = 2, date_obs = '2014-01-01')
+    bad = os.path.join(paths['new_data_dir'], 'icbad000q_flt.fits')
+    with open(bad, 'wb') as f:
+        f.write(b'SIMPLE  =                    T' + b' ' * 100)
+
+    watcher = NewDataWatcher(paths, settle_s = 0, debounce_s = 1e9,
+                             median_interval_s = 1e9)
+    watcher.poll(now = 100.)
+
+    assert os.path.isfile(os.path.join(paths['new_data_dir'], 'quarantine',
+                                       os.path.basename(bad)))
+    assert list(watcher.pending_visits) == [paths['data_dir'] +
+                                            '/F225W/13169/56500.0/2013-05-01']
+    assert [info[0] for info in list(watcher.pending_visits.values())[0]] == good
+    assert watcher.waiting_anneal == set(late)
+
+    #the late file gets its epoch once the anneal dates are updated
+    with open(os.path.join(anneal_info_dir, 'anneal_mjds.txt'), 'w') as f:
+        f.write('56500.0\n57000.0\n')
+    os.utime(os.path.join(anneal_info_dir, 'anneal_mjds.txt'), (1e9, 1e9))
+    watcher.poll(now = 200.)
+    assert watcher.waiting_anneal == set()
+    assert paths['data_dir'] + '/F225W/13169/57000.0/2014-01-01' in watcher.pending_visits
+    assert not any(['None' in visit_dir for visit_dir in watcher.pending_visits])
@@ -0,0 +1,254 @@
+import glob
+import os
+import shutil
+import time
+import traceback
+from paths_and_params import paths, params
+from sort_new_data import get_info_new_files, sort_files
+from anneal_calendar import get_anneal_file
+from make_median_filter_flats import get_median_flat_path
+from stage_graph import build_pipeline_graph, run_graph, main_run_stage_graph
+from instrumentation import instrumented
+
+""" Watches new_data_dir and processes new observations as they arrive.
+
+	The directory is polled, and the size and modification time of each file kept
+	in a stat cache. A file is considered complete once it has not changed for
+	params()['watch_settle_s'] seconds, and is then assigned to its visit from its
+	header. A visit is processed once no file of it arrived for
+	params()['watch_debounce_s'] seconds: its files are sorted into the data
+	directory, and its mean flat and anomalous pixels (if the filter has a median
+	flat) are made with the stage graph. The median flats, and the anomalous
+	pixels depending on them, are rebuilt every params()['watch_median_interval_s']
+	seconds if new files were sorted since the last rebuild.
+	
+	Between polls nothing runs, and the directory is only listed again when its
+	modification time changes or files are still being written.
+	
+	A file whose header can not be read (e.g. truncated) is moved to 
+	new_data_dir/quarantine. A file taken after the last anneal in anneal_mjds.txt
+	is left in new_data_dir and read again once the anneal dates are updated.
+	
+"""
+
+class NewDataWatcher(object):
+
+    """Polls new_data_dir and processes visits once they are complete.
+    
+        Parameters
+        ----------
+        
+        paths: dict
+            Output of paths_and_params.paths().
+            
+        settle_s, debounce_s, median_interval_s: floats
+            See the module docstring, default from params().
+            
+    """
+    
+    def __init__(self, paths, settle_s = None, debounce_s = None,
+                 median_interval_s = None):
+                 
+        self.paths = paths
+        self.settle_s = params()['watch_settle_s'] if settle_s is None else settle_s
+        self.debounce_s = params()['watch_debounce_s'] if debounce_s is None \
+                          else debounce_s
+        self.median_interval_s = params()['watch_median_interval_s'] \
+                                 if median_interval_s is None else median_interval_s
+                                 
+        #path: (size, mtime, time of the last change seen)
+        self.stat_cache = {}
+        self.dir_mtime = None
+        
+        #visit directory: [file info (see get_info_new_files)], last arrival time
+        self.pending_visits = {}
+        self.last_arrival = {}
+        self.assigned = set()
+        
+        #files after the last known anneal, read again when the anneal file changes
+        self.waiting_anneal = set()
+        self.anneal_mtime = None
+        
+        self.last_median_build = time.time()
+        self.sorted_since_median = False
+        
+    def scan(self, now):
+    
+        """Updates the stat cache, returns the files that have settled and are not
+            assigned to a visit yet."""
+            
+        new_data_dir = self.paths['new_data_dir']
+        dir_mtime = os.stat(new_data_dir).st_mtime
+        unsettled = len(self.stat_cache) > len(self.assigned)
+        
+        if dir_mtime != self.dir_mtime or unsettled:
+            self.dir_mtime = dir_mtime
+            present = set(glob.glob(new_data_dir+'/*flt.fits'))
+            for path in list(self.stat_cache):
+                if path not in present:
+                    del self.stat_cache[path]
+                    self.assigned.discard(path)
+            for path in present:
+                if path in self.assigned:
+                    continue
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                old = self.stat_cache.get(path)
+                if old is None or old[0:2] != (stat.st_size, stat.st_mtime):
+                    self.stat_cache[path] = (stat.st_size, stat.st_mtime, now)
+                    
+        return [path for path, (size, mtime, changed) in self.stat_cache.items() \
+                if path not in self.assigned and now - changed >= self.settle_s]
+                
+    def quarantine(self, path):
+    
+        """Moves a file that can not be read out of new_data_dir."""
+        
+        quarantine_dir = os.path.join(self.paths['new_data_dir'],'quarantine')
+        print('Can not read {}, moving it to {}:\n{}'.format(path, quarantine_dir,
+              traceback.format_exc()))
+        try:
+            if not os.path.isdir(quarantine_dir):
+                os.makedirs(quarantine_dir)
+            shutil.move(path, quarantine_dir)
+            self.stat_cache.pop(path, None)
+        except (IOError, OSError):
+            print('Could not move {}, ignoring it.'.format(path))
+            self.assigned.add(path)
+            
+    def assign_visits(self, settled, now):
+    
+        """Reads the headers of settled files and adds them to their pending visit,
+            one file at a time so that a bad file does not stop the others."""
+            
+        data_dir = self.paths['data_dir']
+        for path in settled:
+            try:
+                info = get_info_new_files([path])[0]
+            except Exception:
+                self.quarantine(path)
+                continue
+                
+            if info[3] is None:
+                print('{} was taken after the last known anneal, waiting for the '
+                      'anneal dates to be updated.'.format(os.path.basename(path)))
+                self.waiting_anneal.add(path)
+                self.assigned.add(path)
+                continue
+                
+            filt, prop_id, anneal_mjd, date_obs = info[1:5]
+            visit_dir = data_dir+'/{0}/{1}/{2}/{3}'.format(filt,prop_id,anneal_mjd,
+                                                           date_obs)
+            self.pending_visits.setdefault(visit_dir, []).append(info)
+            self.last_arrival[visit_dir] = now
+            self.assigned.add(info[0])
+            
+    def process_visit(self, visit_dir):
+    
+        """Sorts the pending files of a visit, then makes its mean flat and
+            anomalous pixels."""
+            
+        infos = self.pending_visits.pop(visit_dir)
+        del self.last_arrival[visit_dir]
+        print('Processing {} new files of visit {}'.format(len(infos), visit_dir))
+        
+        #files left in new_data_dir by a failed sort are picked up again
+        try:
+            sort_files(self.paths, infos)
+        finally:
+            for info in infos:
+                self.assigned.discard(info[0])
+                self.stat_cache.pop(info[0], None)
+        self.sorted_since_median = True
+        
+        data_dir = self.paths['data_dir']
+        filt = visit_dir.split('/')[-4]
+        visit = '/'.join(visit_dir.split('/')[-4:])
+        names = ['visit_mean:'+visit]
+        if os.path.isfile(get_median_flat_path(data_dir, filt)):
+            names += ['anom_pixels:'+visit, 'anom_table:'+filt]
+        else:
+            print('No median flat for', filt, ', anomalous pixels deferred.')
+            
+        nodes = [node for node in build_pipeline_graph(data_dir, filters = [filt]) \
+                 if node['name'] in names]
+        run_graph(nodes, self.paths['pipeline_state'])
+        
+    def poll(self, now = None):
+    
+        """Checks new_data_dir once, and processes the visits and median rebuild
+            that are due."""
+            
+        if now is None:
+            now = time.time()
+            
+        #files waiting for an anneal are read again once the anneal list changes
+        anneal_mtime = os.path.getmtime(get_anneal_file())
+        if anneal_mtime != self.anneal_mtime:
+            self.anneal_mtime = anneal_mtime
+            for path in self.waiting_anneal:
+                self.assigned.discard(path)
+                self.stat_cache.pop(path, None)
+            self.waiting_anneal = set()
+            self.dir_mtime = None
+            
+        settled = self.scan(now)
+        if len(settled) > 0:
+            self.assign_visits(settled, now)
+            
+        #a visit that fails is logged, the others are still processed
+        for visit_dir in sorted(self.pending_visits):
+            if now - self.last_arrival[visit_dir] >= self.debounce_s:
+                try:
+                    self.process_visit(visit_dir)
+                except Exception:
+                    print('Visit {} failed:\n{}'.format(visit_dir,
+                          traceback.format_exc()))
+                          
+        if self.sorted_since_median and \
+           now - self.last_median_build >= self.median_interval_s:
+            print('Rebuilding median flats.')
+            self.last_median_build = now
+            self.sorted_since_median = False
+            try:
+                main_run_stage_graph(self.paths['data_dir'],
+                                     self.paths['pipeline_state'])
+            except Exception:
+                print('Median rebuild failed:\n{}'.format(traceback.format_exc()))
+                
+@instrumented()
+def main_watch_new_data(paths, poll_s = None):
+
+    """Watches new_data_dir until interrupted, see NewDataWatcher.
+    
+        Parameters
+        ----------
+        paths : dict
+            Output of paths_and_params.paths().
+            
+        poll_s : float
+            Seconds between polls, default params()['watch_poll_s'].
+            
+    """
+    
+    if poll_s is None:
+        poll_s = params()['watch_poll_s']
+        
+    watcher = NewDataWatcher(paths)
+    print('Watching {} every {} s.'.format(paths['new_data_dir'], poll_s))
+    try:
+        while True:
+            #an unexpected error is logged, and the next poll tries again
+            try:
+                watcher.poll()
+            except Exception:
+                print('Poll failed:\n{}'.format(traceback.format_exc()))
+            time.sleep(poll_s)
+    except KeyboardInterrupt:
+        print('Stopped watching. {} visits pending.'.format(len(watcher.pending_visits)))
+        
+if __name__ == '__main__':
+
+    main_watch_new_data(paths())
@@ -1,35 +1,63 @@
-from download_new_anneal_file import *
+import argparse
+import sys
+from download_new_anneal_file import main_update_anneal_file
 from paths_and_params import paths
-from make_median_filter_flats import *
-from make_mean_visit_flats import *
-from sort_new_data import *
-from group_files_by_date import *
+from sort_new_data import main_sort_new_data
+from stage_graph import main_run_stage_graph
+from watch_new_data import main_watch_new_data
+from instrumentation import instrumented, start_run
 
-def main_run_QE_pixels(paths):
+@instrumented()
+def main_run_QE_pixels(paths, workers = 1, dry_run = False):
 
     #unpack paths
-    data_dir, new_data_dir = paths['data_dir'],paths['new_data_dir']
+    data_dir = paths['data_dir']
     
-    #download most recent anneal date file, update anneal_dates.txt
-    main_update_anneal_file()
+    if dry_run:
+        print('Dry run: anneal dates not updated, new data not sorted.')
     
-    #sort files in new_data dir into subdirectories by filter
-    main_sort_new_data(data_dir,new_data_dir)
+    else:
+        #download most recent anneal date file, update anneal_dates.txt
+        main_update_anneal_file(paths['anneal_info_dir'])
     
-    #group new files in filter subdirectories by nearest anneal date
-    main_group_files_by_date(data_dir)
+        #sort files in new_data dir into filter/proposal/anneal date/visit subdirectories
+        main_sort_new_data(paths)
     
-    #make ideal median flats for each filter, median combining all observations
-    main_make_median_flats(data_dir)
-    
-    #make mean flat for each filter/epoch of data
-    main_make_mean_visit_flats(data_dir)
-    
-    #mask pixels in median / mean flats with DQ array 
+    #make ideal median flats for each filter, median combining all observations,
+    #mean flat for each filter/epoch of data, mask pixels in median / mean flats 
+    #with DQ array and find low QE pixels, for the products out of date with their 
+    #inputs only
+    return main_run_stage_graph(data_dir, paths['pipeline_state'], workers = workers, 
+                                dry_run = dry_run)
     
     
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Run the QE pixel monitor.')
+    parser.add_argument('--workers', type = int, default = 1,
+                        help = 'number of processes filters / visits are run on')
+    parser.add_argument('--report', default = None,
+                        help = 'append per-stage timings, I/O and memory to this '
+                        'JSON lines file')
+    parser.add_argument('--profile-dir', default = None,
+                        help = 'write cProfile stats of the combine steps here')
+    parser.add_argument('--dry-run', action = 'store_true',
+                        help = 'print what would be rebuilt and the estimated cost, '
+                        'without running anything')
+    parser.add_argument('--watch', action = 'store_true',
+                        help = 'after the run, keep watching new_data_dir and process '
+                        'new visits as they arrive')
+    args = parser.parse_args()
+    
+    if args.report is not None:
+        start_run(args.report, profile_dir = args.profile_dir)
+    
     pathss = paths()
-    main_run_QE_pixels(pathss)
-    
\ No newline at end of file
+    failed = main_run_QE_pixels(pathss, workers = args.workers, dry_run = args.dry_run)
+    
+    if args.watch and not args.dry_run:
+        main_watch_new_data(pathss)
+        
+    if len(failed) > 0:
+        sys.exit(1)
+    